@@ -15,6 +15,7 @@ class App extends Component {
 
     this.state = {
       users: [],
+      nextCursor: null,
       title: "Flask TDD Docker",
       accessToken: null
     };
@@ -25,10 +26,30 @@ class App extends Component {
   }
 
   getUsers() {
+    // GET /users returns a page at a time, with X-Next-Cursor set while more
+    // follow; loadMoreUsers fetches the next one when asked to.
+    this.getUsersPage(undefined, []);
+  }
+
+  loadMoreUsers = () => {
+    this.getUsersPage(this.state.nextCursor, this.state.users);
+  };
+
+  getUsersPage(cursor, users) {
+    // a newer load (after logging in or adding a user) supersedes this one
+    const load = (this.usersLoad = {});
     axios
-      .get(`${process.env.REACT_APP_USERS_SERVICE_URL}/users`)
+      .get(`${process.env.REACT_APP_USERS_SERVICE_URL}/users`, {
+        params: { fields: "id,username", limit: 50, cursor }
+      })
       .then(res => {
-        this.setState({ users: res.data });
+        if (this.usersLoad !== load) {
+          return;
+        }
+        this.setState({
+          users: users.concat(res.data),
+          nextCursor: res.headers["x-next-cursor"] || null
+        });
       })
       .catch(err => {
         console.log(err);
@@ -56,6 +77,22 @@ class App extends Component {
   }
 
   logoutUser = () => {
+    const refreshToken = window.localStorage.getItem("refreshToken");
+    if (refreshToken || this.state.accessToken) {
+      // the access token may have expired; the refresh token is revoked anyway
+      const headers = this.state.accessToken
+        ? { Authorization: `Bearer ${this.state.accessToken}` }
+        : {};
+      axios
+        .post(
+          `${process.env.REACT_APP_USERS_SERVICE_URL}/auth/logout`,
+          { refresh_token: refreshToken },
+          { headers }
+        )
+        .catch(err => {
+          console.log(err);
+        });
+    }
     window.localStorage.removeItem("refreshToken");
     this.setState({ accessToken: null });
   };
@@ -124,7 +161,12 @@ class App extends Component {
                         <AddUser addUser={this.addUser} />
                         <hr />
                         <br />
-                        <UsersList users={this.state.users} />
+                        <UsersList
+                          users={this.state.users}
+                          loadMore={
+                            this.state.nextCursor ? this.loadMoreUsers : null
+                          }
+                        />
                       </div>
                     )}
                   />
@@ -15,12 +15,18 @@ const UsersList = props => {
           </p>
         );
       })}
+      {props.loadMore && (
+        <button className="button is-fullwidth" onClick={props.loadMore}>
+          Load more
+        </button>
+      )}
     </div>
   );
 };
 
 UsersList.propTypes = {
-  users: PropTypes.array.isRequired
+  users: PropTypes.array.isRequired,
+  loadMore: PropTypes.func
 };
 
 export default UsersList;
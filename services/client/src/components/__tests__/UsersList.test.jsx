@@ -1,5 +1,5 @@
 import React from "react";
-import { render, cleanup } from "@testing-library/react";
+import { render, cleanup, fireEvent } from "@testing-library/react";
 
 import UsersList from "../UsersList";
 
@@ -28,3 +28,17 @@ it("renders a username", () => {
   expect(getByText("testuser1")).toHaveClass("username");
   expect(getByText("testuser2")).toHaveClass("username");
 });
+
+it("renders a load more button while more users follow", () => {
+  const loadMore = jest.fn();
+  const { getByText } = render(
+    <UsersList users={users} loadMore={loadMore} />
+  );
+  fireEvent.click(getByText("Load more"));
+  expect(loadMore).toHaveBeenCalledTimes(1);
+});
+
+it("renders no load more button on the last page", () => {
+  const { queryByText } = render(<UsersList users={users} />);
+  expect(queryByText("Load more")).toBeNull();
+});
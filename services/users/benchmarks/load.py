@@ -0,0 +1,283 @@
+"""Load benchmark for every users-service endpoint.
+
+Seeds a throwaway database, serves the app from a threaded WSGI server in
+this process and drives each endpoint with concurrent clients::
+
+    python -m benchmarks.load --users 5000 --concurrency 16
+    python -m benchmarks.load --database-url postgres://postgres@localhost/bench --reset
+    python -m benchmarks.load --compare benchmarks/results/<old commit>.json
+
+Results (p50/p95/p99 latency and requests per second per endpoint) are
+written to ``benchmarks/results/<commit>.json`` unless ``--output`` says
+otherwise. The default SQLite database is fine for spotting Python-side
+regressions; use Postgres for numbers that mean anything about production.
+Seeding drops every table, so a ``--database-url`` that already has tables
+is refused unless ``--reset`` is passed: point it at a scratch database.
+"""
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+PASSWORD = "benchmark-password"
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(int(round(pct / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def to_ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "mean_ms": to_ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": to_ms(percentile(latencies, 50)),
+        "p95_ms": to_ms(percentile(latencies, 95)),
+        "p99_ms": to_ms(percentile(latencies, 99)),
+    }
+
+
+def request(base_url, method, path, body=None, headers=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(base_url + path, data=data, method=method)
+    req.add_header("Content-Type", "application/json")
+    for name, value in (headers or {}).items():
+        req.add_header(name, value)
+    with urllib.request.urlopen(req) as resp:
+        return resp.status, resp.read()
+
+
+def drive(call, total, concurrency):
+    """Runs ``call`` ``total`` times from ``concurrency`` threads."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = count()
+
+    def worker():
+        while next(counter) < total:
+            start = time.perf_counter()
+            try:
+                call()
+            except (urllib.error.URLError, ConnectionError):
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    return summarize(latencies, errors[0], time.perf_counter() - start)
+
+
+def scenarios(base_url, user_ids):
+    """Maps endpoint names to zero-argument callables hitting them."""
+    _, body = request(
+        base_url,
+        "POST",
+        "/auth/login",
+        {"email": "benchmark@example.com", "password": PASSWORD},
+    )
+    access_token = json.loads(body)["access_token"]
+    ids = count()
+    new_users = count()
+
+    def create_user():
+        n = next(new_users)
+        request(
+            base_url,
+            "POST",
+            "/users",
+            {
+                "username": f"created{n}",
+                "email": f"created{n}-{time.time_ns()}@example.com",
+                "password": PASSWORD,
+            },
+        )
+
+    return {
+        "GET /ping": lambda: request(base_url, "GET", "/ping"),
+        "POST /auth/login": lambda: request(
+            base_url,
+            "POST",
+            "/auth/login",
+            {"email": "benchmark@example.com", "password": PASSWORD},
+        ),
+        "GET /auth/status": lambda: request(
+            base_url,
+            "GET",
+            "/auth/status",
+            headers={"Authorization": f"Bearer {access_token}"},
+        ),
+        "GET /users": lambda: request(base_url, "GET", "/users"),
+        "GET /users/<id>": lambda: request(
+            base_url, "GET", f"/users/{user_ids[next(ids) % len(user_ids)]}"
+        ),
+        "POST /users": create_user,
+    }
+
+
+def seed(app, users, reset=False):
+    from sqlalchemy import inspect
+
+    from project import db
+    from project.api.users.models import User
+    from project.api.users.services import bulk_add_users
+
+    with app.app_context():
+        tables = inspect(db.engine).get_table_names()
+        if tables and not reset:
+            raise SystemExit(
+                f"{app.config['SQLALCHEMY_DATABASE_URI']} already has tables "
+                f"({', '.join(sorted(tables))}); pass --reset to recreate the users tables"
+            )
+        db.drop_all()
+        db.create_all()
+        # seed cheaply, but give the login user the configured bcrypt cost
+        rounds = app.config["BCRYPT_LOG_ROUNDS"]
+        app.config["BCRYPT_LOG_ROUNDS"] = 4
+        rows = (
+            {"username": f"user{i}", "email": f"user{i}@example.com", "password": "x"}
+            for i in range(users)
+        )
+        for _ in bulk_add_users(rows, app.config["USERS_BULK_BATCH_SIZE"]):
+            pass
+        app.config["BCRYPT_LOG_ROUNDS"] = rounds
+        db.session.add(
+            User(username="benchmark", email="benchmark@example.com", password=PASSWORD)
+        )
+        db.session.commit()
+        return [user_id for (user_id,) in db.session.query(User.id)]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(baseline, current):
+    print(
+        f"{'endpoint':<20} {'metric':<8} {'baseline':>10} {'current':>10} {'change':>8}"
+    )
+    for endpoint, result in current["results"].items():
+        before = baseline["results"].get(endpoint)
+        if not before:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "rps"):
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            print(f"{endpoint:<20} {metric:<8} {old:>10} {new:>10} {change:>+7.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000, help="users to seed")
+    parser.add_argument("--requests", type=int, default=500, help="per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--database-url", help="defaults to a temporary SQLite file")
+    parser.add_argument(
+        "--reset",
+        action="store_true",
+        help="recreate the users tables in a --database-url that has tables",
+    )
+    parser.add_argument("--endpoint", action="append", help="only run these")
+    parser.add_argument("--output", help="results file")
+    parser.add_argument("--compare", help="earlier results file to diff against")
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="keep rate limiting on; every client shares one IP, so most "
+        "auth and signup requests then come back 429",
+    )
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="users-benchmark-")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{workdir}/bench.db"
+    os.environ.setdefault("APP_SETTINGS", "project.config.ProductionConfig")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+
+    from project import create_app
+
+    app = create_app()
+    app.config["SLOW_REQUEST_THRESHOLD"] = None
+    app.config["RATELIMIT_ENABLED"] = args.rate_limits
+    user_ids = seed(app, args.users, args.reset)
+
+    server = make_server(
+        "127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    results = {}
+    try:
+        for endpoint, call in scenarios(base_url, user_ids).items():
+            if args.endpoint and endpoint not in args.endpoint:
+                continue
+            results[endpoint] = drive(call, args.requests, args.concurrency)
+            print(f"{endpoint:<20} {json.dumps(results[endpoint])}")
+    finally:
+        server.shutdown()
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "settings": {
+            "app_settings": os.environ["APP_SETTINGS"],
+            "database": app.config["SQLALCHEMY_DATABASE_URI"].split(":", 1)[0],
+            "users": args.users,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "bcrypt_log_rounds": app.config["BCRYPT_LOG_ROUNDS"],
+            "rate_limits": args.rate_limits,
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Micro-benchmark of the users list serialization paths.
+
+Compares restplus ``marshal`` + stdlib ``json`` (the old GET /users path)
+against ``project.serialization.Serializer`` on ORM instances and on row
+tuples, with whichever JSON encoder is installed::
+
+    python -m benchmarks.serialization --rows 1000 --repeat 50
+"""
+import argparse
+import datetime
+import json
+import os
+import tempfile
+import timeit
+
+from flask_restplus import marshal
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="users-benchmark-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{workdir}/bench.db"
+    os.environ.setdefault("APP_SETTINGS", "project.config.ProductionConfig")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+
+    from project import create_app, db, serialization
+    from project.api.users.models import User
+    from project.api.users.services import get_users_page
+    from project.api.users.views import user, user_serializer
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        db.session.execute(
+            User.__table__.insert().values(
+                [
+                    {
+                        "username": f"user{i}",
+                        "email": f"user{i}@example.com",
+                        "password": "x",
+                        "created_date": datetime.datetime(2020, 1, 1),
+                    }
+                    for i in range(args.rows)
+                ]
+            )
+        )
+        db.session.commit()
+        columns = user_serializer.columns
+
+        def old_path():
+            db.session.expunge_all()
+            users, _ = get_users_page(args.rows)
+            return json.dumps(marshal(users, user))
+
+        def orm_path():
+            db.session.expunge_all()
+            users, _ = get_users_page(args.rows)
+            return serialization.dumps(user_serializer.many(users))
+
+        def row_path():
+            users, _ = get_users_page(args.rows, columns=columns)
+            return serialization.dumps(user_serializer.many(users))
+
+        users, _ = get_users_page(args.rows)
+        cases = [
+            ("marshal only", lambda: marshal(users, user)),
+            ("Serializer only", lambda: user_serializer.many(users)),
+            ("query + marshal + json", old_path),
+            ("query + Serializer (ORM)", orm_path),
+            ("query + Serializer (rows)", row_path),
+        ]
+        encoder = "orjson" if serialization.orjson else "json"
+        print(f"{args.rows} rows, best of 5 x {args.repeat}, encoder: {encoder}")
+        for name, func in cases:
+            best = min(timeit.repeat(func, number=args.repeat, repeat=5))
+            print(f"{name:<28} {best / args.repeat * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Cold start timing of the users app.
+
+Each run is a fresh interpreter that imports ``project``, calls
+``create_app()`` and serves one ``/ping``, the work a worker does before its
+first response when the app is not preloaded::
+
+    python -m benchmarks.startup --runs 10 --target-ms 1000 --imports 15
+
+Exits non-zero when the median boot time exceeds ``--target-ms``.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+import project
+imported = time.perf_counter()
+app = project.create_app()
+created = time.perf_counter()
+app.test_client().get("/ping")
+served = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "create_app": created - imported,
+    "first_request": served - created,
+    "total": served - start,
+}))
+"""
+
+
+def run(env, importtime=False):
+    command = [sys.executable] + (["-X", "importtime"] if importtime else [])
+    result = subprocess.run(
+        command + ["-c", PROBE],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return json.loads(result.stdout), result.stderr
+
+
+def slowest_imports(stderr, count):
+    """Returns the ``count`` imports with the highest self time, in ms."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line.partition(":")[2].split("|")
+        imports.append((int(self_us) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--target-ms", type=float, default=None)
+    parser.add_argument("--imports", type=int, default=0, help="slowest imports")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="users-benchmark-")
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{workdir}/bench.db",
+        APP_SETTINGS=os.environ.get("APP_SETTINGS", "project.config.ProductionConfig"),
+        SECRET_KEY=os.environ.get("SECRET_KEY", "benchmark"),
+    )
+    # the first run warms the bytecode and OS file caches
+    run(env)
+    timings = [run(env)[0] for _ in range(args.runs)]
+    print(f"median of {args.runs} cold starts")
+    for phase in ("import", "create_app", "first_request", "total"):
+        ms = statistics.median(timing[phase] for timing in timings) * 1000
+        print(f"{phase:<14} {ms:8.1f} ms")
+
+    if args.imports:
+        print(f"\nslowest {args.imports} imports (self time)")
+        for ms, name in slowest_imports(run(env, importtime=True)[1], args.imports):
+            print(f"{ms:8.1f} ms  {name}")
+
+    total = statistics.median(timing["total"] for timing in timings) * 1000
+    if args.target_ms is not None and total > args.target_ms:
+        print(f"\nFAIL: {total:.0f} ms exceeds the {args.target_ms:.0f} ms target")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
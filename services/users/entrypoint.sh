@@ -2,10 +2,22 @@
 
 echo "Waiting for PostgreSQL..."
 
+# back off from 0.1s to 2s between attempts rather than spinning
+delay=0.1
 while ! nc -z $POSTGRES_HOST 5432; do
-    sleep 0.1
+    sleep $delay
+    delay=$(awk "BEGIN { d = $delay * 2; print (d > 2 ? 2 : d) }")
 done
 
 echo "...PostgreSQL started"
 
+# a command, such as "python manage.py worker", runs instead of the web server
+if [ $# -gt 0 ]; then
+    exec "$@"
+fi
+
+if [ "$SERVER" = "gunicorn" ]; then
+    exec gunicorn --config gunicorn.conf.py --reload "project:create_app()"
+fi
+
 python manage.py run -h 0.0.0.0
@@ -0,0 +1,106 @@
+# Gunicorn settings for the users service.
+#
+# GUNICORN_WORKER_CLASS picks the serving profile:
+#
+#   gthread (default)  CPU-count workers with GUNICORN_THREADS threads each.
+#                      A request waiting on Postgres only parks its own
+#                      thread, and bcrypt runs in the password pool, so a
+#                      worker keeps serving /ping, /auth/status and user
+#                      reads meanwhile. Needs nothing beyond the stdlib.
+#   gevent             CPU-count workers with GUNICORN_WORKER_CONNECTIONS
+#                      greenlets each. Requires the gevent and psycogreen
+#                      packages, which the image does not ship; without them
+#                      gunicorn warns and serves gthread instead. psycopg2 is
+#                      patched after fork so queries yield to the event loop
+#                      instead of blocking it.
+#   sync               2 * CPU + 1 single-request workers (the old default).
+#
+# GUNICORN_PRELOAD=1 builds the app once in the arbiter and forks workers
+# from it, so each worker boots in milliseconds and shares the imported code
+# copy-on-write. Pools inherited across the fork are disposed in each worker.
+# It is ignored for gevent, which must patch the stdlib before the app loads,
+# and does not combine with --reload. Each worker logs how long it took to
+# boot.
+#
+# With DATABASE_REPLICA_URLS set, a client's reads stay on the primary for a
+# while after its writes. Several workers have to share that through Redis
+# (DB_STICKY_URL): with the per-worker "memory" store, a login following a
+# registration could land on another worker, read a lagging replica and miss
+# the new user, so gunicorn refuses to start.
+#
+# With METRICS_DIR set, each worker saves its metrics there and /metrics sums
+# them; the directory is emptied when gunicorn starts.
+#
+# Every worker holds its own SQLAlchemy pool, so keep the pool size at or
+# above the threads (or expected concurrent DB greenlets) per worker and the
+# total, workers * pool size, under Postgres' max_connections.
+import glob
+import importlib.util
+import multiprocessing
+import os
+import sys
+import time
+
+cpus = multiprocessing.cpu_count()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+
+if worker_class == "gevent" and not all(
+    importlib.util.find_spec(name) for name in ("gevent", "psycogreen")
+):
+    # gunicorn's logging is not set up yet while this file loads
+    print(
+        "[gunicorn.conf] GUNICORN_WORKER_CLASS=gevent needs the gevent and "
+        "psycogreen packages; falling back to gthread",
+        file=sys.stderr,
+    )
+    worker_class = "gthread"
+
+if worker_class == "sync":
+    workers = int(os.environ.get("GUNICORN_WORKERS", 2 * cpus + 1))
+else:
+    workers = int(os.environ.get("GUNICORN_WORKERS", cpus))
+
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 200))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+preload_app = os.environ.get("GUNICORN_PRELOAD") == "1" and worker_class != "gevent"
+
+
+def on_starting(server):
+    # resolved as in project/config.py, which the arbiter does not import
+    replicas = os.environ.get("DATABASE_REPLICA_URLS", "").strip(",")
+    sticky = os.environ.get(
+        "DB_STICKY_BACKEND", "redis" if os.environ.get("DB_STICKY_URL") else "memory"
+    )
+    if replicas and sticky == "memory" and workers > 1:
+        raise RuntimeError(
+            "DATABASE_REPLICA_URLS needs DB_STICKY_URL (a Redis shared by the "
+            f"workers) to run {workers} workers; set it, or GUNICORN_WORKERS=1"
+        )
+    directory = os.environ.get("METRICS_DIR")
+    if directory:
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            os.remove(path)
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.monotonic()
+    if worker_class == "gevent":
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+    if preload_app:
+        from project import db
+
+        db.dispose_engines(server.app.wsgi())
+
+
+def post_worker_init(worker):
+    worker.log.info(
+        "Worker %s booted in %.0f ms",
+        worker.pid,
+        (time.monotonic() - worker.forked_at) * 1000,
+    )
@@ -1,24 +1,210 @@
+import datetime
+import os
+import signal
+import time
+from collections import Counter
+
+import click
+from flask import current_app
 from flask.cli import FlaskGroup
 
-from project import create_app, db
-from project.api.users.models import User
+from project import create_app, db, jobs, metrics, migrations
+from project.api.users import outbox
+from project.api.users.bulk import read_rows
+from project.api.users.passwords import calibrate
+from project.api.users.revocation import purge_expired
+from project.api.users.services import bulk_add_users, purge_deleted_users
+from project.api.users.signing import generate_private_key_pem, new_kid
 
-app = create_app()
 cli = FlaskGroup(create_app=create_app)
 
 
+def __getattr__(name):
+    # "manage:app" is built on first use: CLI commands get their app from
+    # FlaskGroup, and gunicorn calls project:create_app() itself
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def save_metrics():
+    """Lets /metrics include this process's counters, when METRICS_DIR is
+    shared with the web workers."""
+    config = current_app.config
+    if config["METRICS_DIR"]:
+        metrics.start_writer(config["METRICS_DIR"], config["METRICS_WRITE_INTERVAL"])
+
+
 @cli.command("recreate_db")
 def recreate_db():
     db.drop_all()
     db.create_all()
     db.session.commit()
+    migrations.stamp(db.engine)
+
+
+@cli.command("migrate_db")
+def migrate_db():
+    for version in migrations.upgrade(db.engine):
+        print(f"Applied {version}")
 
 
 @cli.command("seed_db")
 def seed_db():
-    db.session.add(User(username="testuser1", email="testuser1@example.com", password="password1"))
-    db.session.add(User(username="testuser2", email="testuser2@example.com", password="password2"))
-    db.session.commit()
+    rows = [
+        {"username": "testuser1", "email": "testuser1@example.com", "password": "password1"},
+        {"username": "testuser2", "email": "testuser2@example.com", "password": "password2"},
+    ]
+    for _ in bulk_add_users(rows, batch_size=len(rows)):
+        pass
+
+
+@cli.command("bulk_load")
+@click.argument("source", type=click.File("rb"))
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), default="csv")
+@click.option("--batch-size", type=int, default=None)
+def bulk_load(source, fmt, batch_size):
+    """Creates users from a CSV or NDJSON file ("-" reads stdin)."""
+    batch_size = batch_size or current_app.config["USERS_BULK_BATCH_SIZE"]
+    counts = Counter()
+    for result in bulk_add_users(read_rows(source, fmt), batch_size):
+        counts[result["status"]] += 1
+        if result["status"] != "created":
+            print(f"row {result['row']}: {result['status']}")
+    print(", ".join(f"{counts[status]} {status}" for status in ("created", "duplicate", "invalid")))
+
+
+@cli.command("purge_users")
+@click.option("--older-than", type=float, default=None, help="days since deletion")
+@click.option("--batch-size", type=int, default=None)
+@click.option("--pause", type=float, default=None, help="seconds between batches")
+def purge_users(older_than, batch_size, pause):
+    """Hard-deletes users deleted more than --older-than days ago.
+
+    Run it from cron; rows go in small batches so that no transaction holds
+    locks for long.
+    """
+    config = current_app.config
+    if older_than is None:
+        older_than = config["USERS_PURGE_AFTER_DAYS"]
+    batch_size = batch_size or config["USERS_PURGE_BATCH_SIZE"]
+    pause = config["USERS_PURGE_PAUSE"] if pause is None else pause
+    before = datetime.datetime.utcnow() - datetime.timedelta(days=older_than)
+    purged = 0
+    for removed in purge_deleted_users(before, batch_size):
+        purged += removed
+        time.sleep(pause)
+    print(f"Purged {purged} users")
+
+
+@cli.command("purge_revoked_tokens")
+def purge_revoked_tokens():
+    """Deletes revocations of tokens that have expired anyway.
+
+    "manage.py worker" does this every REVOCATION_PURGE_INTERVAL seconds;
+    run it by hand to purge right away.
+    """
+    print(f"Purged {purge_expired()} revoked tokens")
+
+
+@cli.command("worker")
+@click.option("--queues", default=None, help="comma-separated; all of JOBS_QUEUES by default")
+@click.option("--threads", type=int, default=None)
+def worker(queues, threads):
+    """Runs background jobs until interrupted.
+
+    Start one per host or container and add more to drain busy queues;
+    SIGTERM lets running jobs finish first.
+    """
+    config = current_app.config
+    queues = queues.split(",") if queues else list(config["JOBS_QUEUES"])
+    threads = threads or config["JOBS_WORKER_THREADS"]
+    pool = jobs.Worker(current_app._get_current_object(), queues, threads)
+    save_metrics()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    pool.start()
+    print(f"Worker {pool.id}: {threads} threads on {', '.join(queues)}")
+    try:
+        pool.wait()
+    except KeyboardInterrupt:
+        print("Stopping once running jobs finish")
+    pool.stop()
+
+
+@cli.command("relay_events")
+@click.option("--once", is_flag=True, help="relay what is pending, then exit")
+@click.option("--batch-size", type=int, default=None)
+def relay_events(once, batch_size):
+    """Publishes user change events to OUTBOX_SINK as they commit.
+
+    Run one relay; a second one waits on the first's batch rather than
+    publishing out of order, so it only takes over if the first stops.
+    """
+    config = current_app.config
+    batch_size = batch_size or config["OUTBOX_BATCH_SIZE"]
+    sink = outbox.sink()
+    save_metrics()
+    relayed = 0
+    while True:
+        count = outbox.relay_events(sink, batch_size)
+        relayed += count
+        if count < batch_size:
+            if once:
+                break
+            time.sleep(config["OUTBOX_POLL_INTERVAL"])
+    print(f"Relayed {relayed} events")
+
+
+@cli.command("prune_events")
+@click.option("--older-than", type=float, default=None, help="days since the change")
+def prune_events(older_than):
+    """Deletes published user change events older than --older-than days.
+
+    GET /users/changes answers 410 to consumers that fall further behind.
+    """
+    if older_than is None:
+        older_than = current_app.config["OUTBOX_RETENTION_DAYS"]
+    before = datetime.datetime.utcnow() - datetime.timedelta(days=older_than)
+    print(f"Pruned {outbox.prune_events(before)} events")
+
+
+@cli.command("generate_signing_key")
+@click.option("--activate-in", type=float, default=24, help="hours until it signs")
+def generate_signing_key(activate_in):
+    """Adds an RS256 key to JWT_KEYS_DIR that starts signing later.
+
+    Publish it for longer than downstream services cache the JWKS before it
+    activates; the key it replaces retires on its own once its tokens expire.
+    """
+    directory = current_app.config["JWT_KEYS_DIR"]
+    if not directory:
+        raise click.UsageError("Set JWT_KEYS_DIR first.")
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    kid = new_kid(now + datetime.timedelta(hours=activate_in))
+    path = os.path.join(directory, f"{kid}.pem")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(generate_private_key_pem())
+    print(f"Created {path}")
+
+
+@cli.command("calibrate_passwords")
+@click.option("--target-ms", type=float, default=250, help="time per hash to aim for")
+@click.option("--scheme", type=click.Choice(["bcrypt", "argon2"]), default=None)
+def calibrate_passwords(target_ms, scheme):
+    """Prints the hashing cost that takes --target-ms on this machine.
+
+    Each login and registration pays that time once, in the password pool.
+    """
+    config = current_app.config
+    scheme = scheme or config["PASSWORD_SCHEME"]
+    cost, ms = calibrate(
+        scheme, target_ms, config["ARGON2_MEMORY_COST"], config["ARGON2_PARALLELISM"]
+    )
+    setting = "BCRYPT_LOG_ROUNDS" if scheme == "bcrypt" else "ARGON2_TIME_COST"
+    print(f"PASSWORD_SCHEME={scheme} {setting}={cost}  ({ms:.0f} ms per hash)")
 
 
 if __name__ == "__main__":
@@ -1,16 +1,16 @@
 import os
 
 from flask import Flask
-from flask_admin import Admin
 from flask_bcrypt import Bcrypt
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
+
+from project import compression, instrumentation, ratelimit
+from project.database import SQLAlchemy
 
 # instantiate the extensions
 db = SQLAlchemy()
 cors = CORS()
 bcrypt = Bcrypt()
-admin = Admin(template_mode="bootstrap3")
 
 
 def create_app(script_info=None):
@@ -24,14 +24,31 @@ def create_app(script_info=None):
 
     # set up extensions
     db.init_app(app)
-    cors.init_app(app, resources={r"*": {"origins": "*"}})
+    # the client follows X-Next-Cursor to page through GET /users
+    cors.init_app(
+        app,
+        resources={r"*": {"origins": "*"}},
+        expose_headers=["X-Next-Cursor", "Link"],
+    )
     bcrypt.init_app(app)
-    if os.getenv("FLASK_ENV") == "development":
-        admin.init_app(app)
+    instrumentation.init_app(app)
+    ratelimit.init_app(app)
+    compression.init_app(app)
 
+    from project import health
     from project.api import api
 
+    # outbox registers the metrics it reads from user_events at scrape time
+    from project.api.users import outbox, signing  # noqa: F401
+
     api.init_app(app)
+    signing.init_app(app)
+    health.init_app(app)
+    if os.getenv("FLASK_ENV") == "development":
+        # flask_admin and wtforms are only imported where the admin is served
+        from project.api.users import admin
+
+        admin.init_app(app)
 
     # shell context for flask cli
     @app.shell_context_processor
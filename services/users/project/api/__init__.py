@@ -1,11 +1,27 @@
+from flask import current_app
 from flask_restplus import Api
 
 from project.api.auth import auth_namespace
 from project.api.ping import ping_namespace
+from project.api.users.passwords import HashingOverloaded
 from project.api.users.views import users_namespace
+from project.ratelimit import RateLimited
 
 api = Api(version="1.0", title="Users API", doc="/doc/")
 
+
+@api.errorhandler(HashingOverloaded)
+def handle_hashing_overloaded(error):
+    retry_after = current_app.config["PASSWORD_RETRY_AFTER"]
+    return {"message": error.description}, 503, {"Retry-After": str(retry_after)}
+
+
+@api.errorhandler(RateLimited)
+def handle_rate_limited(error):
+    # Retry-After and RateLimit-* are added by project.ratelimit.add_headers
+    return {"message": error.description}, 429
+
+
 api.add_namespace(ping_namespace, path="/ping")
 api.add_namespace(users_namespace, path="/users")
 api.add_namespace(auth_namespace, path="/auth")
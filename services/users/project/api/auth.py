@@ -1,18 +1,38 @@
+import time
+
 import jwt
 from flask import request
-from flask_bcrypt import check_password_hash
 from flask_restplus import Namespace, Resource, fields
 
+from project.api.users.cache import token_cache
 from project.api.users.models import User
-from project.api.users.services import add_user, get_user_by_email, get_user_by_id
+from project.api.users.passwords import check_password
+from project.api.users.revocation import revocations
+from project.api.users.services import (
+    add_user,
+    get_user_by_email,
+    get_user_by_id,
+    upgrade_password,
+)
+from project.ratelimit import limit
+from project.serialization import Serializer, json_response
+
+
+def login_email():
+    post_data = request.get_json(silent=True) or {}
+    email = post_data.get("email")
+    return email.lower() if isinstance(email, str) else None
 
-auth_namespace = Namespace("Auth")
+
+auth_namespace = Namespace("Auth", decorators=[limit("auth", "RATELIMIT_AUTH")])
 
 user = auth_namespace.model(
     "Auth User",
     {"username": fields.String(required=True), "email": fields.String(required=True)},
 )
 
+user_serializer = Serializer(user)
+
 full_user = auth_namespace.inherit(
     "Registration User", user, {"password": fields.String(required=True)}
 )
@@ -28,6 +48,10 @@ tokens = auth_namespace.inherit(
     "Access and Refresh Tokens", refresh, {"access_token": fields.String(required=True)}
 )
 
+logout = auth_namespace.model(
+    "Logout", {"refresh_token": fields.String(required=False)}
+)
+
 auth_parser = auth_namespace.parser()
 auth_parser.add_argument("Authorization", location="headers")
 
@@ -37,18 +61,17 @@ class Register(Resource):
     @auth_namespace.expect(full_user, validate=True)
     @auth_namespace.response(201, "Success")
     @auth_namespace.response(400, "Sorry. That email already exists.")
+    @auth_namespace.response(503, "Password service is overloaded.")
     def post(self):
         post_data = request.get_json()
         username = post_data.get("username")
         email = post_data.get("email")
         password = post_data.get("password")
 
-        user = get_user_by_email(email)
-        if user:
-            auth_namespace.abort(400, "Sorry. That email already exists.")
-
         # auth_namespace.abort(400, "Sorry. That username already exists.")
         user = add_user(username, email, password)
+        if not user:
+            auth_namespace.abort(400, "Sorry. That email already exists.")
         return user, 201
 
 
@@ -57,6 +80,9 @@ class Login(Resource):
     @auth_namespace.expect(login, validate=True)
     @auth_namespace.response(200, "Success")
     @auth_namespace.response(404, "User does not exist.")
+    @auth_namespace.response(429, "Too many requests.")
+    @auth_namespace.response(503, "Password service is overloaded.")
+    @limit("login", "RATELIMIT_LOGIN", key=login_email)
     def post(self):
         post_data = request.get_json()
         email = post_data.get("email")
@@ -64,8 +90,9 @@ class Login(Resource):
         response_object = {}
 
         user = get_user_by_email(email)
-        if not user or not check_password_hash(user.password, password):
+        if not user or not check_password(user.password, password):
             auth_namespace.abort(404, "User does not exist")
+        upgrade_password(user, password)
 
         access_token = user.encode_token(user.id, "access")
         refresh_token = user.encode_token(user.id, "refresh")
@@ -87,8 +114,10 @@ class Refresh(Resource):
         response_object = {}
 
         try:
-            resp = User.decode_token(refresh_token)
-            user = get_user_by_id(resp)
+            claims = User.decode_token_payload(refresh_token)
+            if revocations.is_revoked(claims):
+                auth_namespace.abort(401, "Token revoked. Please log in again.")
+            user = get_user_by_id(claims.get("sub"))
             if not user:
                 auth_namespace.abort(401, "Invalid token")
 
@@ -108,8 +137,7 @@ class Refresh(Resource):
 
 
 class Status(Resource):
-    @auth_namespace.marshal_with(user)
-    @auth_namespace.response(200, "Success")
+    @auth_namespace.response(200, "Success", user)
     @auth_namespace.response(401, "Invalid token")
     @auth_namespace.expect(auth_parser)
     def get(self):
@@ -117,11 +145,21 @@ class Status(Resource):
         if auth_header:
             try:
                 access_token = auth_header.split(" ")[1]
-                resp = User.decode_token(access_token)
-                user = get_user_by_id(resp)
-                if not user:
-                    auth_namespace.abort(401, "Invalid token")
-                return user, 200
+                cached = token_cache.get(access_token)
+                if cached is not None:
+                    claims, data = cached
+                else:
+                    claims = User.decode_token_payload(access_token)
+                if revocations.is_revoked(claims):
+                    auth_namespace.abort(401, "Token revoked. Please log in again.")
+                if cached is None:
+                    loaded_at = time.time()
+                    current_user = get_user_by_id(claims.get("sub"))
+                    if not current_user:
+                        auth_namespace.abort(401, "Invalid token")
+                    data = user_serializer(current_user)
+                    token_cache.set(access_token, claims, data, loaded_at)
+                return json_response(data)
             except jwt.ExpiredSignatureError:
                 auth_namespace.abort(401, "Signature expired. Please log in again.")
                 return "Signature expired. Please log in again."
@@ -131,7 +169,43 @@ class Status(Resource):
             auth_namespace.abort(403, "Token required")
 
 
+class Logout(Resource):
+    @auth_namespace.expect(auth_parser, logout)
+    @auth_namespace.response(200, "Successfully logged out.")
+    @auth_namespace.response(401, "Invalid token")
+    @auth_namespace.response(403, "Token required")
+    def post(self):
+        """Revokes the refresh token sent, and the access token if one is sent.
+
+        Either token may have expired: a client whose access token ran out
+        can still revoke its refresh token.
+        """
+        auth_header = request.headers.get("Authorization")
+        post_data = request.get_json(silent=True) or {}
+        refresh_token = post_data.get("refresh_token")
+        if not auth_header and not refresh_token:
+            auth_namespace.abort(403, "Token required")
+        try:
+            claims = [
+                User.decode_token_payload(token, verify_exp=False)
+                for token in (auth_header and auth_header.split(" ")[-1], refresh_token)
+                if token
+            ]
+        except jwt.InvalidTokenError:
+            auth_namespace.abort(401, "Invalid token. Please log in again.")
+        if len({token_claims.get("sub") for token_claims in claims}) > 1:
+            auth_namespace.abort(401, "Invalid token. Please log in again.")
+
+        now = time.time()
+        for token_claims in claims:
+            # an expired token is refused anyway
+            if token_claims.get("exp", now) > now:
+                revocations.revoke(token_claims)
+        return {"message": "Successfully logged out."}, 200
+
+
 auth_namespace.add_resource(Register, "/register")
 auth_namespace.add_resource(Login, "/login")
 auth_namespace.add_resource(Refresh, "/refresh")
 auth_namespace.add_resource(Status, "/status")
+auth_namespace.add_resource(Logout, "/logout")
@@ -1,17 +1,50 @@
-from flask import current_app
+import logging
+
+from flask import flash
+from flask_admin import Admin
+from flask_admin.babel import gettext
 from flask_admin.contrib.sqla import ModelView
 
-from project import bcrypt
+from project import db
+from project.api.users.models import User
+from project.api.users.passwords import hash_password
+from project.api.users.services import delete_user
+
+logger = logging.getLogger(__name__)
 
 
 class UsersAdminView(ModelView):
+    # ILIKE '%term%' searches are served by the pg_trgm indexes on both columns
     column_searchable_list = ("username", "email")
     column_editable_list = ("username", "email", "created_date")
-    column_filters = ("username", "email")
+    column_filters = ("username", "email", "active", "created_date", "deleted_at")
     column_sortable_list = ("username", "email", "active", "created_date")
     column_default_sort = ("created_date", True)
+    # skip the COUNT(*) over the whole table on every list page
+    simple_list_pager = True
 
     def on_change(self, form, model, is_created):
-        model.password = bcrypt.generate_password_hash(
-            model.password, current_app.config.get("BCRYPT_LOG_ROUNDS")
-        ).decode()
+        model.password = hash_password(model.password)
+
+    def delete_model(self, model):
+        # a soft delete, as DELETE /users/<id> does, so the caches are
+        # invalidated and "manage.py purge_users" removes the row later
+        try:
+            self.on_model_delete(model)
+            delete_user(model)
+        except Exception as ex:
+            if not self.handle_view_exception(ex):
+                flash(
+                    gettext("Failed to delete record. %(error)s", error=str(ex)),
+                    "error",
+                )
+                logger.exception("Failed to delete record.")
+            self.session.rollback()
+            return False
+        self.after_model_delete(model)
+        return True
+
+
+def init_app(app):
+    admin = Admin(app, template_mode="bootstrap3")
+    admin.add_view(UsersAdminView(User, db.session))
@@ -0,0 +1,41 @@
+import csv
+import io
+import json
+from collections import Counter
+
+FORMATS = {"text/csv": "csv", "application/x-ndjson": "ndjson"}
+
+
+def read_rows(stream, fmt):
+    """Lazily yields one dict per user record in a CSV or NDJSON byte stream.
+
+    CSV input needs a ``username,email,password`` header row. Lines that
+    are not valid JSON objects come through as ``None`` so the caller can
+    report them against their row number.
+    """
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    if fmt == "csv":
+        yield from csv.DictReader(text)
+    elif fmt == "ndjson":
+        for line in text:
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield row if isinstance(row, dict) else None
+    else:
+        raise ValueError(f"Unknown bulk format {fmt!r}")
+
+
+def summarize(results):
+    """Builds the ``POST /users/bulk`` report from ``bulk_add_users`` results."""
+    results = list(results)
+    counts = Counter(result["status"] for result in results)
+    return {
+        "created": counts["created"],
+        "duplicate": counts["duplicate"],
+        "invalid": counts["invalid"],
+        "results": results,
+    }
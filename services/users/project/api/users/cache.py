@@ -0,0 +1,123 @@
+import threading
+import time
+
+from flask import current_app
+
+from project import metrics
+from project.cache import LRUCache, create_backend
+
+token_cache_hits = metrics.Counter(
+    "token_cache_hits_total", "Authenticated calls served from the token cache."
+)
+token_cache_misses = metrics.Counter(
+    "token_cache_misses_total", "Authenticated calls that had to verify the token."
+)
+user_cache_hits = metrics.Counter(
+    "user_cache_hits_total", "User lookups by id answered from the cache."
+)
+user_cache_misses = metrics.Counter(
+    "user_cache_misses_total", "User lookups by id that went to the database."
+)
+
+
+class TokenCache:
+    """Verified access tokens and the serialized user they belong to.
+
+    Entries are keyed by the token signature and never outlive the token's
+    ``exp`` claim. Writes to a user bump its invalidation time, which makes
+    every entry cached before it stale. Invalidation is per process, so other
+    workers may serve a changed user for up to ``TOKEN_CACHE_TTL`` seconds.
+    """
+
+    def __init__(self):
+        self._entries = None
+        self._invalidated = {}
+        self._lock = threading.Lock()
+
+    def _cache(self):
+        size = current_app.config["TOKEN_CACHE_SIZE"]
+        if self._entries is None or self._entries.maxsize != size:
+            self._entries = LRUCache(size)
+        return self._entries
+
+    def get(self, token):
+        """Returns ``(claims, data)`` for a cached token, or None."""
+        if not current_app.config["TOKEN_CACHE_TTL"]:
+            return None
+        entry = self._cache().get(token.rsplit(".", 1)[-1])
+        if entry is not None:
+            cached_token, claims, cached_at, data = entry
+            invalidated = self._invalidated.get(claims["sub"], 0)
+            if cached_token == token and cached_at > invalidated:
+                token_cache_hits.inc()
+                return claims, data
+        token_cache_misses.inc()
+        return None
+
+    def set(self, token, claims, data, loaded_at):
+        """Caches ``data``, the user as read from the database at ``loaded_at``."""
+        ttl = current_app.config["TOKEN_CACHE_TTL"]
+        if not ttl:
+            return
+        expires_at = min(claims["exp"], time.time() + ttl)
+        entry = (token, claims, loaded_at, data)
+        self._cache().set(token.rsplit(".", 1)[-1], entry, expires_at)
+
+    def invalidate_user(self, user_id):
+        now = time.time()
+        horizon = now - current_app.config["TOKEN_CACHE_TTL"]
+        with self._lock:
+            # anything cached before the horizon has expired on its own
+            for stale in [k for k, v in self._invalidated.items() if v < horizon]:
+                del self._invalidated[stale]
+            self._invalidated[user_id] = now
+
+    def clear(self):
+        if self._entries is not None:
+            self._entries.clear()
+        self._invalidated.clear()
+
+
+token_cache = TokenCache()
+
+
+class UserCache:
+    """Read-through cache of users by id, holding their public columns.
+
+    A missing user is cached as an empty dict for ``USER_CACHE_NEGATIVE_TTL``
+    seconds so that repeated lookups of unknown ids stay off the database.
+    """
+
+    def _backend(self):
+        config = current_app.config
+        key = (
+            config["USER_CACHE_BACKEND"],
+            config["USER_CACHE_URL"],
+            config["USER_CACHE_SIZE"],
+        )
+        state = current_app.extensions.get("user_cache")
+        if state is None or state[0] != key:
+            state = (key, create_backend(*key, prefix="users:"))
+            current_app.extensions["user_cache"] = state
+        return state[1]
+
+    def get(self, user_id):
+        data = self._backend().get(str(user_id))
+        if data is None:
+            user_cache_misses.inc()
+        else:
+            user_cache_hits.inc()
+        return data
+
+    def set(self, user_id, data):
+        if data:
+            ttl = current_app.config["USER_CACHE_TTL"]
+        else:
+            ttl = current_app.config["USER_CACHE_NEGATIVE_TTL"]
+        self._backend().set(str(user_id), data, ttl)
+
+    def invalidate(self, user_id):
+        self._backend().delete(str(user_id))
+
+
+user_cache = UserCache()
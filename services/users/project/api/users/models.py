@@ -1,13 +1,23 @@
 import datetime
-import os
+import time
+import uuid
 
 import jwt
 from flask.globals import current_app
+from sqlalchemy import DDL, event
 from sqlalchemy.sql import func
-from sqlalchemy.sql.schema import Column
-from sqlalchemy.sql.sqltypes import Boolean, DateTime, Integer, String
+from sqlalchemy.sql.schema import Column, Index
+from sqlalchemy.sql.sqltypes import JSON, BigInteger, Boolean, DateTime, Integer, String
 
-from project import bcrypt, db
+from project import db
+from project.api.users.passwords import hash_password
+from project.api.users.signing import keyring
+from project.instrumentation import record_jwt
+
+
+def _where(condition):
+    """Index options making a partial index on every dialect that has them."""
+    return {"postgresql_where": condition, "sqlite_where": condition}
 
 
 class User(db.Model):
@@ -18,14 +28,46 @@ class User(db.Model):
     email = Column(String(128), nullable=False)
     password = Column(String(255), nullable=False)
     active = Column(Boolean(), default=True, nullable=False)
-    created_date = Column(DateTime, default=func.now(), nullable=False)
+    # set in Python rather than by the database: SQLite's CURRENT_TIMESTAMP
+    # has no fractional seconds, so it would not compare equal to the value
+    # a created_date keyset cursor reads back
+    created_date = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    # bumped by every ORM update; ETags for single users are built from it
+    version = Column(Integer, default=1, nullable=False)
+    # set by DELETE /users/<id>; "manage.py purge_users" removes the row later
+    deleted_at = Column(DateTime, nullable=True)
+
+    __mapper_args__ = {"version_id_col": version}
+
+    # API reads only see live users, so their indexes leave deleted rows out;
+    # the unique email index does too, which frees a deleted user's email
+    __table_args__ = (
+        Index(
+            "ix_users_live_email_lower",
+            func.lower(email),
+            unique=True,
+            **_where(deleted_at.is_(None)),
+        ),
+        Index("ix_users_live_id", id, **_where(deleted_at.is_(None))),
+        Index(
+            "ix_users_live_created_date_id",
+            created_date,
+            id,
+            **_where(deleted_at.is_(None)),
+        ),
+        Index(
+            "ix_users_live_username_id", username, id, **_where(deleted_at.is_(None))
+        ),
+        Index("ix_users_live_email_id", email, id, **_where(deleted_at.is_(None))),
+        Index("ix_users_deleted_at", deleted_at, **_where(deleted_at.isnot(None))),
+        # admin default sort, over deleted users too
+        Index("ix_users_created_date", created_date),
+    )
 
     def __init__(self, username="", email="", password=""):
         self.username = username
         self.email = email
-        self.password = bcrypt.generate_password_hash(
-            password, current_app.config["BCRYPT_LOG_ROUNDS"]
-        ).decode()
+        self.password = hash_password(password)
 
     def to_json(self):
         return {
@@ -41,25 +83,159 @@ class User(db.Model):
         else:
             seconds = current_app.config.get("REFRESH_TOKEN_EXPIRATION")
 
-        # expiration, issued at, subject
+        # expiration, issued at, subject, token id (for revocation)
         payload = {
             "exp": datetime.datetime.utcnow()
             + datetime.timedelta(days=0, seconds=seconds),
             "iat": datetime.datetime.utcnow(),
             "sub": user_id,
+            "jti": uuid.uuid4().hex,
         }
-        return jwt.encode(
-            payload, current_app.config.get("SECRET_KEY"), algorithm="HS256"
-        )
+        start = time.perf_counter()
+        if keyring.enabled():
+            key = keyring.signing_key()
+            token = jwt.encode(
+                payload, key.private_key, algorithm="RS256", headers={"kid": key.kid}
+            )
+        else:
+            token = jwt.encode(
+                payload, current_app.config.get("SECRET_KEY"), algorithm="HS256"
+            )
+        record_jwt("encode", time.perf_counter() - start)
+        return token
 
     @staticmethod
     def decode_token(token):
-        payload = jwt.decode(token, current_app.config.get("SECRET_KEY"))
-        return payload.get("sub")
+        return User.decode_token_payload(token).get("sub")
+
+    @staticmethod
+    def decode_token_payload(token, verify_exp=True):
+        start = time.perf_counter()
+        options = {"verify_exp": verify_exp}
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+            if kid is None:
+                # HS256, including tokens issued before RS256 was turned on
+                return jwt.decode(
+                    token,
+                    current_app.config.get("SECRET_KEY"),
+                    algorithms=["HS256"],
+                    options=options,
+                )
+            key = keyring.verification_key(kid) if keyring.enabled() else None
+            if key is None:
+                raise jwt.InvalidTokenError(f"Unknown signing key {kid}")
+            return jwt.decode(token, key, algorithms=["RS256"], options=options)
+        finally:
+            record_jwt("decode", time.perf_counter() - start)
+
+
+class RevokedToken(db.Model):
+    """Tokens logged out before their ``exp``; rows are pruned once expired."""
+
+    __tablename__ = "revoked_tokens"
+
+    jti = Column(String(64), primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    revoked_at = Column(DateTime, default=func.now(), nullable=False, index=True)
+
+
+class ChangeCounter(db.Model):
+    """Named counters kept next to the data they describe, such as how far
+    the user_events outbox has been pruned."""
+
+    __tablename__ = "change_counters"
+
+    name = Column(String(64), primary_key=True)
+    value = Column(BigInteger, default=0, nullable=False)
+
+    @staticmethod
+    def get(name):
+        return (
+            db.session.query(ChangeCounter.value)
+            .filter(ChangeCounter.name == name)
+            .scalar()
+        )
+
+    @staticmethod
+    def advance(connection, name, value):
+        """Raises the counter to ``value``; never lowers it."""
+        table = ChangeCounter.__table__
+        connection.execute(
+            table.update()
+            .where(table.c.name == name)
+            .where(table.c.value < value)
+            .values(value=value)
+        )
+
+
+event.listen(
+    ChangeCounter.__table__,
+    "after_create",
+    DDL("INSERT INTO change_counters (name, value) VALUES ('user_events_pruned', 0)"),
+)
+
+
+class UserEvent(db.Model):
+    """Outbox of user changes, written in the transaction that made them.
+
+    ``manage.py relay_events`` publishes them in ``seq`` order and
+    ``GET /users/changes`` serves them to consumers that poll. Events are
+    written just before commit under a lock held until the commit is done,
+    so they commit in ``seq`` order: a reader that has seen one never misses
+    a smaller one later. The newest ``seq`` doubles as the version of the
+    users collection.
+    """
+
+    __tablename__ = "user_events"
+
+    seq = Column(
+        BigInteger().with_variant(Integer, "sqlite"),
+        primary_key=True,
+        autoincrement=True,
+    )
+    user_id = Column(Integer, nullable=False)
+    # created, updated or deleted
+    type = Column(String(16), nullable=False)
+    # the user as of the change, without the password hash
+    data = Column(JSON, nullable=False)
+    # UTC, like the utcnow() cutoffs of the relay lag and prune_events
+    created_at = Column(
+        DateTime, default=datetime.datetime.utcnow, nullable=False, index=True
+    )
+    published_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_user_events_unpublished", seq, **_where(published_at.is_(None))),
+    )
+
+    def to_json(self):
+        return {
+            "seq": self.seq,
+            "type": self.type,
+            "user_id": self.user_id,
+            "user": self.data,
+            "created_at": self.created_at.isoformat(),
+        }
 
 
-if os.getenv("FLASK_ENV") == "development":
-    from project import admin
-    from project.api.users.admin import UsersAdminView
+# Search indexes only Postgres can build: text_pattern_ops for prefix matches
+# and trigrams for substring/ILIKE matches (GET /users?q=, the admin search).
+# Migration 0002 builds the same indexes concurrently on existing databases.
+SEARCH_INDEXES = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_prefix "
+    "ON users (lower(username) text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_email_prefix "
+    "ON users (lower(email) text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+    "ON users USING gin (username gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_email_trgm "
+    "ON users USING gin (email gin_trgm_ops)",
+)
 
-    admin.add_view(UsersAdminView(User, db.session))
+for statement in SEARCH_INDEXES:
+    event.listen(
+        User.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql")
+    )
@@ -0,0 +1,158 @@
+"""Relays user change events from the outbox table to a sink.
+
+Writes to users add a ``UserEvent`` in the same transaction (see
+``services._write_user_events``), so an event exists exactly when its change
+committed.
+``relay_events`` then publishes unpublished events oldest first, a batch per
+transaction, and marks them published once the sink has accepted them: a
+crash in between publishes the batch again, so consumers dedupe by ``seq``.
+
+Sinks take a list of event dicts. ``file`` appends NDJSON lines to a local
+file and ``memory`` puts them on an in-process queue, as stand-ins for a
+broker; ``redis`` adds them to a Redis stream.
+"""
+import datetime
+import os
+import queue
+
+from flask import current_app
+from sqlalchemy.sql import func
+
+from project import db, metrics
+from project.api.users.models import ChangeCounter, UserEvent
+from project.serialization import dumps
+
+published = metrics.Counter(
+    "outbox_events_published_total", "User change events relayed to the sink."
+)
+unpublished = metrics.Gauge(
+    "outbox_events_unpublished", "User change events waiting to be relayed."
+)
+relay_lag = metrics.Gauge(
+    "outbox_oldest_unpublished_seconds",
+    "Age of the oldest user change event waiting to be relayed.",
+)
+
+
+class FileSink:
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, events):
+        with open(self.path, "ab") as f:
+            f.write(b"".join(dumps(event) for event in events))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class MemorySink:
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def publish(self, events):
+        for event in events:
+            self.queue.put(event)
+
+
+class RedisSink:
+    def __init__(self, client, stream):
+        self.client = client
+        self.stream = stream
+
+    @classmethod
+    def from_url(cls, url, stream="user_events"):
+        import redis
+
+        return cls(redis.Redis.from_url(url), stream)
+
+    def publish(self, events):
+        pipe = self.client.pipeline()
+        for event in events:
+            pipe.xadd(self.stream, {"seq": event["seq"], "event": dumps(event)})
+        pipe.execute()
+
+
+def create_sink(kind, url=None):
+    if kind == "file":
+        return FileSink(url)
+    if kind == "memory":
+        return MemorySink()
+    if kind == "redis":
+        return RedisSink.from_url(url)
+    raise ValueError(f"Unknown outbox sink {kind!r}")
+
+
+def sink():
+    config = current_app.config
+    key = (config["OUTBOX_SINK"], config["OUTBOX_URL"])
+    cached = current_app.extensions.get("outbox")
+    if cached is None or cached[0] != key:
+        cached = current_app.extensions["outbox"] = (key, create_sink(*key))
+    return cached[1]
+
+
+def relay_events(target, batch_size):
+    """Publishes the oldest ``batch_size`` unpublished events to ``target``
+    and returns how many there were.
+
+    The rows stay locked until they are marked published, so a second relay
+    waits for the first instead of publishing the same events out of order.
+    """
+    events = (
+        UserEvent.query.filter(UserEvent.published_at.is_(None))
+        .order_by(UserEvent.seq)
+        .limit(batch_size)
+        .with_for_update()
+        .all()
+    )
+    if not events:
+        db.session.commit()
+        return 0
+    target.publish([event.to_json() for event in events])
+    UserEvent.query.filter(UserEvent.seq.in_([event.seq for event in events])).update(
+        {"published_at": datetime.datetime.utcnow()}, synchronize_session=False
+    )
+    db.session.commit()
+    published.inc(len(events))
+    return len(events)
+
+
+@metrics.collector
+@db.use_replica()
+def _collect_backlog_metrics():
+    # Read by the web service from the table, since the relay serves no
+    # /metrics of its own; both run over the unpublished partial index.
+    count, oldest = (
+        db.session.query(func.count(UserEvent.seq), func.min(UserEvent.created_at))
+        .filter(UserEvent.published_at.is_(None))
+        .one()
+    )
+    unpublished.set(count)
+    age = (datetime.datetime.utcnow() - oldest).total_seconds() if oldest else 0
+    relay_lag.set(max(age, 0))
+
+
+def prune_events(before):
+    """Deletes published events created before ``before`` and returns how
+    many; ``GET /users/changes`` answers 410 for a ``since`` behind them."""
+    last = (
+        db.session.query(db.func.max(UserEvent.seq))
+        .filter(UserEvent.created_at < before, UserEvent.published_at.isnot(None))
+        .scalar()
+    )
+    if last is None:
+        return 0
+    # only a prefix goes, so unpublished events are never lost
+    unpublished = (
+        db.session.query(db.func.min(UserEvent.seq))
+        .filter(UserEvent.published_at.is_(None))
+        .scalar()
+    )
+    if unpublished is not None:
+        last = min(last, unpublished - 1)
+    ChangeCounter.advance(db.session.connection(), "user_events_pruned", last)
+    deleted = UserEvent.query.filter(UserEvent.seq <= last).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+    return deleted
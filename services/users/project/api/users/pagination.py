@@ -0,0 +1,24 @@
+import base64
+import binascii
+import json
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    """Packs the keyset values of the last row on a page into an opaque token."""
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor):
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, ValueError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or not values:
+        raise InvalidCursor(cursor)
+    return values
@@ -0,0 +1,323 @@
+"""Password hashing off the request thread.
+
+Hashes follow the policy in config: bcrypt at ``BCRYPT_LOG_ROUNDS``, or
+argon2id at ``ARGON2_*`` costs with ``PASSWORD_SCHEME = "argon2"`` (needs the
+optional ``argon2-cffi`` package). Hashes made under an older policy still
+verify; a successful login rehashes them in the background, so raising the
+cost or switching scheme migrates users as they sign in. ``manage.py
+calibrate_passwords`` picks a cost for the hardware at hand.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import bcrypt as _bcrypt
+from flask import current_app, g
+from werkzeug.exceptions import ServiceUnavailable
+
+from project import metrics
+
+queue_wait = metrics.Histogram(
+    "password_queue_wait_seconds",
+    "Time password jobs spent waiting for a free hashing worker.",
+)
+hash_time = metrics.Histogram(
+    "password_hash_seconds", "Time spent hashing or verifying a password."
+)
+rejected = metrics.Counter(
+    "password_jobs_rejected_total",
+    "Password jobs refused because the hashing queue was full.",
+)
+rehashes = metrics.Counter(
+    "password_rehashes_total",
+    "Background rehashes of outdated password hashes by outcome: upgraded, "
+    "stale (the password changed meanwhile) or skipped (queue full).",
+    labelnames=("result",),
+)
+
+
+class HashingOverloaded(ServiceUnavailable):
+    """Raised when the password hashing queue is full."""
+
+    description = "Password service is overloaded. Please retry."
+
+
+def _policy():
+    """Returns the current hashing policy as a picklable tuple."""
+    config = current_app.config
+    if config["PASSWORD_SCHEME"] == "argon2":
+        return (
+            "argon2",
+            config["ARGON2_TIME_COST"],
+            config["ARGON2_MEMORY_COST"],
+            config["ARGON2_PARALLELISM"],
+        )
+    return ("bcrypt", config["BCRYPT_LOG_ROUNDS"])
+
+
+def _argon2(policy=("argon2",)):
+    from argon2 import PasswordHasher, Type
+
+    if len(policy) == 1:
+        return PasswordHasher(type=Type.ID)
+    _, time_cost, memory_cost, parallelism = policy
+    return PasswordHasher(time_cost, memory_cost, parallelism, type=Type.ID)
+
+
+def _hash_one(password, policy):
+    if policy[0] == "argon2":
+        return _argon2(policy).hash(password)
+    return _bcrypt.hashpw(password, _bcrypt.gensalt(policy[1])).decode()
+
+
+def _hash(passwords, policy):
+    # timestamps use the system-wide monotonic clock, so they compare across
+    # the pool's processes
+    start = time.monotonic()
+    hashed = [_hash_one(password, policy) for password in passwords]
+    return hashed, start, time.monotonic()
+
+
+def _check(hashed, password):
+    start = time.monotonic()
+    if hashed.startswith(b"$argon2"):
+        from argon2.exceptions import InvalidHash, VerificationError
+
+        try:
+            ok = _argon2().verify(hashed, password)
+        except (InvalidHash, VerificationError):
+            # a wrong password, or a malformed hash no password matches
+            ok = False
+    else:
+        try:
+            ok = _bcrypt.checkpw(password, hashed)
+        except ValueError:
+            # a malformed hash
+            ok = False
+    return ok, start, time.monotonic()
+
+
+_mp_context = multiprocessing.get_context("forkserver")
+
+
+class _PoolState:
+    def __init__(self, size, depth):
+        self.key = (os.getpid(), size, depth)
+        # forked from a process already running threads, a child can inherit
+        # a lock some other thread held; forkserver children start clean
+        self.executor = (
+            ProcessPoolExecutor(size, mp_context=_mp_context) if size else None
+        )
+        self.slots = threading.BoundedSemaphore(depth) if depth else None
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def _pool():
+    # Built lazily and per pid: a pool inherited across a gunicorn fork has no
+    # live worker processes in the child.
+    global _state
+    size = current_app.config["PASSWORD_POOL_SIZE"]
+    depth = current_app.config["PASSWORD_QUEUE_DEPTH"]
+    with _state_lock:
+        if _state is None or _state.key != (os.getpid(), size, depth):
+            if _state is not None and _state.executor is not None:
+                _state.executor.shutdown()
+            _state = _PoolState(size, depth)
+        return _state
+
+
+def queue_depth():
+    """Returns ``(in_flight, capacity)`` for this process's hashing queue."""
+    state = _state
+    if state is None:
+        return 0, 0
+    return state.in_flight, state.key[2]
+
+
+def _acquire(state):
+    if state.slots is not None and not state.slots.acquire(
+        timeout=current_app.config["PASSWORD_QUEUE_TIMEOUT"]
+    ):
+        rejected.inc()
+        raise HashingOverloaded()
+    with state.lock:
+        state.in_flight += 1
+
+
+def _release(state):
+    with state.lock:
+        state.in_flight -= 1
+    if state.slots is not None:
+        state.slots.release()
+
+
+def _submit(state, fn, args):
+    """Takes a queue slot and starts ``fn(*args)``, returning its future."""
+    _acquire(state)
+    submitted = time.monotonic()
+    try:
+        if state.executor is None:
+            future = Future()
+            future.set_result(fn(*args))
+        else:
+            future = state.executor.submit(fn, *args)
+    except BaseException:
+        _release(state)
+        raise
+    return future, submitted
+
+
+def _run(jobs):
+    """Runs ``(fn, args)`` jobs in the pool, each holding a queue slot.
+
+    A batch keeps at most one job per pool process submitted at a time, so
+    a login checked meanwhile waits behind one hash per process, not the
+    whole batch.
+    """
+    state = _pool()
+    window = max(current_app.config["PASSWORD_POOL_SIZE"], 1)
+    pending = deque()
+    results = []
+    try:
+        for fn, args in jobs:
+            if len(pending) >= window:
+                results.append(_result(state, *pending.popleft()))
+            pending.append(_submit(state, fn, args))
+        while pending:
+            results.append(_result(state, *pending.popleft()))
+    finally:
+        # on an error, hand back the slots of jobs still queued or running
+        for future, _ in pending:
+            future.cancel()
+            future.add_done_callback(lambda _: _release(state))
+    return results
+
+
+def _result(state, future, submitted):
+    try:
+        result, start, end = future.result()
+    finally:
+        _release(state)
+    queue_wait.observe(start - submitted)
+    hash_time.observe(end - start)
+    g.password_queue_wait = g.get("password_queue_wait", 0.0) + start - submitted
+    g.password_hash_time = g.get("password_hash_time", 0.0) + end - start
+    return result
+
+
+def hash_password(password):
+    (hashed,) = hash_passwords([password])
+    return hashed
+
+
+def hash_passwords(passwords):
+    """Hashes a batch of passwords, one pool job and queue slot per password."""
+    policy = _policy()
+    jobs = [(_hash, ([password.encode()], policy)) for password in passwords]
+    return [hashed for (hashed,) in _run(jobs)]
+
+
+def check_password(hashed, password):
+    (ok,) = _run([(_check, (hashed.encode(), password.encode()))])
+    return ok
+
+
+def needs_rehash(hashed):
+    """True if ``hashed`` was made under a scheme or cost other than the current."""
+    policy = _policy()
+    if policy[0] == "argon2":
+        return not hashed.startswith("$argon2") or (
+            _argon2(policy).check_needs_rehash(hashed)
+        )
+    if hashed.startswith("$argon2"):
+        return True
+    # $2b$<rounds>$<salt and hash>
+    return int(hashed.split("$")[2]) != policy[1]
+
+
+class _Rehasher:
+    def __init__(self):
+        self.pid = os.getpid()
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = 0
+        self.lock = threading.Lock()
+
+
+_rehasher = None
+
+
+def rehash_later(password, store):
+    """Hashes ``password`` under the current policy on a background thread.
+
+    ``store(hashed)`` runs in an app context on that thread and returns True
+    if it saved the new hash. Returns the future, or None if too many
+    rehashes are already waiting; the hash then upgrades on a later login.
+    """
+    global _rehasher
+    app = current_app._get_current_object()
+    depth = app.config["PASSWORD_QUEUE_DEPTH"]
+    with _state_lock:
+        if _rehasher is None or _rehasher.pid != os.getpid():
+            _rehasher = _Rehasher()
+        rehasher = _rehasher
+    with rehasher.lock:
+        if depth and rehasher.pending >= depth:
+            rehashes.labels("skipped").inc()
+            return None
+        rehasher.pending += 1
+
+    def run():
+        try:
+            with app.app_context():
+                try:
+                    hashed = hash_password(password)
+                except HashingOverloaded:
+                    rehashes.labels("skipped").inc()
+                    return False
+                stored = store(hashed)
+                rehashes.labels("upgraded" if stored else "stale").inc()
+                return stored
+        except Exception:
+            app.logger.exception("Password rehash failed")
+            raise
+        finally:
+            with rehasher.lock:
+                rehasher.pending -= 1
+
+    return rehasher.executor.submit(run)
+
+
+def calibrate(scheme, target_ms, memory_cost=None, parallelism=None):
+    """Returns ``(cost, ms)``: the cheapest cost taking ``target_ms`` per hash.
+
+    The cost is bcrypt's log rounds, or argon2's time cost at the given
+    memory cost (KiB) and parallelism. Timings are taken on this thread, so
+    run it on the hardware that will serve logins, with nothing else busy.
+    """
+    if scheme == "bcrypt":
+        policies = (("bcrypt", cost) for cost in range(4, 32))
+    elif scheme == "argon2":
+        policies = (
+            ("argon2", cost, memory_cost, parallelism) for cost in range(1, 100)
+        )
+    else:
+        raise ValueError(f"Unknown password scheme {scheme!r}")
+    for policy in policies:
+        # best of three, so a stray pause does not pick too low a cost
+        ms = min(_time_hash(policy) for _ in range(3)) * 1000
+        if ms >= target_ms:
+            break
+    return policy[1], ms
+
+
+def _time_hash(policy):
+    _, start, end = _hash([b"calibration password"], policy)
+    return end - start
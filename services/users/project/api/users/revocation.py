@@ -0,0 +1,141 @@
+import datetime
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from project import db, metrics
+from project.api.users.models import RevokedToken
+from project.bloom import BloomFilter
+
+revocation_checks = metrics.Counter(
+    "token_revocation_checks_total",
+    "Revocation checks by outcome: clear (bloom miss, no query), "
+    "false_positive or revoked.",
+    labelnames=("result",),
+)
+
+# re-read rows revoked this long before the newest one already seen, to pick
+# up transactions that committed out of order
+SYNC_OVERLAP = datetime.timedelta(seconds=60)
+
+
+def purge_expired(before=None):
+    """Deletes revocations of tokens that expired before ``before`` (now by
+    default), which no longer need checking, and returns how many there
+    were."""
+    before = before or datetime.datetime.utcnow()
+    purged = RevokedToken.query.filter(RevokedToken.expires_at < before).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+    return purged
+
+
+class RevocationList:
+    """Per-process bloom filter over the ``jti`` of every revoked token.
+
+    A token that misses the filter is not revoked, which answers the common
+    case without a query; a hit is confirmed against ``revoked_tokens``. The
+    filter picks up other workers' revocations every
+    ``REVOCATION_SYNC_INTERVAL`` seconds, and every
+    ``REVOCATION_REBUILD_INTERVAL`` seconds it is rebuilt from the unexpired
+    rows. A periodic job run by ``manage.py worker`` deletes the expired ones.
+    """
+
+    def __init__(self):
+        self._bloom = None
+        self._seen_until = None
+        self._synced_at = 0.0
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+
+    def _rebuild(self, now):
+        # built aside and swapped in whole: is_revoked in other threads keeps
+        # the old filter until the new one holds every revocation
+        config = current_app.config
+        utcnow = datetime.datetime.utcnow()
+        live = RevokedToken.query.filter(RevokedToken.expires_at >= utcnow).count()
+        bloom = BloomFilter(
+            max(config["REVOCATION_BLOOM_CAPACITY"], live * 2),
+            config["REVOCATION_BLOOM_ERROR_RATE"],
+        )
+        seen_until = self._load(bloom, None, utcnow)
+        self._bloom, self._seen_until = bloom, seen_until
+        self._built_at = now
+
+    def _load(self, bloom, seen_until, utcnow):
+        """Adds revocations from ``seen_until`` on to ``bloom`` and returns
+        the newest ``revoked_at`` seen."""
+        query = db.session.query(RevokedToken.jti, RevokedToken.revoked_at).filter(
+            RevokedToken.expires_at >= utcnow
+        )
+        if seen_until is not None:
+            query = query.filter(RevokedToken.revoked_at >= seen_until - SYNC_OVERLAP)
+        for jti, revoked_at in query:
+            bloom.add(jti)
+            if seen_until is None or revoked_at > seen_until:
+                seen_until = revoked_at
+        return seen_until
+
+    def _sync(self):
+        config = current_app.config
+        now = time.monotonic()
+        bloom = self._bloom
+        if bloom is not None and (
+            now - self._synced_at < config["REVOCATION_SYNC_INTERVAL"]
+        ):
+            return bloom
+        with self._lock:
+            if (
+                self._bloom is None
+                or self._bloom.count > self._bloom.capacity
+                or now - self._built_at >= config["REVOCATION_REBUILD_INTERVAL"]
+            ):
+                self._rebuild(now)
+            else:
+                self._seen_until = self._load(
+                    self._bloom, self._seen_until, datetime.datetime.utcnow()
+                )
+            self._synced_at = now
+        return self._bloom
+
+    def is_revoked(self, claims):
+        jti = claims.get("jti")
+        if not jti:
+            # issued before tokens carried an id
+            return False
+        if jti not in self._sync():
+            revocation_checks.labels("clear").inc()
+            return False
+        if db.session.query(RevokedToken.jti).filter_by(jti=jti).first() is None:
+            revocation_checks.labels("false_positive").inc()
+            return False
+        revocation_checks.labels("revoked").inc()
+        return True
+
+    def revoke(self, claims):
+        """Revokes the token the ``claims`` were decoded from."""
+        jti = claims.get("jti")
+        if not jti:
+            return
+        db.session.add(
+            RevokedToken(
+                jti=jti,
+                user_id=claims["sub"],
+                expires_at=datetime.datetime.utcfromtimestamp(claims["exp"]),
+            )
+        )
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # already revoked
+            db.session.rollback()
+        self._sync().add(jti)
+
+    def clear(self):
+        self._bloom = None
+
+
+revocations = RevocationList()
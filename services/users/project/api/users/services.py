@@ -1,34 +1,467 @@
+import datetime
+
+from flask import current_app
+from sqlalchemy import Integer, bindparam, event, inspect, text
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.sql import any_, func, or_, tuple_
+from werkzeug.exceptions import Conflict
+
 from project import db
-from project.api.users.models import User
+from project.api.users.cache import token_cache, user_cache
+from project.api.users.models import ChangeCounter, User, UserEvent
+from project.api.users.passwords import hash_passwords, needs_rehash, rehash_later
+
+
+class UserChanged(Conflict):
+    """Raised when a user was changed by someone else since it was read."""
+
+    description = "The user was changed by another request. Please retry."
+
+
+# columns kept in the user cache; the password hash never leaves the database
+CACHED_COLUMNS = ("id", "username", "email", "active", "version")
+
+# API reads only ever see users that have not been deleted; the partial
+# indexes on users share this condition
+LIVE = User.deleted_at.is_(None)
+
+# columns GET /users can sort by, each backed by an index ending in id
+SORT_COLUMNS = {
+    "id": User.id,
+    "username": User.username,
+    "email": User.email,
+    "created_date": User.created_date,
+}
 
 
+def _to_cache(user):
+    data = {column: getattr(user, column) for column in CACHED_COLUMNS}
+    data["created_date"] = user.created_date.isoformat()
+    return data
+
+
+def _from_cache(data):
+    # Rebuild a persistent instance without a SELECT; columns that are not
+    # cached (the password) load lazily if something reads them.
+    user = User.__mapper__.class_manager.new_instance()
+    for column in CACHED_COLUMNS:
+        setattr(user, column, data[column])
+    user.created_date = datetime.datetime.fromisoformat(data["created_date"])
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+@db.use_replica()
 def get_all_users():
-    return User.query.all()
+    return User.query.filter(LIVE).order_by(User.id).all()
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def filter_users(
+    query,
+    active=None,
+    created_after=None,
+    created_before=None,
+    search=None,
+    match="prefix",
+):
+    """Narrows a user query; ``search`` matches the start of the username or
+    email, or anywhere in them with ``match="contains"``, ignoring case.
+    Deleted users are always left out."""
+    query = query.filter(LIVE)
+    if active is not None:
+        query = query.filter(User.active == active)
+    if created_after is not None:
+        query = query.filter(User.created_date >= created_after)
+    if created_before is not None:
+        query = query.filter(User.created_date < created_before)
+    if search:
+        term = _escape_like(search.lower())
+        if match == "contains":
+            # served by the pg_trgm indexes, which also back the admin search
+            query = query.filter(
+                or_(
+                    User.username.ilike(f"%{term}%", escape="\\"),
+                    User.email.ilike(f"%{term}%", escape="\\"),
+                )
+            )
+        else:
+            # served by the lower(...) text_pattern_ops indexes
+            query = query.filter(
+                or_(
+                    func.lower(User.username).like(f"{term}%", escape="\\"),
+                    func.lower(User.email).like(f"{term}%", escape="\\"),
+                )
+            )
+    return query
+
+
+def _select(columns):
+    # Column tuples skip building (and identity-mapping) ORM instances.
+    if columns:
+        return db.session.query(*(getattr(User, column) for column in columns))
+    return User.query
+
+
+@db.use_replica()
+def get_users_page(
+    limit, after=None, sort="id", descending=False, columns=None, **filters
+):
+    """Returns up to ``limit`` users ordered by ``sort`` then id, and whether
+    any rows follow the page.
+
+    ``after`` holds the keyset of the last row on the previous page:
+    ``[id]`` when sorting by id, ``[value, id]`` otherwise. With ``columns``
+    the page holds row tuples of just those columns, which must include id
+    and the sort column.
+    """
+    column = SORT_COLUMNS[sort]
+    keys = [User.id] if sort == "id" else [column, User.id]
+    query = filter_users(_select(columns), **filters)
+    if after is not None:
+        position = tuple_(*keys) if len(keys) > 1 else keys[0]
+        values = tuple_(*after) if len(keys) > 1 else after[0]
+        query = query.filter(position < values if descending else position > values)
+    query = query.order_by(*(key.desc() if descending else key for key in keys))
+    users = query.limit(limit + 1).all()
+    return users[:limit], len(users) > limit
+
+
+def iter_all_users(batch_size, columns=None, **filters):
+    """Yields every matching user from a server-side cursor, ``batch_size``
+    rows at a time; ``columns`` works as for ``get_users_page``."""
+    query = filter_users(_select(columns), **filters).order_by(User.id)
+    query = query.execution_options(stream_results=True)
+    return query.yield_per(batch_size)
+
+
+@db.use_replica()
+def get_users_version():
+    """Returns the newest user event's seq, which every write to users moves
+    on; once every event has been pruned, the seq pruned up to."""
+    head = db.session.query(func.max(UserEvent.seq)).scalar()
+    return head if head is not None else ChangeCounter.get("user_events_pruned")
 
 
 def get_user_by_id(user_id):
-    return User.query.filter_by(id=user_id).first()
+    """Loads a live user through the user cache. Misses read the primary: a
+    lagging replica could refill an entry just invalidated by a write with
+    the old row, to be served for the whole ``USER_CACHE_TTL``."""
+    data = user_cache.get(user_id)
+    if data == {}:
+        return None
+    # entries written before a column was cached are treated as misses
+    if data and all(column in data for column in CACHED_COLUMNS):
+        return _from_cache(data)
+    user = User.query.filter(User.id == user_id, LIVE).first()
+    user_cache.set(user_id, _to_cache(user) if user else {})
+    return user
 
 
+def get_user_for_update(user_id):
+    """Loads a live user from the primary, bypassing the user cache, whose
+    entry may carry a ``version`` other workers have since moved past."""
+    return User.query.filter(User.id == user_id, LIVE).first()
+
+
+def _id_in(ids):
+    # Postgres gets a single array parameter, WHERE id = ANY(%(ids)s), so the
+    # statement is the same however many ids are asked for
+    if db.engine.dialect.name == "postgresql":
+        return User.id == any_(bindparam("ids", ids, type_=ARRAY(Integer)))
+    return User.id.in_(ids)
+
+
+@db.use_replica()
+def get_users_by_ids(ids, columns=None):
+    """Returns ``(users, missing)`` for ``ids`` in one query.
+
+    Both lists follow the order of ``ids``, with repeats dropped; ``columns``
+    works as for ``get_users_page`` and must include id.
+    """
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return [], []
+    query = _select(columns).filter(_id_in(ids), LIVE)
+    found = {row.id: row for row in query}
+    users = [found[user_id] for user_id in ids if user_id in found]
+    missing = [user_id for user_id in ids if user_id not in found]
+    return users, missing
+
+
+@db.use_replica()
 def get_user_by_email(email):
-    return User.query.filter_by(email=email).first()
+    return User.query.filter(func.lower(User.email) == email.lower(), LIVE).first()
+
+
+@db.use_replica()
+def get_user_changes(since, limit):
+    """Returns up to ``limit`` events after seq ``since``, oldest first, and
+    whether more follow."""
+    events = (
+        UserEvent.query.filter(UserEvent.seq > since)
+        .order_by(UserEvent.seq)
+        .limit(limit + 1)
+        .all()
+    )
+    return events[:limit], len(events) > limit
+
+
+@db.use_replica()
+def get_changes_bounds():
+    """Returns ``(pruned, head)``: events up to seq ``pruned`` have been
+    deleted, and ``head`` is the newest seq."""
+    head = db.session.query(func.max(UserEvent.seq)).scalar()
+    return ChangeCounter.get("user_events_pruned") or 0, head or 0
+
+
+# Taken by each writing transaction just before it writes its events and held
+# until it commits. Only that last step is serialized, not the whole write.
+EVENTS_LOCK = text("SELECT pg_advisory_xact_lock(hashtext('user_events'))")
+
+
+def _pending_events(session):
+    return session.info.setdefault("user_events", {})
+
+
+def _note_event(pending, user, type):
+    # one event per user per transaction; a user created and then edited in
+    # the same transaction is still "created", a deletion always wins
+    if pending.get(user) != "created" or type == "deleted":
+        pending[user] = type
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_user_events(session, flush_context):
+    """Notes the users each flush wrote, whoever wrote them: these functions
+    and the admin alike. Core statements (bulk_add_users) note their own."""
+    pending = _pending_events(session)
+    for obj in session.new:
+        if isinstance(obj, User):
+            _note_event(pending, obj, "created")
+    for obj in session.dirty:
+        if isinstance(obj, User) and session.is_modified(obj):
+            history = inspect(obj).attrs.deleted_at.history
+            deleted = history.has_changes() and obj.deleted_at is not None
+            _note_event(pending, obj, "deleted" if deleted else "updated")
+
+
+@event.listens_for(Session, "before_commit")
+def _write_user_events(session):
+    # Flushed first, so the events carry the users as they commit. On SQLite
+    # the database lock already orders writing transactions.
+    session.flush()
+    pending = session.info.pop("user_events", None)
+    if pending:
+        connection = session.connection()
+        if connection.dialect.name == "postgresql":
+            connection.execute(EVENTS_LOCK)
+        connection.execute(
+            UserEvent.__table__.insert(),
+            [
+                {"user_id": user.id, "type": type, "data": _to_cache(user)}
+                for user, type in pending.items()
+            ],
+        )
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _forget_user_events(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("user_events", None)
+
+
+def upgrade_password(user, password):
+    """Rehashes a just-verified ``password`` if the stored hash is outdated.
+
+    Runs in the background and returns the future, or None when there is
+    nothing to do. The new hash only replaces the one that was verified, so a
+    password change in the meantime wins.
+    """
+    if not current_app.config["PASSWORD_REHASH"] or not needs_rehash(user.password):
+        return None
+    user_id, verified = user.id, user.password
+
+    def store(hashed):
+        updated = User.query.filter_by(id=user_id, password=verified).update(
+            {"password": hashed}, synchronize_session=False
+        )
+        db.session.commit()
+        return bool(updated)
+
+    return rehash_later(password, store)
 
 
 def add_user(username, email, password):
+    """Creates a user, or returns None if the email is already registered."""
     user = User(username=username, email=email, password=password)
     db.session.add(user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    user_cache.invalidate(user.id)
     return user
 
 
 def update_user(user, username, email):
+    """Updates a user, or returns None if the new email belongs to someone else.
+
+    Raises ``UserChanged`` if the row no longer has the ``version`` ``user``
+    was read at.
+    """
+    user_id = user.id
     user.username = username
     user.email = email
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    except StaleDataError:
+        db.session.rollback()
+        user_cache.invalidate(user_id)
+        raise UserChanged()
+    user_cache.invalidate(user.id)
+    token_cache.invalidate_user(user.id)
     return user
 
 
 def delete_user(user):
-    db.session.delete(user)
-    db.session.commit()
+    """Marks a user deleted with one UPDATE; ``purge_deleted_users`` removes
+    the row once it has been deleted for ``USERS_PURGE_AFTER_DAYS``.
+    Raises ``UserChanged`` as ``update_user`` does."""
+    user_id = user.id
+    user.active = False
+    user.deleted_at = datetime.datetime.utcnow()
+    try:
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        user_cache.invalidate(user_id)
+        raise UserChanged()
+    user_cache.invalidate(user.id)
+    token_cache.invalidate_user(user.id)
     return user
+
+
+def purge_deleted_users(before, batch_size):
+    """Hard-deletes users deleted before ``before``, ``batch_size`` rows per
+    transaction, and yields how many each transaction removed.
+
+    Batches keep each transaction's locks short; callers pause between them
+    to leave the database room for requests.
+    """
+    while True:
+        ids = [
+            user_id
+            for (user_id,) in db.session.query(User.id)
+            .filter(User.deleted_at < before)
+            .order_by(User.deleted_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        ]
+        if not ids:
+            db.session.commit()
+            return
+        User.query.filter(User.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        yield len(ids)
+
+
+def bulk_add_users(rows, batch_size):
+    """Creates users from an iterable of dicts, ``batch_size`` rows at a time.
+
+    Yields one result per input row, in order, with a ``status`` of
+    ``created`` (plus the new ``id``), ``duplicate`` or ``invalid``.
+    """
+    batch = []
+    for number, row in enumerate(rows, start=1):
+        batch.append((number, row))
+        if len(batch) == batch_size:
+            yield from _add_batch(batch)
+            batch = []
+    if batch:
+        yield from _add_batch(batch)
+
+
+def _is_valid_row(row):
+    # an over-long value fails the whole multi-row insert with a DataError
+    return (
+        isinstance(row, dict)
+        and all(
+            isinstance(row.get(field), str) and row[field]
+            for field in ("username", "email", "password")
+        )
+        and len(row["username"]) <= User.username.type.length
+        and len(row["email"]) <= User.email.type.length
+    )
+
+
+def _record_created(emails):
+    """Notes "created" events for the users just inserted with ``emails``;
+    returns their ids by lowercased email."""
+    columns = ("created_date",) + CACHED_COLUMNS
+    rows = _select(columns).filter(func.lower(User.email).in_(emails), LIVE).all()
+    pending = _pending_events(db.session)
+    for row in rows:
+        _note_event(pending, row, "created")
+    return {row.email.lower(): row.id for row in rows}
+
+
+def _add_batch(batch):
+    results = {}
+    pending = {}
+    for number, row in batch:
+        if not _is_valid_row(row):
+            results[number] = {"row": number, "status": "invalid"}
+        elif row["email"].lower() in pending:
+            results[number] = {"row": number, "status": "duplicate"}
+        else:
+            pending[row["email"].lower()] = (number, row)
+
+    if pending:
+        taken = db.session.query(func.lower(User.email)).filter(
+            func.lower(User.email).in_(list(pending)), LIVE
+        )
+        for (email,) in taken:
+            number, _ = pending.pop(email)
+            results[number] = {"row": number, "status": "duplicate"}
+
+    if pending:
+        hashes = hash_passwords([row["password"] for _, row in pending.values()])
+        values = [
+            {"username": row["username"], "email": row["email"], "password": hashed}
+            for (_, row), hashed in zip(pending.values(), hashes)
+        ]
+        try:
+            db.session.execute(User.__table__.insert().values(values))
+            created = _record_created(list(pending))
+            db.session.commit()
+        except IntegrityError:
+            # lost a race with another writer: fall back to row-at-a-time
+            db.session.rollback()
+            created = {}
+            for email, value in zip(list(pending), values):
+                try:
+                    db.session.execute(User.__table__.insert().values(value))
+                    created.update(_record_created([email]))
+                    db.session.commit()
+                except IntegrityError:
+                    db.session.rollback()
+                    number, _ = pending.pop(email)
+                    results[number] = {"row": number, "status": "duplicate"}
+
+        for email, user_id in created.items():
+            number, _ = pending[email]
+            results[number] = {"row": number, "status": "created", "id": user_id}
+            user_cache.invalidate(user_id)
+
+    return [results[number] for number, _ in batch]
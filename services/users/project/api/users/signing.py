@@ -0,0 +1,160 @@
+"""Asymmetric token signing keys, rotated on a schedule.
+
+With ``JWT_KEYS_DIR`` set, tokens are signed with RSA keys kept in that
+directory as ``<kid>.pem``, where the kid is the UTC time the key starts
+signing (``20261019T000000Z``; see ``manage.py generate_signing_key``). The
+newest key whose time has come signs; every key that has not been retired is
+published at ``/.well-known/jwks.json``, so other services verify tokens
+offline. A key is retired once its successor has been signing for longer than
+any token lives, which gives every token it signed time to expire.
+
+Without ``JWT_KEYS_DIR``, tokens are signed HS256 with ``SECRET_KEY`` as
+before. Signing with RSA needs the optional ``cryptography`` package, and
+the app refuses to start with ``JWT_KEYS_DIR`` set if it is missing.
+"""
+import datetime
+import json
+import os
+import threading
+import time
+
+from flask import current_app, request
+
+from project.serialization import json_response
+
+KID_FORMAT = "%Y%m%dT%H%M%SZ"
+
+
+def new_kid(activates_at):
+    return activates_at.strftime(KID_FORMAT)
+
+
+def generate_private_key_pem():
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(65537, 2048, default_backend())
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+
+
+def _load_private_key(path):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+
+    with open(path, "rb") as f:
+        return serialization.load_pem_private_key(f.read(), None, default_backend())
+
+
+class SigningKey:
+    def __init__(self, kid, private_key):
+        self.kid = kid
+        self.activates_at = datetime.datetime.strptime(kid, KID_FORMAT)
+        self.private_key = private_key
+        self.public_key = private_key.public_key()
+
+
+class KeyRing:
+    """Signing keys loaded from ``JWT_KEYS_DIR`` and cached by kid.
+
+    The directory is rescanned at most every ``JWT_KEYS_RELOAD_INTERVAL``
+    seconds; PEM files are only parsed when they first appear.
+    """
+
+    def __init__(self):
+        self._directory = None
+        self._keys = {}
+        self._scanned_at = 0.0
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        directory = current_app.config["JWT_KEYS_DIR"]
+        now = time.monotonic()
+        if directory == self._directory and (
+            now - self._scanned_at < current_app.config["JWT_KEYS_RELOAD_INTERVAL"]
+        ):
+            return
+        with self._lock:
+            keys = self._keys if directory == self._directory else {}
+            found = {}
+            for name in sorted(os.listdir(directory)):
+                kid, ext = os.path.splitext(name)
+                if ext != ".pem":
+                    continue
+                found[kid] = keys.get(kid) or SigningKey(
+                    kid, _load_private_key(os.path.join(directory, name))
+                )
+            self._keys, self._directory, self._scanned_at = found, directory, now
+
+    def enabled(self):
+        return bool(current_app.config["JWT_KEYS_DIR"])
+
+    def _schedule(self, now=None):
+        """Returns ``(signing key, live keys)`` for the time ``now``."""
+        self._scan()
+        now = now or datetime.datetime.utcnow()
+        lifetime = datetime.timedelta(
+            seconds=max(
+                current_app.config["ACCESS_TOKEN_EXPIRATION"],
+                current_app.config["REFRESH_TOKEN_EXPIRATION"],
+            )
+        )
+        keys = sorted(self._keys.values(), key=lambda key: key.activates_at)
+        active = [key for key in keys if key.activates_at <= now]
+        signing = active[-1] if active else None
+        live = []
+        for key, successor in zip(keys, keys[1:] + [None]):
+            if successor is None or successor.activates_at + lifetime > now:
+                live.append(key)
+        return signing, live
+
+    def signing_key(self):
+        signing, _ = self._schedule()
+        if signing is None:
+            raise RuntimeError(f"No active signing key in {self._directory}")
+        return signing
+
+    def verification_key(self, kid):
+        _, live = self._schedule()
+        for key in live:
+            if key.kid == kid:
+                return key.public_key
+        return None
+
+    def jwks(self):
+        from jwt.algorithms import RSAAlgorithm
+
+        keys = []
+        for key in self._schedule()[1]:
+            jwk = json.loads(RSAAlgorithm.to_jwk(key.public_key))
+            keys.append(dict(jwk, kid=key.kid, use="sig", alg="RS256"))
+        return {"keys": keys}
+
+
+keyring = KeyRing()
+
+
+def jwks_view():
+    keys = keyring.jwks() if keyring.enabled() else {"keys": []}
+    response = json_response(keys)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config["JWKS_MAX_AGE"]
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def init_app(app):
+    if app.config["JWT_KEYS_DIR"]:
+        from jwt.algorithms import has_crypto
+
+        # refuse to start rather than fail every login later on
+        if not has_crypto:
+            raise RuntimeError(
+                "JWT_KEYS_DIR is set, but RS256 signing needs the cryptography "
+                "package; install it or unset JWT_KEYS_DIR"
+            )
+    app.add_url_rule("/.well-known/jwks.json", "jwks", jwks_view)
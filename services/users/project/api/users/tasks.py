@@ -0,0 +1,95 @@
+"""Background jobs for the users API, run by ``manage.py worker``."""
+import json
+import os
+import uuid
+
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeSerializer
+
+from project import jobs
+from project.api.users.bulk import summarize
+from project.api.users.revocation import purge_expired
+from project.api.users.services import bulk_add_users
+
+BULK_IMPORT = "users.bulk_import"
+PURGE_REVOKED_TOKENS = "users.purge_revoked_tokens"
+
+
+class TooManyRows(ValueError):
+    pass
+
+
+def _staged_path(upload):
+    # only the generated name travels in the job's args, never a path
+    name = os.path.basename(upload)
+    return os.path.join(current_app.config["USERS_BULK_STAGING_DIR"], name)
+
+
+def stage_upload(rows, maximum):
+    """Writes ``rows`` to a file only this user can read, for a background
+    import to pick up, and returns its name. The rows hold plaintext
+    passwords, which is why they never go into the jobs table. Raises
+    ``TooManyRows`` past ``maximum`` rows, leaving nothing behind."""
+    directory = current_app.config["USERS_BULK_STAGING_DIR"]
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    upload = f"{uuid.uuid4().hex}.ndjson"
+    path = _staged_path(upload)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, "w") as f:
+            for count, row in enumerate(rows, start=1):
+                if count > maximum:
+                    raise TooManyRows(maximum)
+                f.write(json.dumps(row) + "\n")
+    except BaseException:
+        discard_upload(upload)
+        raise
+    return upload
+
+
+def discard_upload(upload):
+    try:
+        os.remove(_staged_path(upload))
+    except FileNotFoundError:
+        pass
+
+
+def _read_upload(upload):
+    with open(_staged_path(upload)) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+@jobs.task(BULK_IMPORT, queue="bulk", max_attempts=3, cleanup=discard_upload)
+def bulk_import(upload):
+    """Runs an upload accepted by ``POST /users/bulk`` with ``Prefer:
+    respond-async``. Rows created by an earlier attempt are reported as
+    duplicates when it is retried; the staged file is deleted once the job
+    is done or has failed for good."""
+    batch_size = current_app.config["USERS_BULK_BATCH_SIZE"]
+    return summarize(bulk_add_users(_read_upload(upload), batch_size))
+
+
+def _signer():
+    return URLSafeSerializer(current_app.config["SECRET_KEY"], salt=BULK_IMPORT)
+
+
+def bulk_import_token(job):
+    """An unguessable handle on ``job`` for ``GET /users/bulk/<token>``: job
+    ids are sequential, and the report lists who was imported."""
+    return _signer().dumps(job.id)
+
+
+def get_bulk_import(token):
+    try:
+        job_id = _signer().loads(token)
+    except BadSignature:
+        return None
+    return jobs.Job.query.filter_by(id=job_id, name=BULK_IMPORT).first()
+
+
+@jobs.task(PURGE_REVOKED_TOKENS, every="REVOCATION_PURGE_INTERVAL")
+def purge_revoked_tokens():
+    """Deletes revocations of tokens that have expired anyway, every
+    ``REVOCATION_PURGE_INTERVAL`` seconds."""
+    return {"purged": purge_expired()}
@@ -1,14 +1,43 @@
+import datetime
+from functools import lru_cache
+from itertools import islice
+from urllib.parse import urlencode
+
+from flask import Response, current_app, stream_with_context
 from flask.globals import request
-from flask_restplus import Namespace, Resource, fields
+from flask_restplus import Namespace, Resource, fields, inputs
+from werkzeug.http import quote_etag
 
+from project import db, jobs
+from project.api.users.bulk import FORMATS, read_rows, summarize
+from project.api.users.pagination import InvalidCursor, decode_cursor, encode_cursor
 from project.api.users.services import (
+    SORT_COLUMNS,
     add_user,
+    bulk_add_users,
     delete_user,
-    get_all_users,
-    get_user_by_email,
+    get_changes_bounds,
     get_user_by_id,
+    get_user_changes,
+    get_user_for_update,
+    get_users_by_ids,
+    get_users_page,
+    get_users_version,
+    iter_all_users,
     update_user,
 )
+from project.api.users.tasks import (
+    BULK_IMPORT,
+    TooManyRows,
+    bulk_import_token,
+    discard_upload,
+    get_bulk_import,
+    stage_upload,
+)
+from project.ratelimit import limit
+from project.serialization import Serializer, dumps, json_response
+
+NDJSON = "application/x-ndjson"
 
 users_namespace = Namespace("Users")
 
@@ -22,15 +51,218 @@ user = users_namespace.model(
     },
 )
 
+user_serializer = Serializer(user)
+
+
+@lru_cache(maxsize=None)
+def serializer_for(fields):
+    """The serializer for a ``fields`` tuple from ``field_list``; None means
+    every field."""
+    return user_serializer.only(fields) if fields else user_serializer
+
+
 user_post = users_namespace.inherit(
     "Full User", user, {"password": fields.String(required=True)}
 )
 
+batch_get = users_namespace.model(
+    "Batch Get", {"ids": fields.List(fields.Integer, required=True)}
+)
+
+batch_result = users_namespace.model(
+    "Batch Get Result",
+    {"users": fields.List(fields.Nested(user)), "missing": fields.List(fields.Integer)},
+)
+
+change = users_namespace.model(
+    "User Change",
+    {
+        "seq": fields.Integer,
+        "type": fields.String(enum=("created", "updated", "deleted")),
+        "user_id": fields.Integer,
+        "user": fields.Raw,
+        "created_at": fields.DateTime,
+    },
+)
+
+change_list = users_namespace.model(
+    "User Changes",
+    {
+        "changes": fields.List(fields.Nested(change)),
+        "next": fields.Integer,
+        "has_more": fields.Boolean,
+    },
+)
+
+bulk_result = users_namespace.model(
+    "Bulk Import Row",
+    {"row": fields.Integer, "status": fields.String, "id": fields.Integer},
+)
+
+bulk_report = users_namespace.model(
+    "Bulk Import Report",
+    {
+        "created": fields.Integer,
+        "duplicate": fields.Integer,
+        "invalid": fields.Integer,
+        "results": fields.List(fields.Nested(bulk_result, skip_none=True)),
+    },
+)
+
+bulk_job = users_namespace.model(
+    "Bulk Import Job",
+    {
+        "id": fields.Integer,
+        "status": fields.String(enum=("queued", "running", "done", "failed")),
+        "attempts": fields.Integer,
+        "result": fields.Nested(bulk_report, allow_null=True),
+        "error": fields.String,
+        "created_at": fields.DateTime,
+        "finished_at": fields.DateTime,
+    },
+)
+
+
+def utc_datetime(value):
+    """ISO 8601 date or datetime, as the naive UTC value stored in the table."""
+    parsed = inputs.datetime_from_iso8601(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+utc_datetime.__schema__ = {"type": "string", "format": "date-time"}
+
+
+def id_list(value):
+    """Comma-separated user ids."""
+    try:
+        return [int(part) for part in value.split(",") if part.strip()]
+    except ValueError:
+        raise ValueError("ids must be comma-separated integers")
+
+
+id_list.__schema__ = {"type": "string"}
+
+
+def field_list(value):
+    """Comma-separated User fields, in model order."""
+    names = {part.strip() for part in value.split(",") if part.strip()}
+    unknown = sorted(names.difference(user))
+    if unknown or not names:
+        raise ValueError(f"fields must be some of {', '.join(user)}")
+    return tuple(name for name in user if name in names)
+
+
+field_list.__schema__ = {"type": "string"}
+
+FIELDS_HELP = "only return these fields, e.g. id,username"
+
+fields_parser = users_namespace.parser()
+fields_parser.add_argument("fields", type=field_list, location="args", help=FIELDS_HELP)
+
+SORTS = tuple(SORT_COLUMNS) + tuple(f"-{name}" for name in SORT_COLUMNS)
+
+list_parser = users_namespace.parser()
+list_parser.add_argument("limit", type=inputs.positive, location="args")
+list_parser.add_argument("cursor", location="args")
+list_parser.add_argument("format", choices=("json", "ndjson"), location="args")
+list_parser.add_argument(
+    "sort", choices=SORTS, default="id", location="args", help="prefix - to reverse"
+)
+list_parser.add_argument("active", type=inputs.boolean, location="args")
+list_parser.add_argument("created_after", type=utc_datetime, location="args")
+list_parser.add_argument("created_before", type=utc_datetime, location="args")
+list_parser.add_argument("q", location="args", help="username or email search")
+list_parser.add_argument(
+    "match", choices=("prefix", "contains"), default="prefix", location="args"
+)
+list_parser.add_argument(
+    "ids", type=id_list, location="args", help="look up these users instead"
+)
+list_parser.add_argument("fields", type=field_list, location="args", help=FIELDS_HELP)
+
+changes_parser = users_namespace.parser()
+changes_parser.add_argument(
+    "since", type=inputs.natural, location="args", help="the last next seen"
+)
+changes_parser.add_argument("limit", type=inputs.positive, location="args")
+
+
+def list_filters(args):
+    return {
+        "active": args["active"],
+        "created_after": args["created_after"],
+        "created_before": args["created_before"],
+        "search": args["q"],
+        "match": args["match"],
+    }
+
+
+def cursor_keyset(row, sort):
+    if sort == "id":
+        return [row.id]
+    value = getattr(row, sort)
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    return [value, row.id]
+
+
+def parse_cursor(cursor, sort):
+    """Decodes a cursor made by ``cursor_keyset`` for the same sort."""
+    values = decode_cursor(cursor)
+    if len(values) != (1 if sort == "id" else 2) or not isinstance(values[-1], int):
+        raise InvalidCursor(cursor)
+    if sort != "id" and not isinstance(values[0], str):
+        raise InvalidCursor(cursor)
+    if sort == "created_date":
+        values[0] = datetime.datetime.fromisoformat(values[0])
+    return values
+
+
+def cache_headers(etag):
+    return {
+        "ETag": quote_etag(etag, weak=True),
+        "Cache-Control": current_app.config["USERS_CACHE_CONTROL"],
+    }
+
+
+def not_modified(etag):
+    """Returns a bodiless 304 if the client already holds ``etag``."""
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=cache_headers(etag))
+    return None
+
+
+def stream_users(filters, serializer):
+    batch_size = current_app.config["USERS_STREAM_BATCH_SIZE"]
+    columns = serializer.columns
+
+    def generate():
+        for row in iter_all_users(batch_size, columns=columns, **filters):
+            yield dumps(serializer(row))
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
+
+
+def batch_get_users(ids, serializer, headers=None):
+    """Responds with the users for ``ids`` in request order, from one query."""
+    maximum = current_app.config["USERS_BATCH_MAX_IDS"]
+    if len(ids) > maximum:
+        users_namespace.abort(400, f"At most {maximum} ids per request")
+    columns = tuple(dict.fromkeys(serializer.columns + ("id",)))
+    users, missing = get_users_by_ids(ids, columns=columns)
+    return json_response(
+        {"users": serializer.many(users), "missing": missing}, 200, headers
+    )
+
 
 class UserList(Resource):
     @users_namespace.expect(user_post, validate=True)
     @users_namespace.response(201, "<user_email> was added!")
     @users_namespace.response(400, "Sorry. That email already exists.")
+    @users_namespace.response(429, "Too many requests.")
+    @limit("create_user", "RATELIMIT_CREATE_USER")
     def post(self):
         """Creates a new user."""
         post_data = request.get_json()
@@ -39,39 +271,233 @@ class UserList(Resource):
         password = post_data.get("password")
         response_object = {}
 
-        user = get_user_by_email(email)
-
-        if user:
+        if not add_user(username, email, password):
             response_object["message"] = "Sorry. That email already exists."
             return response_object, 400
 
-        add_user(username, email, password)
         response_object["message"] = f"{email} was added!"
         return response_object, 201
 
-    @users_namespace.marshal_with(user, as_list=True)
+    @users_namespace.expect(list_parser)
+    @users_namespace.response(200, "Success", [user])
+    @users_namespace.response(304, "Not Modified")
+    @users_namespace.response(400, "Invalid cursor")
     def get(self):
-        """Returns all users."""
-        return get_all_users(), 200
+        """Returns a page of users, or streams every user as NDJSON.
+
+        Filtering, sorting and search all run in SQL; pages follow the
+        ``X-Next-Cursor`` header, which is only valid for the same query.
+        With ``ids``, returns those users instead, as ``POST /users/batch-get``
+        does. ``fields`` trims each user to the fields named, and only those
+        columns are selected.
+        """
+        args = list_parser.parse_args()
+        filters = list_filters(args)
+        serializer = serializer_for(args["fields"])
+        if args["ids"] is None and (
+            args["format"] == "ndjson"
+            or request.accept_mimetypes.best_match(["application/json", NDJSON])
+            == NDJSON
+        ):
+            return stream_users(filters, serializer)
+
+        limit = min(
+            args["limit"] or current_app.config["USERS_PAGE_SIZE"],
+            current_app.config["USERS_MAX_PAGE_SIZE"],
+        )
+        sort = args["sort"].lstrip("-")
+        after = None
+        if args["cursor"]:
+            try:
+                after = parse_cursor(args["cursor"], sort)
+            except ValueError:
+                users_namespace.abort(400, "Invalid cursor")
+
+        # one ETag per URL, changed by any write to the users table
+        version = get_users_version()
+        etag = None if version is None else f"users-{version}"
+        if etag:
+            response = not_modified(etag)
+            if response:
+                return response
+        headers = cache_headers(etag) if etag else {}
+        if args["ids"] is not None:
+            return batch_get_users(args["ids"], serializer, headers)
+
+        users, has_more = get_users_page(
+            limit,
+            after=after,
+            sort=sort,
+            descending=args["sort"].startswith("-"),
+            columns=tuple(dict.fromkeys(serializer.columns + ("id", sort))),
+            **filters,
+        )
+        if has_more:
+            next_cursor = encode_cursor(cursor_keyset(users[-1], sort))
+            query = request.args.to_dict()
+            query.update(limit=limit, cursor=next_cursor)
+            next_url = request.base_url + "?" + urlencode(query)
+            headers["X-Next-Cursor"] = next_cursor
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        return json_response(serializer.many(users), 200, headers)
 
 
 users_namespace.add_resource(UserList, "")
 
 
+class UserBatchGet(Resource):
+    @users_namespace.expect(batch_get, fields_parser, validate=True)
+    @users_namespace.response(200, "Success", batch_result)
+    @users_namespace.response(400, "Too many ids")
+    def post(self):
+        """Returns the users with the given ids, in order, and the ids not found.
+
+        Repeated ids are returned once. Takes up to ``USERS_BATCH_MAX_IDS``.
+        """
+        serializer = serializer_for(fields_parser.parse_args()["fields"])
+        return batch_get_users(request.get_json()["ids"], serializer)
+
+
+users_namespace.add_resource(UserBatchGet, "/batch-get")
+
+
+class UserChanges(Resource):
+    @users_namespace.expect(changes_parser)
+    @users_namespace.response(200, "Success", change_list)
+    @users_namespace.response(410, "Changes after <since> are no longer kept")
+    def get(self):
+        """Returns changes to users after seq ``since``, oldest first.
+
+        Without ``since`` there are no changes, only the current ``next``:
+        keep it, read ``GET /users`` once, then poll with ``since`` set to the
+        last ``next``. Each change carries the user as it was; changes already
+        seen in the full read may come again.
+        """
+        args = changes_parser.parse_args()
+        pruned, head = get_changes_bounds()
+        since = args["since"]
+        if since is None:
+            return json_response({"changes": [], "next": head, "has_more": False})
+        if since < pruned:
+            users_namespace.abort(
+                410, f"Changes after {since} are no longer kept; read GET /users"
+            )
+        limit = min(
+            args["limit"] or current_app.config["USERS_PAGE_SIZE"],
+            current_app.config["USERS_MAX_PAGE_SIZE"],
+        )
+        events, has_more = get_user_changes(since, limit)
+        return json_response(
+            {
+                "changes": [event.to_json() for event in events],
+                "next": events[-1].seq if events else since,
+                "has_more": has_more,
+            }
+        )
+
+
+users_namespace.add_resource(UserChanges, "/changes")
+
+
+class UserBulk(Resource):
+    @users_namespace.response(200, "Success", bulk_report)
+    @users_namespace.response(202, "Accepted; follow Location", bulk_job)
+    @users_namespace.response(413, "Too many rows for one request.")
+    @users_namespace.response(415, "Send text/csv or application/x-ndjson.")
+    @users_namespace.response(429, "Too many requests.")
+    @limit("bulk_import", "RATELIMIT_BULK_IMPORT")
+    def post(self):
+        """Creates users from a CSV or NDJSON body.
+
+        Up to ``USERS_BULK_SYNC_MAX_ROWS`` rows are imported in the request.
+        With ``Prefer: respond-async``, up to ``USERS_BULK_ASYNC_MAX_ROWS``
+        are handed to a background job and the response's Location points at
+        ``GET /users/bulk/<token>``.
+        """
+        fmt = FORMATS.get(request.mimetype)
+        if not fmt:
+            users_namespace.abort(415, "Send text/csv or application/x-ndjson.")
+
+        rows = read_rows(request.stream, fmt)
+        if "respond-async" in request.headers.get("Prefer", ""):
+            return enqueue_bulk_import(rows)
+        # read before anything is created, so an oversized upload creates none
+        maximum = current_app.config["USERS_BULK_SYNC_MAX_ROWS"]
+        rows = list(islice(rows, maximum + 1))
+        if len(rows) > maximum:
+            users_namespace.abort(
+                413,
+                f"At most {maximum} rows per request; "
+                "send larger uploads with Prefer: respond-async",
+            )
+        batch_size = current_app.config["USERS_BULK_BATCH_SIZE"]
+        return json_response(summarize(bulk_add_users(rows, batch_size)))
+
+
+def enqueue_bulk_import(rows):
+    maximum = current_app.config["USERS_BULK_ASYNC_MAX_ROWS"]
+    try:
+        upload = stage_upload(rows, maximum)
+    except TooManyRows:
+        users_namespace.abort(413, f"At most {maximum} rows per background import")
+    try:
+        job = jobs.enqueue(BULK_IMPORT, {"upload": upload})
+        db.session.commit()
+    except Exception:
+        discard_upload(upload)
+        raise
+    return json_response(
+        job.to_json(),
+        202,
+        {
+            "Location": f"{request.base_url}/{bulk_import_token(job)}",
+            "Preference-Applied": "respond-async",
+        },
+    )
+
+
+users_namespace.add_resource(UserBulk, "/bulk")
+
+
+class UserBulkJob(Resource):
+    @users_namespace.response(200, "Success", bulk_job)
+    @users_namespace.response(404, "Import does not exist")
+    def get(self, token):
+        """Returns the status of a background import, and its report once done.
+
+        ``token`` comes from the Location of the ``POST /users/bulk`` that
+        queued it.
+        """
+        job = get_bulk_import(token)
+        if not job:
+            users_namespace.abort(404, "Import does not exist")
+        return json_response(job.to_json())
+
+
+users_namespace.add_resource(UserBulkJob, "/bulk/<token>")
+
+
 class Users(Resource):
-    @users_namespace.marshal_with(user)
-    @users_namespace.response(200, "Success")
+    @users_namespace.expect(fields_parser)
+    @users_namespace.response(200, "Success", user)
+    @users_namespace.response(304, "Not Modified")
     @users_namespace.response(404, "User <user_id> does not exist")
     def get(self, user_id):
         """Returns a single user."""
-        user = get_user_by_id(user_id)
-        if not user:
+        args = fields_parser.parse_args()
+        current_user = get_user_by_id(user_id)
+        if not current_user:
             users_namespace.abort(404, f"User {user_id} does not exist")
-        return user, 200
+        etag = f"user-{current_user.id}-{current_user.version}"
+        return not_modified(etag) or json_response(
+            serializer_for(args["fields"])(current_user), 200, cache_headers(etag)
+        )
 
     @users_namespace.expect(user, validate=True)
     @users_namespace.response(200, "<user_id> was updated!")
+    @users_namespace.response(400, "Sorry. That email already exists.")
     @users_namespace.response(404, "User <user_id> does not exist")
+    @users_namespace.response(409, "The user was changed by another request.")
     def put(self, user_id):
         """Updates a user."""
         post_data = request.get_json()
@@ -79,25 +505,32 @@ class Users(Resource):
         email = post_data.get("email")
         response_object = {}
 
-        user = get_user_by_id(user_id)
+        # the version checked on write must be current: read the primary and
+        # skip the user cache
+        user = get_user_for_update(user_id)
 
         if not user:
             users_namespace.abort(404, f"User {user_id} does not exist")
 
-        update_user(user, username, email)
+        if not update_user(user, username, email):
+            response_object["message"] = "Sorry. That email already exists."
+            return response_object, 400
+
         response_object["message"] = f"{user.id} was updated!"
         return response_object, 200
 
     @users_namespace.response(200, "<user_id> was removed!")
     @users_namespace.response(404, "User <user_id> does not exist")
+    @users_namespace.response(409, "The user was changed by another request.")
     def delete(self, user_id):
         """Deletes a user."""
         response_object = {}
-        user = get_user_by_id(user_id)
+        user = get_user_for_update(user_id)
         if not user:
             users_namespace.abort(404, f"User {user_id} does not exist")
+        email = user.email
         delete_user(user)
-        response_object["message"] = f"{user.email} was removed!"
+        response_object["message"] = f"{email} was removed!"
         return response_object, 200
 
 
@@ -0,0 +1,39 @@
+import hashlib
+import math
+
+
+class BloomFilter:
+    """Fixed-size set membership test with no false negatives.
+
+    Sized for ``capacity`` keys at a false positive rate of ``error_rate``;
+    past that capacity the rate climbs, so callers rebuild a bigger one.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        added = False
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        # re-adding a key (or a false positive) does not use up capacity
+        self.count += added
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
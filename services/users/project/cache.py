@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A thread-safe LRU mapping whose entries also expire at a set time."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class NullBackend:
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+
+class MemoryBackend:
+    """Per-process backend; each gunicorn worker keeps its own copy."""
+
+    def __init__(self, maxsize):
+        self._cache = LRUCache(maxsize)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl):
+        self._cache.set(key, value, time.time() + ttl)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+
+class RedisBackend:
+    """Shared backend storing JSON values in Redis (or anything with its API)."""
+
+    def __init__(self, client, prefix=""):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, prefix=""):
+        import redis
+
+        return cls(redis.Redis.from_url(url), prefix)
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+def create_backend(kind, url=None, maxsize=None, prefix=""):
+    if kind == "memory":
+        return MemoryBackend(maxsize)
+    if kind == "redis":
+        return RedisBackend.from_url(url, prefix)
+    if kind == "null":
+        return NullBackend()
+    raise ValueError(f"Unknown cache backend {kind!r}")
@@ -0,0 +1,114 @@
+"""Negotiated response compression.
+
+Responses of a compressible type are encoded with brotli or gzip, whichever
+the client prefers in ``Accept-Encoding`` (brotli wins a tie, and is only
+offered when the optional ``brotli`` package is installed). Buffered bodies
+smaller than ``COMPRESS_MIN_SIZE`` go out as they are, since the headers
+would eat the saving. Streamed bodies, such as ``GET /users`` as NDJSON, are
+compressed chunk by chunk as they are generated, so the whole body is never
+held in memory.
+"""
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # optional: pip install brotli
+    brotli = None
+
+COMPRESSIBLE = ("application/json", "application/x-ndjson", "text/")
+
+
+class GzipEncoder:
+    def __init__(self, level):
+        # wbits 31: a gzip header and trailer around the deflate stream
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def process(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliEncoder:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def process(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def available_encodings():
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate(accept_encodings):
+    """Returns the encoding to use for ``Accept-Encoding``, or None."""
+    best, best_quality = None, 0
+    for encoding in available_encodings():
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def encoder(encoding):
+    config = current_app.config
+    if encoding == "br":
+        return BrotliEncoder(config["COMPRESS_BROTLI_QUALITY"])
+    return GzipEncoder(config["COMPRESS_GZIP_LEVEL"])
+
+
+def _compressed(chunks, encoder, charset="utf-8"):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            data = encoder.process(chunk)
+            if data:
+                yield data
+        yield encoder.finish()
+    finally:
+        # lets stream_with_context generators release the request context
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response):
+    if not current_app.config["COMPRESS_ENABLED"]:
+        return response
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    if response.direct_passthrough or "Content-Encoding" in response.headers:
+        return response
+    if not (response.mimetype or "").startswith(COMPRESSIBLE):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = _compressed(
+            response.response, encoder(encoding), response.charset
+        )
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config["COMPRESS_MIN_SIZE"]:
+            return response
+        response.set_data(b"".join(_compressed([data], encoder(encoding))))
+    response.headers["Content-Encoding"] = encoding
+    # the encoded bytes differ, so a strong validator no longer holds
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    app.after_request(compress_response)
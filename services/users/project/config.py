@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 
 class BaseConfig:
@@ -6,9 +7,160 @@ class BaseConfig:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = os.environ.get("SECRET_KEY")
     POSTGRES_HOST = os.environ.get("POSTGRES_HOST")
-    BCRYPT_LOG_ROUNDS = 13
+    # connection pool per worker process: keep DB_POOL_SIZE at or above the
+    # gunicorn threads per worker (see gunicorn.conf.py)
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 5))
+    DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 10))
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+    DB_POOL_PRE_PING = True
+    # set when PgBouncer (or another transaction pooler) sits in front of Postgres
+    DB_TRANSACTION_POOLER = os.environ.get("DB_TRANSACTION_POOLER") == "1"
+    # read replicas, given as comma-separated DATABASE_REPLICA_URLS, become
+    # the binds replica0, replica1, ... Reads marked with db.use_replica() go
+    # to one trailing the primary by at most DB_REPLICA_MAX_LAG seconds, and
+    # stay on the primary for that long after the client's own writes. That
+    # window is shared through Redis once DB_STICKY_URL is set; the "memory"
+    # backend only covers the worker that took the write, so gunicorn refuses
+    # to start several workers on it with replicas configured.
+    SQLALCHEMY_BINDS = {
+        f"replica{i}": url
+        for i, url in enumerate(os.environ.get("DATABASE_REPLICA_URLS", "").split(","))
+        if url
+    }
+    DB_REPLICA_MAX_LAG = float(os.environ.get("DB_REPLICA_MAX_LAG", 5))
+    DB_REPLICA_LAG_CHECK_INTERVAL = 1
+    DB_STICKY_BACKEND = os.environ.get(
+        "DB_STICKY_BACKEND", "redis" if os.environ.get("DB_STICKY_URL") else "memory"
+    )
+    DB_STICKY_URL = os.environ.get("DB_STICKY_URL")
+    DB_STICKY_SIZE = 100000
+    # password hashing policy; tune the cost per host with
+    # "manage.py calibrate_passwords". Hashes made under an older policy are
+    # upgraded on the next successful login when PASSWORD_REHASH is on.
+    PASSWORD_SCHEME = os.environ.get("PASSWORD_SCHEME", "bcrypt")
+    BCRYPT_LOG_ROUNDS = int(os.environ.get("BCRYPT_LOG_ROUNDS", 13))
+    ARGON2_TIME_COST = int(os.environ.get("ARGON2_TIME_COST", 3))
+    ARGON2_MEMORY_COST = int(os.environ.get("ARGON2_MEMORY_COST", 65536))  # KiB
+    ARGON2_PARALLELISM = int(os.environ.get("ARGON2_PARALLELISM", 2))
+    PASSWORD_REHASH = True
+    # bcrypt processes per gunicorn worker; 0 hashes on the request thread
+    PASSWORD_POOL_SIZE = int(os.environ.get("PASSWORD_POOL_SIZE", 2))
+    # passwords being hashed or verified per gunicorn worker, queued or
+    # running, before answering 503; 0 disables the limit
+    PASSWORD_QUEUE_DEPTH = int(os.environ.get("PASSWORD_QUEUE_DEPTH", 16))
+    PASSWORD_QUEUE_TIMEOUT = 0.5
+    PASSWORD_RETRY_AFTER = 1
+    # directory of RS256 signing keys (see project/api/users/signing.py);
+    # unset signs HS256 with SECRET_KEY
+    JWT_KEYS_DIR = os.environ.get("JWT_KEYS_DIR")
+    JWT_KEYS_RELOAD_INTERVAL = 60
+    JWKS_MAX_AGE = 300
     ACCESS_TOKEN_EXPIRATION = 900  # 15 minutes
     REFRESH_TOKEN_EXPIRATION = 2592000  # 30 days
+    # verified access tokens kept per worker; a TTL of 0 disables the cache
+    TOKEN_CACHE_SIZE = 10000
+    TOKEN_CACHE_TTL = 30
+    # "memory" is per worker; point USER_CACHE_URL at Redis with the "redis"
+    # backend to keep every worker coherent after writes
+    USER_CACHE_BACKEND = os.environ.get("USER_CACHE_BACKEND", "memory")
+    USER_CACHE_URL = os.environ.get("USER_CACHE_URL")
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 30
+    USER_CACHE_NEGATIVE_TTL = 5
+    # revoked token ids kept in a per-worker bloom filter; other workers'
+    # revocations take up to REVOCATION_SYNC_INTERVAL seconds to apply.
+    # "manage.py worker" prunes expired ones every REVOCATION_PURGE_INTERVAL.
+    REVOCATION_BLOOM_CAPACITY = 100000
+    REVOCATION_BLOOM_ERROR_RATE = 0.001
+    REVOCATION_SYNC_INTERVAL = 5
+    REVOCATION_REBUILD_INTERVAL = 3600
+    REVOCATION_PURGE_INTERVAL = 3600
+    # proxies in front of the app that append to X-Forwarded-For; rate limits
+    # and replica stickiness key on the client address found behind them
+    PROXY_COUNT = int(
+        os.environ.get("PROXY_COUNT", os.environ.get("RATELIMIT_PROXY_COUNT", 0))
+    )
+    # (requests, seconds) sliding-window limits, counted per worker by the
+    # "memory" store or shared through RATELIMIT_URL with the "redis" store
+    RATELIMIT_ENABLED = True
+    RATELIMIT_STORE = os.environ.get("RATELIMIT_STORE", "memory")
+    RATELIMIT_URL = os.environ.get("RATELIMIT_URL")
+    RATELIMIT_SIZE = 100000
+    RATELIMIT_AUTH = (120, 60)  # per IP, across /auth/*
+    RATELIMIT_LOGIN = (10, 300)  # per account, on /auth/login
+    RATELIMIT_CREATE_USER = (30, 60)  # per IP, on POST /users
+    RATELIMIT_BULK_IMPORT = (10, 3600)  # per IP, on POST /users/bulk
+    # /readyz runs SELECT 1 at most every READINESS_DB_CHECK_INTERVAL seconds
+    # per worker, and reports not ready once this share (0-1) of the DB pool
+    # or of the password hashing queue is in use
+    READINESS_DB_CHECK_INTERVAL = 5
+    READINESS_MAX_POOL_USAGE = 1.0
+    READINESS_MAX_PASSWORD_QUEUE = 1.0
+    # responses of at least COMPRESS_MIN_SIZE bytes are gzipped, or brotli
+    # encoded when the brotli package is installed and the client takes it;
+    # streamed responses are compressed whatever their size
+    COMPRESS_ENABLED = True
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 4
+    # a directory shared by every worker (and job worker or relay) on the
+    # host; with it, /metrics sums all their registries instead of reporting
+    # only the worker that answers
+    METRICS_DIR = os.environ.get("METRICS_DIR")
+    METRICS_WRITE_INTERVAL = 5
+    # requests slower than this many seconds are logged with their SQL;
+    # None turns the log off
+    SLOW_REQUEST_THRESHOLD = 0.5
+    USERS_PAGE_SIZE = 100
+    USERS_MAX_PAGE_SIZE = 1000
+    USERS_STREAM_BATCH_SIZE = 1000
+    USERS_BULK_BATCH_SIZE = 1000
+    # deleted users are kept this long, then "manage.py purge_users" removes
+    # them USERS_PURGE_BATCH_SIZE rows at a time, USERS_PURGE_PAUSE seconds apart
+    USERS_PURGE_AFTER_DAYS = 30
+    USERS_PURGE_BATCH_SIZE = 500
+    USERS_PURGE_PAUSE = 0.5
+    # rows per POST /users/bulk imported in the request, which has to finish
+    # well within gunicorn's 30s timeout: at BCRYPT_LOG_ROUNDS 13 a hash takes
+    # about 0.7s, so 25 rows on 2 pool processes take about 9s. Raise it with
+    # the pool size or a lower cost; larger uploads go to the background.
+    USERS_BULK_SYNC_MAX_ROWS = int(os.environ.get("USERS_BULK_SYNC_MAX_ROWS", 25))
+    # rows per POST /users/bulk sent with "Prefer: respond-async"; they are
+    # staged in USERS_BULK_STAGING_DIR, which the web service and the job
+    # workers must share, until the import ends
+    USERS_BULK_ASYNC_MAX_ROWS = 100000
+    USERS_BULK_STAGING_DIR = os.environ.get(
+        "USERS_BULK_STAGING_DIR", os.path.join(tempfile.gettempdir(), "users-bulk")
+    )
+    # ids per GET /users?ids= or POST /users/batch-get
+    USERS_BATCH_MAX_IDS = 5000
+    # background jobs run by "manage.py worker"; JOBS_QUEUES caps how many
+    # jobs of each queue run at once across every worker (0 for no cap).
+    # Failed jobs retry after JOBS_RETRY_BASE seconds, doubling up to
+    # JOBS_RETRY_MAX; a job running longer than JOBS_LEASE seconds is assumed
+    # lost with its worker and handed out again. Finished jobs are kept
+    # JOBS_RETENTION_DAYS, then deleted every JOBS_PRUNE_INTERVAL seconds.
+    JOBS_QUEUES = {"default": 0, "bulk": 1}
+    JOBS_WORKER_THREADS = int(os.environ.get("JOBS_WORKER_THREADS", 4))
+    JOBS_POLL_INTERVAL = 1
+    JOBS_MAX_ATTEMPTS = 5
+    JOBS_RETRY_BASE = 10
+    JOBS_RETRY_MAX = 3600
+    JOBS_LEASE = 900
+    JOBS_RETENTION_DAYS = 7
+    JOBS_PRUNE_INTERVAL = 3600
+    # user change events are relayed by "manage.py relay_events" to the
+    # OUTBOX_SINK: "file" appends NDJSON to the OUTBOX_URL path, "redis" adds
+    # to the user_events stream at OUTBOX_URL. "manage.py prune_events" keeps
+    # published events OUTBOX_RETENTION_DAYS for GET /users/changes.
+    OUTBOX_SINK = os.environ.get("OUTBOX_SINK", "file")
+    OUTBOX_URL = os.environ.get("OUTBOX_URL", "user_events.ndjson")
+    OUTBOX_BATCH_SIZE = 500
+    OUTBOX_POLL_INTERVAL = 1
+    OUTBOX_RETENTION_DAYS = 7
+    # sent with ETag'd user responses; "no-cache" still lets clients revalidate
+    USERS_CACHE_CONTROL = os.environ.get("USERS_CACHE_CONTROL", "private, no-cache")
 
 
 class DevelopmentConfig(BaseConfig):
@@ -20,6 +172,12 @@ class TestingConfig(BaseConfig):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_TEST_URL")
     BCRYPT_LOG_ROUNDS = 4
+    PASSWORD_POOL_SIZE = 0
+    TOKEN_CACHE_TTL = 0
+    USER_CACHE_BACKEND = "null"
+    OUTBOX_SINK = "memory"
+    REVOCATION_SYNC_INTERVAL = 0
+    RATELIMIT_ENABLED = False
     ACCESS_TOKEN_EXPIRATION = 3
     REFRESH_TOKEN_EXPIRATION = 3
 
@@ -0,0 +1,239 @@
+import math
+import random
+import time
+from contextlib import contextmanager
+
+from flask import has_request_context
+from flask_sqlalchemy import SignallingSession
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
+from sqlalchemy import orm, text
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.expression import Select
+
+from project import metrics
+from project.cache import create_backend
+from project.utils import client_ip
+
+checkout_wait = metrics.Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting to check a connection out of the pool.",
+)
+checkout_timeouts = metrics.Counter(
+    "db_pool_checkout_timeouts_total",
+    "Checkouts that gave up after DB_POOL_TIMEOUT seconds.",
+)
+replica_routes = metrics.Counter(
+    "db_replica_routing_total",
+    "Replica-eligible reads by where they went: replica, or the primary "
+    "after a recent write (sticky) or because every replica lags (lagging).",
+    labelnames=("route",),
+)
+
+# 0 while the replica has replayed everything it received, otherwise the age
+# of the last transaction it replayed; NULL on a primary
+REPLICA_LAG_SQL = """
+SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END
+"""
+
+
+class InstrumentedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            checkout_timeouts.inc()
+            raise
+        finally:
+            checkout_wait.observe(time.perf_counter() - start)
+
+
+def replica_lag(engine):
+    """Returns how many seconds the database behind ``engine`` trails its
+    primary; databases other than Postgres are taken to be caught up."""
+    if engine.dialect.name != "postgresql":
+        return 0.0
+    with engine.connect() as conn:
+        return float(conn.execute(text(REPLICA_LAG_SQL)).scalar() or 0.0)
+
+
+class ReplicaMonitor:
+    """Each replica's lag, measured at most every ``interval`` seconds.
+
+    A replica that cannot be reached counts as infinitely far behind until
+    the next check.
+    """
+
+    def __init__(self):
+        self._checked = {}
+
+    def lag(self, app, engine):
+        interval = app.config["DB_REPLICA_LAG_CHECK_INTERVAL"]
+        now = time.monotonic()
+        checked = self._checked.get(engine)
+        if checked is None or now - checked[0] >= interval:
+            try:
+                lag = replica_lag(engine)
+            except SQLAlchemyError:
+                app.logger.warning("Replica %s is unreachable", engine.url)
+                lag = math.inf
+            checked = self._checked[engine] = (now, lag)
+        return checked[1]
+
+
+replica_monitor = ReplicaMonitor()
+
+
+def _sticky_store(app):
+    config = app.config
+    key = (config["DB_STICKY_BACKEND"], config["DB_STICKY_URL"])
+    cached = app.extensions.get("db_sticky")
+    if cached is None or cached[0] != key:
+        store = create_backend(
+            config["DB_STICKY_BACKEND"],
+            config["DB_STICKY_URL"],
+            config["DB_STICKY_SIZE"],
+            prefix="db-sticky:",
+        )
+        cached = app.extensions["db_sticky"] = (key, store)
+    return cached[1]
+
+
+class RoutingSession(SignallingSession):
+    """Sends SELECTs made under ``SQLAlchemy.use_replica`` to a replica.
+
+    Replicas are the ``SQLALCHEMY_BINDS`` whose key starts with "replica";
+    one trailing the primary by at most ``DB_REPLICA_MAX_LAG`` seconds is
+    picked per transaction. Everything else, and every read in a transaction
+    that has written, goes to the primary. After a client commits a write,
+    its replica reads stay on the primary for ``DB_REPLICA_MAX_LAG`` seconds,
+    long enough for any replica still in use to have the write.
+    """
+
+    def __init__(self, db, **options):
+        self.use_replica = None
+        self._db = db
+        self._wrote = False
+        self._replica = None
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self._wrote = True
+        elif self.use_replica and isinstance(clause, Select):
+            replica = self._route()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+    def _route(self):
+        config = self.app.config
+        keys = [
+            key for key in config["SQLALCHEMY_BINDS"] or () if key.startswith("replica")
+        ]
+        if not keys:
+            return None
+        if self._wrote or self._is_sticky():
+            replica_routes.labels("sticky").inc()
+            return None
+        max_lag = config["DB_REPLICA_MAX_LAG"]
+        engines = [self._db.get_engine(self.app, bind=key) for key in keys]
+        if (
+            self._replica not in engines
+            or replica_monitor.lag(self.app, self._replica) > max_lag
+        ):
+            healthy = [
+                engine
+                for engine in engines
+                if replica_monitor.lag(self.app, engine) <= max_lag
+            ]
+            if not healthy:
+                replica_routes.labels("lagging").inc()
+                return None
+            self._replica = random.choice(healthy)
+        replica_routes.labels("replica").inc()
+        return self._replica
+
+    def _is_sticky(self):
+        return (
+            has_request_context()
+            and _sticky_store(self.app).get(client_ip()) is not None
+        )
+
+    def _reset(self):
+        self._wrote = False
+        self._replica = None
+
+    def commit(self):
+        super().commit()
+        if self._wrote and has_request_context():
+            ttl = max(int(math.ceil(self.app.config["DB_REPLICA_MAX_LAG"])), 1)
+            _sticky_store(self.app).set(client_ip(), 1, ttl)
+        self._reset()
+
+    def rollback(self):
+        super().rollback()
+        self._reset()
+
+    def close(self):
+        super().close()
+        self._reset()
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """Applies the ``DB_POOL_*`` settings to Postgres engines.
+
+    With ``DB_TRANSACTION_POOLER`` set, a transaction pooler such as
+    PgBouncer owns the pooling: every checkout opens a fresh client
+    connection to it (``NullPool``), and nothing may rely on session state
+    surviving between transactions. psycopg2 never creates server-side
+    prepared statements, so there are none to turn off.
+
+    Sessions are ``RoutingSession``s, which send reads marked with
+    ``use_replica`` to read replicas.
+    """
+
+    def dispose_engines(self, app):
+        """Drops every pooled connection ``app``'s engines hold.
+
+        Call it in each worker forked from a preloaded app: a connection
+        inherited across fork shares its socket with the parent.
+        """
+        with app.app_context():
+            for bind in [None] + list(app.config["SQLALCHEMY_BINDS"] or ()):
+                self.get_engine(app, bind).dispose()
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    @contextmanager
+    def use_replica(self, enabled=True):
+        """Lets SELECTs in the block (or decorated function) read from a
+        replica, or with ``enabled=False`` keeps them on the primary. The
+        outermost block decides."""
+        session = self.session()
+        previous = session.use_replica
+        if previous is None:
+            session.use_replica = enabled
+        try:
+            yield
+        finally:
+            session.use_replica = previous
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        if not sa_url.drivername.startswith("postgres"):
+            return
+        config = app.config
+        if config["DB_TRANSACTION_POOLER"]:
+            options["poolclass"] = NullPool
+            return
+        options["poolclass"] = InstrumentedQueuePool
+        options["pool_size"] = config["DB_POOL_SIZE"]
+        options["max_overflow"] = config["DB_MAX_OVERFLOW"]
+        options["pool_timeout"] = config["DB_POOL_TIMEOUT"]
+        options["pool_recycle"] = config["DB_POOL_RECYCLE"]
+        options["pool_pre_ping"] = config["DB_POOL_PRE_PING"]
@@ -0,0 +1,140 @@
+"""Liveness and readiness probes.
+
+``/livez`` is answered by WSGI middleware before Flask sees the request, so
+it costs next to nothing and only fails when the worker cannot run Python at
+all: point the orchestrator's liveness probe at it.
+
+``/readyz`` reports whether this worker should get traffic. It is not ready
+while the database is unreachable, every pooled connection is checked out,
+or the password hashing queue is full; a saturated worker is taken out of
+rotation until it drains instead of being restarted. The ``SELECT 1`` runs
+at most every ``READINESS_DB_CHECK_INTERVAL`` seconds per worker, however
+often the probe calls.
+"""
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import QueuePool
+
+from project import db
+from project.api.users.passwords import queue_depth
+from project.serialization import json_response
+
+
+class LivenessMiddleware:
+    def __init__(self, app, path="/livez"):
+        self.app = app
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        method = environ.get("REQUEST_METHOD")
+        if environ.get("PATH_INFO") == self.path and method in ("GET", "HEAD"):
+            start_response(
+                "200 OK",
+                [
+                    ("Content-Type", "text/plain"),
+                    ("Content-Length", "3"),
+                    ("Cache-Control", "no-store"),
+                ],
+            )
+            return [] if method == "HEAD" else [b"ok\n"]
+        return self.app(environ, start_response)
+
+
+def ping_database(engine):
+    """Returns the ``SELECT 1`` round trip in seconds."""
+    start = time.perf_counter()
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+    return time.perf_counter() - start
+
+
+class DatabaseCheck:
+    """The last ``SELECT 1`` result, refreshed at most every ``interval``.
+
+    While one thread refreshes it, others answer with the previous result
+    rather than queue up behind it.
+    """
+
+    def __init__(self):
+        self._result = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def result(self, engine, interval):
+        now = time.monotonic()
+        if self._result is not None and now - self._checked_at < interval:
+            return self._result
+        if not self._lock.acquire(blocking=self._result is None):
+            return self._result
+        try:
+            try:
+                latency = ping_database(engine)
+            except SQLAlchemyError as e:
+                current_app.logger.warning("Readiness check failed: %s", e)
+                self._result = {"ok": False, "error": type(e).__name__}
+            else:
+                self._result = {"ok": True, "latency_ms": round(latency * 1000, 1)}
+            self._checked_at = now
+            return self._result
+        finally:
+            self._lock.release()
+
+
+database_check = DatabaseCheck()
+
+
+def pool_usage(engine):
+    """Returns ``(checked out, capacity)`` for a bounded ``QueuePool``."""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool) or pool._max_overflow < 0:
+        return None
+    return pool.checkedout(), pool.size() + pool._max_overflow
+
+
+def _usage(used, capacity, limit):
+    return {
+        "in_use": used,
+        "capacity": capacity,
+        "ok": not capacity or used < capacity * limit,
+    }
+
+
+def readiness():
+    """Returns ``(ready, checks)`` for this worker."""
+    config = current_app.config
+    engine = db.engine
+    checks = {}
+    usage = pool_usage(engine)
+    if usage is not None:
+        checks["db_pool"] = _usage(*usage, config["READINESS_MAX_POOL_USAGE"])
+    if checks.get("db_pool", {}).get("ok", True):
+        checks["database"] = database_check.result(
+            engine, config["READINESS_DB_CHECK_INTERVAL"]
+        )
+    else:
+        # a checkout would only wait for DB_POOL_TIMEOUT
+        checks["database"] = {"ok": False, "error": "pool exhausted"}
+    in_flight, capacity = queue_depth()
+    checks["password_queue"] = _usage(
+        in_flight, capacity, config["READINESS_MAX_PASSWORD_QUEUE"]
+    )
+    return all(check["ok"] for check in checks.values()), checks
+
+
+def readyz_view():
+    ready, checks = readiness()
+    response = json_response(
+        {"status": "ready" if ready else "unavailable", "checks": checks},
+        200 if ready else 503,
+    )
+    response.cache_control.no_store = True
+    return response
+
+
+def init_app(app):
+    app.wsgi_app = LivenessMiddleware(app.wsgi_app)
+    app.add_url_rule("/readyz", "readyz", readyz_view)
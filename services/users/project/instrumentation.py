@@ -0,0 +1,125 @@
+import time
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from project import metrics
+
+MAX_LOGGED_STATEMENTS = 50
+
+request_duration = metrics.Histogram(
+    "http_request_duration_seconds",
+    "Request latency by endpoint.",
+    labelnames=("endpoint", "method"),
+)
+requests_total = metrics.Counter(
+    "http_requests_total",
+    "Requests by endpoint and status code.",
+    labelnames=("endpoint", "method", "status"),
+)
+request_queries = metrics.Histogram(
+    "http_request_db_queries",
+    "SQL statements executed per request.",
+    labelnames=("endpoint",),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+request_db_time = metrics.Histogram(
+    "http_request_db_seconds",
+    "Time spent in SQL statements per request.",
+    labelnames=("endpoint",),
+)
+jwt_time = metrics.Histogram(
+    "jwt_seconds",
+    "Time spent encoding or decoding JWTs.",
+    labelnames=("operation",),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05),
+)
+
+
+def _tracking():
+    return has_app_context() and "sql_count" in g
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    if _tracking():
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    if _tracking() and conn.info.get("query_start"):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        g.sql_count += 1
+        g.sql_time += elapsed
+        if len(g.sql_statements) < MAX_LOGGED_STATEMENTS:
+            g.sql_statements.append((statement, elapsed))
+
+
+def record_jwt(operation, elapsed):
+    jwt_time.labels(operation).observe(elapsed)
+    if has_app_context():
+        g.jwt_time = g.get("jwt_time", 0.0) + elapsed
+
+
+def _start_request():
+    directory = current_app.config["METRICS_DIR"]
+    if directory:
+        metrics.start_writer(directory, current_app.config["METRICS_WRITE_INTERVAL"])
+    g.request_start = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+    g.sql_statements = []
+
+
+def _finish_request(response):
+    if "request_start" not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or "unmatched"
+    request_duration.labels(endpoint, request.method).observe(elapsed)
+    requests_total.labels(endpoint, request.method, str(response.status_code)).inc()
+    request_queries.labels(endpoint).observe(g.sql_count)
+    request_db_time.labels(endpoint).observe(g.sql_time)
+
+    threshold = current_app.config["SLOW_REQUEST_THRESHOLD"]
+    if threshold is not None and elapsed >= threshold:
+        statements = "".join(
+            f"\n  {seconds * 1000:.1f}ms {statement}"
+            for statement, seconds in g.sql_statements
+        )
+        current_app.logger.warning(
+            "Slow request %s %s: %.1fms total, %d queries in %.1fms, "
+            "password hashing %.1fms (queued %.1fms), jwt %.1fms%s",
+            request.method,
+            request.path,
+            elapsed * 1000,
+            g.sql_count,
+            g.sql_time * 1000,
+            g.get("password_hash_time", 0.0) * 1000,
+            g.get("password_queue_wait", 0.0) * 1000,
+            g.get("jwt_time", 0.0) * 1000,
+            statements,
+        )
+    return response
+
+
+def metrics_view():
+    metrics.collect()
+    directory = current_app.config["METRICS_DIR"]
+    if directory:
+        # this worker's own numbers are current; the others' are at most
+        # METRICS_WRITE_INTERVAL seconds old
+        metrics.write(directory)
+        body = metrics.render_directory(directory)
+    else:
+        body = metrics.render()
+    return current_app.response_class(body, mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -0,0 +1,444 @@
+"""Background jobs kept in the ``jobs`` table.
+
+``enqueue`` adds a job to the caller's transaction, so it only exists if the
+work that asked for it commits. ``manage.py worker`` runs a pool of threads
+that claim due jobs with ``SELECT ... FOR UPDATE SKIP LOCKED``: any number of
+worker processes share the table without handing out a job twice, and more
+can be started whenever the queues back up.
+
+A failed job is retried after an exponential backoff until it has run
+``max_attempts`` times. ``JOBS_QUEUES`` caps how many jobs of each queue run
+at once across every worker, which keeps heavy work such as bulk imports
+from starving the rest; on Postgres, claims from a capped queue take an
+advisory lock so the cap is not overshot by concurrent workers. A job whose
+worker died is handed out again once it has been running for
+``JOBS_LEASE`` seconds, so task functions must be safe to run twice.
+Periodic tasks, such as pruning expired token revocations, are enqueued by
+the workers themselves, so they need no cron entry. One of them deletes jobs
+that finished more than ``JOBS_RETENTION_DAYS`` ago.
+"""
+import datetime
+import logging
+import random
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.sql import func
+from sqlalchemy.sql.schema import Column, Index
+from sqlalchemy.sql.sqltypes import JSON, BigInteger, DateTime, Integer, String, Text
+
+from project import db, metrics
+
+logger = logging.getLogger(__name__)
+
+job_results = metrics.Counter(
+    "jobs_total", "Background jobs run, by outcome.", ("queue", "result")
+)
+job_duration = metrics.Histogram(
+    "job_duration_seconds", "Time spent running background jobs.", ("queue",)
+)
+jobs_queued = metrics.Gauge(
+    "jobs_queued", "Jobs waiting to run, due or scheduled, by queue.", ("queue",)
+)
+jobs_running = metrics.Gauge("jobs_running", "Jobs being run, by queue.", ("queue",))
+jobs_lag = metrics.Gauge(
+    "jobs_oldest_due_seconds",
+    "How long the oldest due job of each queue has been waiting.",
+    ("queue",),
+)
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class Job(db.Model):
+    __tablename__ = "jobs"
+
+    id = Column(
+        BigInteger().with_variant(Integer, "sqlite"),
+        primary_key=True,
+        autoincrement=True,
+    )
+    queue = Column(String(64), nullable=False)
+    name = Column(String(128), nullable=False)
+    args = Column(JSON, nullable=True)
+    status = Column(String(16), default=QUEUED, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, nullable=False)
+    # not claimed before this time; retries push it back. Every timestamp
+    # here is UTC, compared with utcnow() by claims, leases and the prune.
+    run_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    locked_at = Column(DateTime, nullable=True)
+    locked_by = Column(String(128), nullable=True)
+    result = Column(JSON, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index(
+            "ix_jobs_due",
+            queue,
+            run_at,
+            postgresql_where=status == QUEUED,
+            sqlite_where=status == QUEUED,
+        ),
+        Index(
+            "ix_jobs_running",
+            queue,
+            locked_at,
+            postgresql_where=status == RUNNING,
+            sqlite_where=status == RUNNING,
+        ),
+        # the periodic scheduler's lookups by name, and the prune
+        Index("ix_jobs_name_run_at", name, run_at),
+        Index("ix_jobs_finished_at", finished_at),
+    )
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "queue": self.queue,
+            "name": self.name,
+            "status": self.status,
+            "attempts": self.attempts,
+            "result": self.result,
+            "error": self.last_error,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at and self.finished_at.isoformat(),
+        }
+
+
+class Task:
+    def __init__(self, name, func, queue, max_attempts, sensitive, cleanup, every):
+        self.name = name
+        self.func = func
+        self.queue = queue
+        self.max_attempts = max_attempts
+        self.sensitive = sensitive
+        self.cleanup = cleanup
+        self.every = every
+
+
+tasks = {}
+
+
+def task(
+    name, queue="default", max_attempts=None, sensitive=False, cleanup=None, every=None
+):
+    """Registers the decorated function as the job ``name``.
+
+    It is called with the job's args as keyword arguments and whatever it
+    returns, if JSON-serializable, is kept as the job's result. The args of
+    a ``sensitive`` task are cleared once it is done or has failed for good,
+    and ``cleanup``, if given, is then called with them to release anything
+    they point to. ``every`` names the config key holding the seconds between
+    runs of a periodic task, which ``schedule_periodic`` enqueues without
+    args; a falsy setting turns it off.
+    """
+
+    def decorator(f):
+        tasks[name] = Task(name, f, queue, max_attempts, sensitive, cleanup, every)
+        return f
+
+    return decorator
+
+
+def enqueue(name, args=None, delay=None, run_at=None):
+    """Adds the job ``name`` to the current transaction and returns it.
+
+    It runs once the transaction commits and ``run_at`` (or ``delay``
+    seconds from now) has passed.
+    """
+    registered = tasks[name]
+    if run_at is None:
+        # the same clock claim() compares against
+        run_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay or 0)
+    job = Job(
+        queue=registered.queue,
+        name=name,
+        args=args or {},
+        max_attempts=registered.max_attempts or current_app.config["JOBS_MAX_ATTEMPTS"],
+        run_at=run_at,
+    )
+    db.session.add(job)
+    return job
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying a job that has failed ``attempts``
+    times: doubling from ``JOBS_RETRY_BASE`` up to ``JOBS_RETRY_MAX``, with
+    jitter so jobs that failed together do not retry together."""
+    config = current_app.config
+    delay = min(
+        config["JOBS_RETRY_BASE"] * 2 ** (attempts - 1), config["JOBS_RETRY_MAX"]
+    )
+    return delay * random.uniform(0.5, 1.0)
+
+
+def claim(queue, worker_id, now=None):
+    """Marks the next due job in ``queue`` as running for ``worker_id`` and
+    returns it, or returns None when nothing is due or the queue is at its
+    limit."""
+    now = now or datetime.datetime.utcnow()
+    limit = current_app.config["JOBS_QUEUES"].get(queue)
+    if limit:
+        if db.engine.dialect.name == "postgresql":
+            # held until commit: claims from this queue go one at a time
+            db.session.execute(
+                text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+                {"key": f"jobs:{queue}"},
+            )
+        running = Job.query.filter(Job.queue == queue, Job.status == RUNNING).count()
+        if running >= limit:
+            db.session.commit()
+            return None
+    job = (
+        Job.query.filter(Job.queue == queue, Job.status == QUEUED, Job.run_at <= now)
+        .order_by(Job.run_at, Job.id)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if job is not None:
+        job.status = RUNNING
+        job.attempts += 1
+        job.locked_at = now
+        job.locked_by = worker_id
+    db.session.commit()
+    return job
+
+
+def _cleanup(name, args):
+    registered = tasks.get(name)
+    if registered is None or registered.cleanup is None or args is None:
+        return
+    try:
+        registered.cleanup(**args)
+    except Exception:
+        logger.exception("Cleaning up after job %s failed", name)
+
+
+def _finish(job_id, worker_id, values):
+    # a worker that overran its lease no longer owns the job
+    Job.query.filter(Job.id == job_id, Job.locked_by == worker_id).update(
+        dict(values, locked_at=None, locked_by=None), synchronize_session=False
+    )
+    db.session.commit()
+
+
+def run(job, worker_id):
+    """Runs a claimed job and records how it went."""
+    job_id, queue, name, args = job.id, job.queue, job.name, job.args
+    attempts, max_attempts = job.attempts, job.max_attempts
+    registered = tasks.get(name)
+    start = time.perf_counter()
+    try:
+        if registered is None:
+            raise LookupError(f"Unknown job {name!r}")
+        result = registered.func(**args)
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc()
+        logger.warning("Job %s (%s) failed on attempt %s", job_id, name, attempts)
+        now = datetime.datetime.utcnow()
+        if attempts < max_attempts and registered is not None:
+            outcome = "retried"
+            values = {
+                "status": QUEUED,
+                "run_at": now + datetime.timedelta(seconds=backoff(attempts)),
+                "last_error": error,
+            }
+        else:
+            outcome = "failed"
+            values = {"status": FAILED, "finished_at": now, "last_error": error}
+            if registered is not None and registered.sensitive:
+                values["args"] = None
+    else:
+        outcome = "done"
+        values = {
+            "status": DONE,
+            "result": result,
+            "finished_at": datetime.datetime.utcnow(),
+        }
+        if registered.sensitive:
+            values["args"] = None
+    job_duration.labels(queue).observe(time.perf_counter() - start)
+    _finish(job_id, worker_id, values)
+    if outcome != "retried":
+        _cleanup(name, args)
+    job_results.labels(queue, outcome).inc()
+    return outcome
+
+
+def requeue_expired(lease, now=None):
+    """Hands jobs that have been running longer than ``lease`` seconds back
+    to the queue, or fails them if that was their last attempt, and returns
+    how many there were."""
+    now = now or datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(seconds=lease)
+    expired = (Job.status == RUNNING, Job.locked_at < cutoff)
+    values = {"locked_at": None, "locked_by": None, "last_error": "lease expired"}
+    retried = Job.query.filter(*expired, Job.attempts < Job.max_attempts).update(
+        dict(values, status=QUEUED, run_at=now), synchronize_session=False
+    )
+    # the rest were on their last attempt
+    ended = db.session.query(Job.name, Job.args).filter(*expired).all()
+    sensitive = [name for name, registered in tasks.items() if registered.sensitive]
+    Job.query.filter(*expired, Job.name.in_(sensitive)).update(
+        {"args": None}, synchronize_session=False
+    )
+    failed = Job.query.filter(*expired).update(
+        dict(values, status=FAILED, finished_at=now), synchronize_session=False
+    )
+    db.session.commit()
+    for name, args in ended:
+        _cleanup(name, args)
+    return retried + failed
+
+
+def schedule_periodic(now=None):
+    """Enqueues the next run of each periodic task that has no job queued or
+    running, ``every`` seconds after its last run was due, and returns the
+    jobs added."""
+    now = now or datetime.datetime.utcnow()
+    config = current_app.config
+    periodic = [t for t in tasks.values() if t.every and config.get(t.every)]
+    if not periodic:
+        return []
+    if db.engine.dialect.name == "postgresql":
+        # held until commit: workers checking at once schedule a task once
+        db.session.execute(
+            text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+            {"key": "jobs:schedule"},
+        )
+    scheduled = []
+    for registered in periodic:
+        pending = db.session.query(Job.id).filter(
+            Job.name == registered.name, Job.status.in_((QUEUED, RUNNING))
+        )
+        if pending.first() is not None:
+            continue
+        last = (
+            db.session.query(func.max(Job.run_at))
+            .filter(Job.name == registered.name)
+            .scalar()
+        )
+        run_at = now
+        if last is not None:
+            run_at = last + datetime.timedelta(seconds=config[registered.every])
+        scheduled.append(enqueue(registered.name, run_at=run_at))
+    db.session.commit()
+    return scheduled
+
+
+def prune_finished(before):
+    """Deletes jobs that were done, or failed for good, before ``before`` and
+    returns how many there were."""
+    pruned = Job.query.filter(
+        Job.status.in_((DONE, FAILED)), Job.finished_at < before
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return pruned
+
+
+PRUNE_JOBS = "jobs.prune"
+
+
+@task(PRUNE_JOBS, every="JOBS_PRUNE_INTERVAL")
+def prune_jobs():
+    """Deletes jobs finished more than ``JOBS_RETENTION_DAYS`` ago, every
+    ``JOBS_PRUNE_INTERVAL`` seconds."""
+    days = current_app.config["JOBS_RETENTION_DAYS"]
+    before = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    return {"pruned": prune_finished(before)}
+
+
+@metrics.collector
+@db.use_replica()
+def _collect_queue_metrics():
+    # Read from the table rather than the workers, which may run anywhere.
+    # Only queued and running jobs are counted, over the partial indexes.
+    now = datetime.datetime.utcnow()
+    counts = (
+        db.session.query(Job.queue, Job.status, func.count(), func.min(Job.run_at))
+        .filter(Job.status.in_((QUEUED, RUNNING)))
+        .group_by(Job.queue, Job.status)
+    )
+    for gauge in (jobs_queued, jobs_running, jobs_lag):
+        gauge.clear()
+        for queue in current_app.config["JOBS_QUEUES"]:
+            gauge.labels(queue).set(0)
+    for queue, status, count, oldest in counts:
+        if status == RUNNING:
+            jobs_running.labels(queue).set(count)
+            continue
+        jobs_queued.labels(queue).set(count)
+        lag = (now - oldest).total_seconds()
+        jobs_lag.labels(queue).set(max(lag, 0))
+
+
+class Worker:
+    """``threads`` threads taking turns over ``queues``, one job at a time."""
+
+    def __init__(self, app, queues, threads):
+        self.app = app
+        self.queues = list(queues)
+        self.id = f"{socket.gethostname()}:{uuid.uuid4().hex[:8]}"
+        self._stopping = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._loop, args=(i,), name=f"job-worker-{i}")
+            for i in range(threads)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def wait(self):
+        for thread in self._threads:
+            thread.join()
+
+    def stop(self, timeout=None):
+        """Lets running jobs finish, then joins the threads."""
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def work(self, offset=0):
+        """Claims and runs one job, starting with the queue at ``offset``,
+        and returns its outcome or None if no queue had one."""
+        for i in range(len(self.queues)):
+            queue = self.queues[(offset + i) % len(self.queues)]
+            job = claim(queue, self.id)
+            if job is not None:
+                return run(job, self.id)
+        return None
+
+    def _loop(self, index):
+        config = self.app.config
+        checked = 0.0
+        turn = index
+        with self.app.app_context():
+            while not self._stopping.is_set():
+                try:
+                    if (
+                        index == 0
+                        and time.monotonic() - checked > config["JOBS_LEASE"] / 10
+                    ):
+                        requeue_expired(config["JOBS_LEASE"])
+                        schedule_periodic()
+                        checked = time.monotonic()
+                    outcome = self.work(turn)
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Job worker %s failed", self.id)
+                    outcome = None
+                finally:
+                    db.session.remove()
+                turn += 1
+                if outcome is None:
+                    self._stopping.wait(config["JOBS_POLL_INTERVAL"])
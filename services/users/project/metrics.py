@@ -0,0 +1,300 @@
+"""Metrics rendered in the Prometheus text format.
+
+Every process keeps its own registry. With ``METRICS_DIR`` set, each one
+also saves its registry to ``<pid>.json`` in that directory every
+``METRICS_WRITE_INTERVAL`` seconds, and ``/metrics`` serves the sum over
+every file there: a scrape then covers all gunicorn workers, and any job
+worker or relay sharing the directory, whichever worker answers it. Files of
+exited processes are kept so counters never go backwards; clear the
+directory when the service starts.
+
+Gauges hold values read from the database when ``/metrics`` is served, by
+functions registered with ``collector``. They are the same for every
+process, so they are neither saved nor summed.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+registry = {}
+
+
+def _escape(value):
+    # label values may hold a backslash, double quote or newline, which the
+    # text format needs escaped
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), _register=True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if _register:
+            registry[name] = self
+
+    def labels(self, *values):
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._new_child()
+                self._children[values] = child
+            return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def clear(self):
+        """Drops every labelled series, for gauges whose label sets change."""
+        with self._lock:
+            self._children.clear()
+
+    def _all(self):
+        if not self.labelnames:
+            return [((), self)]
+        with self._lock:
+            return list(self._children.items())
+
+    def dump(self):
+        return {
+            "kind": self.kind,
+            "documentation": self.documentation,
+            "labelnames": list(self.labelnames),
+            "series": [[list(values), child._state()] for values, child in self._all()],
+        }
+
+    def merge(self, dump):
+        """Adds the series of another process's ``dump`` of this metric."""
+        for values, state in dump["series"]:
+            target = self.labels(*values) if self.labelnames else self
+            target._add(state)
+
+    def _series(self):
+        if not self.labelnames:
+            return [("", self)]
+        return [
+            (
+                ",".join(
+                    f'{n}="{_escape(v)}"' for n, v in zip(self.labelnames, values)
+                ),
+                child,
+            )
+            for values, child in sorted(self._children.items())
+        ]
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for labels, series in self._series():
+            lines.extend(series._samples(self.name, labels))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=(), _register=True):
+        super().__init__(name, documentation, labelnames, _register)
+        self.value = 0
+
+    def _new_child(self):
+        return Counter(self.name, self.documentation, _register=False)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def _state(self):
+        return self.value
+
+    def _add(self, state):
+        self.inc(state)
+
+    def _samples(self, name, labels):
+        return [
+            f"{name}{{{labels}}} {self.value}" if labels else f"{name} {self.value}"
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def _new_child(self):
+        return Gauge(self.name, self.documentation, _register=False)
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name,
+        documentation,
+        labelnames=(),
+        buckets=DEFAULT_BUCKETS,
+        _register=True,
+    ):
+        super().__init__(name, documentation, labelnames, _register)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def _new_child(self):
+        return Histogram(
+            self.name, self.documentation, buckets=self.buckets, _register=False
+        )
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+
+    def dump(self):
+        return dict(super().dump(), buckets=list(self.buckets))
+
+    def _state(self):
+        with self._lock:
+            return [list(self.counts), self.count, self.sum]
+
+    def _add(self, state):
+        counts, count, total = state
+        with self._lock:
+            self.counts = [a + b for a, b in zip(self.counts, counts)]
+            self.count += count
+            self.sum += total
+
+    def _samples(self, name, labels):
+        prefix = labels + "," if labels else ""
+        lines = [
+            f'{name}_bucket{{{prefix}le="{bound}"}} {count}'
+            for bound, count in zip(self.buckets, self.counts)
+        ]
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+
+def _render(metrics):
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _gauges():
+    return [metric for metric in registry.values() if metric.kind == Gauge.kind]
+
+
+collectors = []
+
+
+def collector(func):
+    """Registers ``func`` to refresh gauges each time metrics are served."""
+    collectors.append(func)
+    return func
+
+
+def collect():
+    for func in collectors:
+        try:
+            func()
+        except Exception:
+            logger.exception("Metrics collector %s failed", func.__name__)
+
+
+def render():
+    return _render(registry.values())
+
+
+def write(directory):
+    """Saves this process's registry, gauges aside, to ``directory``."""
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    dumps = {
+        name: metric.dump()
+        for name, metric in registry.items()
+        if metric.kind != Gauge.kind
+    }
+    # written aside and renamed, so readers never see half a file
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(dumps, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _from_dump(name, dump):
+    if dump["kind"] == Histogram.kind:
+        return Histogram(
+            name,
+            dump["documentation"],
+            dump["labelnames"],
+            buckets=dump["buckets"],
+            _register=False,
+        )
+    return Counter(name, dump["documentation"], dump["labelnames"], _register=False)
+
+
+def render_directory(directory):
+    """Renders the sum of every registry saved to ``directory``, and this
+    process's gauges."""
+    merged = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        try:
+            with open(path) as f:
+                dumps = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, dump in dumps.items():
+            if name not in merged:
+                merged[name] = _from_dump(name, dump)
+            merged[name].merge(dump)
+    return _render(list(merged.values()) + _gauges())
+
+
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def start_writer(directory, interval):
+    """Saves this process's registry to ``directory`` every ``interval``
+    seconds, and once more at exit; does nothing if this process already
+    does. Threads do not survive a fork, so forked workers start their own."""
+    global _writer_pid
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return
+        _writer_pid = os.getpid()
+    os.makedirs(directory, exist_ok=True)
+
+    def loop():
+        while True:
+            try:
+                write(directory)
+            except OSError:
+                logger.exception("Could not save metrics to %s", directory)
+            time.sleep(interval)
+
+    threading.Thread(target=loop, name="metrics-writer", daemon=True).start()
+    atexit.register(write, directory)
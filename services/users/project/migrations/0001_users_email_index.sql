@@ -0,0 +1,8 @@
+-- Case-insensitive unique index backing email lookups and duplicate checks,
+-- plus the created_date index used by the admin default sort.
+--
+-- The unique index fails to build if existing rows collide on lower(email);
+-- find them with:
+--   SELECT lower(email), count(*) FROM users GROUP BY 1 HAVING count(*) > 1;
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_users_email_lower ON users (lower(email));
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_created_date ON users (created_date);
@@ -0,0 +1,13 @@
+-- Indexes behind GET /users sorting and search, and the admin search.
+--
+-- (username, id) and (email, id) serve keyset pages sorted by those columns.
+-- lower(...) text_pattern_ops serves case-insensitive prefix matches whatever
+-- the database collation; the pg_trgm GIN indexes serve substring and ILIKE
+-- matches. Creating the extension needs a role allowed to do so.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_id ON users (username, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_email_id ON users (email, id);
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_prefix ON users (lower(username) text_pattern_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_email_prefix ON users (lower(email) text_pattern_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_trgm ON users USING gin (username gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_email_trgm ON users USING gin (email gin_trgm_ops);
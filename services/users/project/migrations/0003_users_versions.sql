@@ -0,0 +1,8 @@
+-- Row versions behind the ETags on GET /users/<id>, and the change_counters
+-- table for named counters such as how far user_events has been pruned. The
+-- non-volatile default keeps the ADD COLUMN metadata-only on Postgres 11+.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+CREATE TABLE IF NOT EXISTS change_counters (
+    name VARCHAR(64) PRIMARY KEY,
+    value BIGINT NOT NULL DEFAULT 0
+);
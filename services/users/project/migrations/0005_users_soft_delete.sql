@@ -0,0 +1,15 @@
+-- Soft delete: DELETE /users/<id> sets deleted_at and "manage.py purge_users"
+-- removes the row later. API reads filter on deleted_at IS NULL, so their
+-- indexes become partial, and the unique email index only covers live users
+-- so a deleted user's email can register again. The new indexes are built
+-- before the ones they replace are dropped.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_users_live_email_lower ON users (lower(email)) WHERE deleted_at IS NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_live_id ON users (id) WHERE deleted_at IS NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_live_created_date_id ON users (created_date, id) WHERE deleted_at IS NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_live_username_id ON users (username, id) WHERE deleted_at IS NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_live_email_id ON users (email, id) WHERE deleted_at IS NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_deleted_at ON users (deleted_at) WHERE deleted_at IS NOT NULL;
+DROP INDEX CONCURRENTLY IF EXISTS ix_users_email_lower;
+DROP INDEX CONCURRENTLY IF EXISTS ix_users_username_id;
+DROP INDEX CONCURRENTLY IF EXISTS ix_users_email_id;
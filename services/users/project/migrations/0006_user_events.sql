@@ -0,0 +1,15 @@
+-- Outbox of user changes: add_user, update_user and delete_user write an
+-- event in the same transaction, "manage.py relay_events" publishes them and
+-- GET /users/changes serves them by seq. "manage.py prune_events" deletes
+-- old published events and records how far it got in change_counters.
+CREATE TABLE IF NOT EXISTS user_events (
+    seq BIGSERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    type VARCHAR(16) NOT NULL,
+    data JSON NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT now(),
+    published_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS ix_user_events_unpublished ON user_events (seq) WHERE published_at IS NULL;
+CREATE INDEX IF NOT EXISTS ix_user_events_created_at ON user_events (created_at);
+INSERT INTO change_counters (name, value) VALUES ('user_events_pruned', 0) ON CONFLICT (name) DO NOTHING;
@@ -0,0 +1,21 @@
+-- Background jobs run by "manage.py worker". Workers claim due jobs through
+-- ix_jobs_due with FOR UPDATE SKIP LOCKED; ix_jobs_running serves the
+-- per-queue concurrency caps and the search for jobs whose lease expired.
+CREATE TABLE IF NOT EXISTS jobs (
+    id BIGSERIAL PRIMARY KEY,
+    queue VARCHAR(64) NOT NULL,
+    name VARCHAR(128) NOT NULL,
+    args JSON,
+    status VARCHAR(16) NOT NULL,
+    attempts INTEGER NOT NULL,
+    max_attempts INTEGER NOT NULL,
+    run_at TIMESTAMP NOT NULL DEFAULT now(),
+    locked_at TIMESTAMP,
+    locked_by VARCHAR(128),
+    result JSON,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT now(),
+    finished_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_due ON jobs (queue, run_at) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS ix_jobs_running ON jobs (queue, locked_at) WHERE status = 'running';
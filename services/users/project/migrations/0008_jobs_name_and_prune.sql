@@ -0,0 +1,5 @@
+-- Finished jobs are pruned after JOBS_RETENTION_DAYS by a periodic job that
+-- finds them through ix_jobs_finished_at. The scheduler looks up each
+-- periodic task's pending and latest jobs through ix_jobs_name_run_at.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_jobs_name_run_at ON jobs (name, run_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_jobs_finished_at ON jobs (finished_at);
@@ -0,0 +1,4 @@
+-- user_events.created_at is compared with UTC times by the relay lag metric
+-- and prune_events. now() gives the session's local time, which only matches
+-- when the TimeZone setting is UTC, so default to the UTC time instead.
+ALTER TABLE user_events ALTER COLUMN created_at SET DEFAULT timezone('utc', now());
@@ -0,0 +1,4 @@
+-- Job timestamps are UTC, set from utcnow() by the workers. now() gives the
+-- session's local time, so default to the UTC time instead.
+ALTER TABLE jobs ALTER COLUMN run_at SET DEFAULT timezone('utc', now());
+ALTER TABLE jobs ALTER COLUMN created_at SET DEFAULT timezone('utc', now());
@@ -0,0 +1,93 @@
+import os
+import re
+
+from sqlalchemy import text
+
+MIGRATIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CREATE_VERSIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version VARCHAR(255) PRIMARY KEY,
+    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+CONCURRENT_INDEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)",
+    re.IGNORECASE,
+)
+
+INDEX_IS_INVALID = """
+SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)
+"""
+
+
+def available_migrations():
+    """Returns ``(version, path)`` pairs for every SQL migration, oldest first."""
+    return [
+        (name[: -len(".sql")], os.path.join(MIGRATIONS_DIR, name))
+        for name in sorted(os.listdir(MIGRATIONS_DIR))
+        if name.endswith(".sql")
+    ]
+
+
+def applied_versions(engine):
+    engine.execute(text(CREATE_VERSIONS_TABLE))
+    rows = engine.execute(text("SELECT version FROM schema_migrations"))
+    return {row[0] for row in rows}
+
+
+def split_statements(sql):
+    # Migrations are plain DDL: no semicolons inside literals or function bodies.
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [stmt.strip() for stmt in "\n".join(lines).split(";") if stmt.strip()]
+
+
+def drop_invalid_index(conn, statement):
+    """Drops the index ``statement`` creates concurrently if an interrupted
+    earlier build left it invalid, which ``IF NOT EXISTS`` would skip."""
+    match = CONCURRENT_INDEX.match(statement)
+    if match is None or conn.dialect.name != "postgresql":
+        return
+    name = match.group(1)
+    if conn.execute(text(INDEX_IS_INVALID), name=name).scalar():
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+
+def upgrade(engine):
+    """Applies pending migrations and returns the versions that were run.
+
+    Each statement runs in autocommit mode so that ``CREATE INDEX
+    CONCURRENTLY`` can build indexes without locking writes; migrations are
+    written to be idempotent in case one is interrupted halfway. A concurrent
+    build cut short leaves an invalid index, which is dropped and built again.
+    """
+    done = applied_versions(engine)
+    ran = []
+    for version, path in available_migrations():
+        if version in done:
+            continue
+        with open(path) as f:
+            statements = split_statements(f.read())
+        with engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            for statement in statements:
+                drop_invalid_index(conn, statement)
+                conn.execute(text(statement))
+            conn.execute(
+                text("INSERT INTO schema_migrations (version) VALUES (:version)"),
+                version=version,
+            )
+        ran.append(version)
+    return ran
+
+
+def stamp(engine):
+    """Marks every migration as applied, for schemas built by ``create_all``."""
+    done = applied_versions(engine)
+    for version, _ in available_migrations():
+        if version not in done:
+            engine.execute(
+                text("INSERT INTO schema_migrations (version) VALUES (:version)"),
+                version=version,
+            )
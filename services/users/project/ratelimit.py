@@ -0,0 +1,160 @@
+"""Sliding-window rate limits.
+
+Each limit counts hits in fixed windows and weighs the previous window by how
+much of it still overlaps the sliding one, which keeps two counters per key
+instead of a timestamp per hit. Counters live in a per-process store by
+default; the ``redis`` store shares them between workers and hosts.
+
+Limits are checked by ``limit`` decorators before the view runs, so rejected
+requests never reach the database or bcrypt.
+"""
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g
+from werkzeug.exceptions import TooManyRequests
+
+from project import metrics
+from project.cache import LRUCache
+from project.utils import client_ip
+
+rejections = metrics.Counter(
+    "ratelimit_rejections_total", "Requests rejected by a rate limit.", ("limit",)
+)
+
+
+class RateLimited(TooManyRequests):
+    description = "Too many requests. Please try again later."
+
+
+class MemoryStore:
+    def __init__(self, maxsize):
+        self._counts = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._counts.get(key, 0)
+
+    def incr(self, key, ttl):
+        with self._lock:
+            count = self._counts.get(key, 0) + 1
+            self._counts.set(key, count, time.time() + ttl)
+            return count
+
+
+class RedisStore:
+    def __init__(self, client, prefix=""):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, prefix=""):
+        import redis
+
+        return cls(redis.Redis.from_url(url), prefix)
+
+    def get(self, key):
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def incr(self, key, ttl):
+        pipe = self.client.pipeline()
+        pipe.incr(self.prefix + key)
+        pipe.expire(self.prefix + key, int(math.ceil(ttl)))
+        return pipe.execute()[0]
+
+
+def create_store(kind, url=None, maxsize=None, prefix=""):
+    if kind == "memory":
+        return MemoryStore(maxsize)
+    if kind == "redis":
+        return RedisStore.from_url(url, prefix)
+    raise ValueError(f"Unknown rate limit store {kind!r}")
+
+
+def _store():
+    config = current_app.config
+    key = (config["RATELIMIT_STORE"], config["RATELIMIT_URL"])
+    cached = current_app.extensions.get("ratelimit")
+    if cached is None or cached[0] != key:
+        store = create_store(
+            config["RATELIMIT_STORE"],
+            config["RATELIMIT_URL"],
+            config["RATELIMIT_SIZE"],
+            prefix="ratelimit:",
+        )
+        cached = current_app.extensions["ratelimit"] = (key, store)
+    return cached[1]
+
+
+def hit(name, key, limit, period, now=None):
+    """Counts a hit against ``limit`` per ``period`` seconds.
+
+    Returns ``(allowed, remaining, reset)``, where ``reset`` is the number of
+    seconds until a rejected caller may try again, or until the current
+    window ends. Rejected hits are not counted.
+    """
+    store = _store()
+    now = time.time() if now is None else now
+    window = int(now // period)
+    elapsed = now / period - window
+    current_key = f"{name}:{key}:{window}"
+    previous = store.get(f"{name}:{key}:{window - 1}")
+    current = store.get(current_key)
+    weighted = previous * (1 - elapsed) + current
+    if weighted >= limit:
+        # wait for enough of the previous window to slide out
+        if previous and current < limit:
+            wait = (1 - elapsed) - (limit - current) / previous
+            reset = max(wait, 0) * period
+        else:
+            reset = (1 - elapsed) * period
+        return False, 0, int(math.ceil(round(reset, 3))) or 1
+    current = store.incr(current_key, period * 2)
+    remaining = max(int(limit - previous * (1 - elapsed) - current), 0)
+    return True, remaining, int(math.ceil(round((1 - elapsed) * period, 3)))
+
+
+def limit(name, setting, key=client_ip):
+    """Applies the ``(limit, period)`` in config ``setting`` per ``key()``.
+
+    ``key`` returns the value to count by, or None to skip the limit for
+    this request.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if current_app.config["RATELIMIT_ENABLED"]:
+                value = key()
+                if value is not None:
+                    count, period = current_app.config[setting]
+                    allowed, remaining, reset = hit(name, value, count, period)
+                    state = g.get("ratelimit")
+                    if not allowed or state is None or remaining < state[1]:
+                        g.ratelimit = (count, remaining, reset)
+                    if not allowed:
+                        rejections.labels(name).inc()
+                        raise RateLimited()
+            return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def add_headers(response):
+    state = g.get("ratelimit")
+    if state is not None:
+        count, remaining, reset = state
+        response.headers["RateLimit-Limit"] = str(count)
+        response.headers["RateLimit-Remaining"] = str(remaining)
+        response.headers["RateLimit-Reset"] = str(reset)
+        if response.status_code == 429:
+            response.headers["Retry-After"] = str(reset)
+    return response
+
+
+def init_app(app):
+    app.after_request(add_headers)
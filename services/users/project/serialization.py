@@ -0,0 +1,129 @@
+"""Compiled serializers for flask-restplus models.
+
+``marshal`` walks every field of the model for every object and formats each
+value through the field class. ``Serializer`` does that walk once per model:
+it precomputes an accessor and a formatter per field, short-circuiting values
+that already have the right type, so the restplus model (and its Swagger
+schema) stays the single definition of the response shape.
+
+Bodies are encoded with ``orjson`` when it is installed and the stdlib
+``json`` module otherwise.
+"""
+import datetime
+import json
+from operator import attrgetter
+
+from flask import current_app
+from flask_restplus import fields
+
+try:
+    import orjson
+except ImportError:  # optional: pip install orjson
+    orjson = None
+
+
+def _passthrough(kind, field):
+    def format(value):
+        return value if type(value) is kind else field.format(value)
+
+    return format
+
+
+def _format_datetime(field):
+    def format(value):
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        return field.format(value)
+
+    return format
+
+
+def _formatter(field):
+    """Returns ``format(value)`` for a non-None value, or None when the field
+    needs the generic ``field.output`` path."""
+    if field.mask is not None or callable(field.attribute):
+        return None
+    if isinstance(field, fields.Nested) or isinstance(field, fields.List):
+        return None
+    if isinstance(field, fields.DateTime):
+        if field.dt_format != "iso8601":
+            return field.format
+        return _format_datetime(field)
+    if isinstance(field, fields.Boolean):
+        return _passthrough(bool, field)
+    if isinstance(field, fields.Integer):
+        return _passthrough(int, field)
+    if isinstance(field, fields.Float):
+        return _passthrough(float, field)
+    if isinstance(field, fields.String):
+        return _passthrough(str, field)
+    if type(field) is fields.Raw:
+        return field.format
+    return None
+
+
+class Serializer:
+    """Turns objects, dicts or row tuples into dicts shaped like ``model``,
+    matching ``marshal(obj, model)`` for the field types it compiles."""
+
+    def __init__(self, model):
+        self.model = model
+        self._fields = []
+        for name, field in getattr(model, "resolved", model).items():
+            if isinstance(field, type):
+                field = field()
+            attribute = field.attribute or name
+            default = field.default
+            if callable(default) or default:
+                formatter = None
+            else:
+                formatter = _formatter(field)
+            self._fields.append((name, attribute, field, formatter, default))
+        self.columns = tuple(
+            attribute for _, attribute, _, formatter, _ in self._fields if formatter
+        )
+        self._getter = attrgetter(*self.columns) if self.columns else None
+
+    def __call__(self, obj):
+        if isinstance(obj, dict):
+            values = [obj.get(attribute) for attribute in self.columns]
+        elif len(self.columns) == 1:
+            values = [self._getter(obj)]
+        elif self.columns:
+            values = self._getter(obj)
+        else:
+            values = ()
+        values = iter(values)
+        data = {}
+        for name, attribute, field, formatter, default in self._fields:
+            if formatter is None:
+                data[name] = field.output(name, obj)
+                continue
+            value = next(values)
+            data[name] = default if value is None else formatter(value)
+        return data
+
+    def many(self, objs):
+        return [self(obj) for obj in objs]
+
+    def only(self, names):
+        """Returns a serializer for just the model fields in ``names``, in
+        model order; its ``columns`` are the only ones it reads."""
+        fields = getattr(self.model, "resolved", self.model)
+        return Serializer(
+            {name: field for name, field in fields.items() if name in names}
+        )
+
+
+def dumps(data):
+    """Encodes ``data`` as compact JSON bytes ending in a newline."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(data, separators=(",", ":")).encode() + b"\n"
+
+
+def json_response(data, status=200, headers=None):
+    """Builds the response directly, bypassing restplus' representations."""
+    return current_app.response_class(
+        dumps(data), status=status, headers=headers, mimetype="application/json"
+    )
@@ -20,6 +20,13 @@ def test_database():
     db.drop_all()
 
 
+@pytest.fixture(scope="function")
+def clean_users(test_app, test_database):
+    """Starts the test with no users, for tests that reuse an email."""
+    test_database.session.query(User).delete()
+    test_database.session.commit()
+
+
 @pytest.fixture(scope="function")
 def add_user():
     def _add_user(username, email, password):
@@ -29,3 +36,43 @@ def add_user():
         return user
 
     return _add_user
+
+
+class FakeRedis:
+    """Just enough of the redis client for the redis backends and stores."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode()
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.results = []
+
+    def incr(self, key):
+        self.redis.data[key] = self.redis.data.get(key, 0) + 1
+        self.results.append(self.redis.data[key])
+
+    def expire(self, key, seconds):
+        self.results.append(True)
+
+    def execute(self):
+        return self.results
+
+
+@pytest.fixture(scope="function")
+def fake_redis():
+    return FakeRedis()
@@ -0,0 +1,102 @@
+import json
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+
+from project import health, metrics
+
+
+def test_livez(test_app):
+    client = test_app.test_client()
+    requests = metrics.registry["http_requests_total"]
+    before = sum(child.value for child in requests._children.values())
+    resp = client.get("/livez")
+    assert resp.status_code == 200
+    assert resp.data == b"ok\n"
+    assert resp.headers["Cache-Control"] == "no-store"
+    resp = client.head("/livez")
+    assert resp.status_code == 200
+    assert resp.data == b""
+    # answered before Flask, so not even counted
+    assert sum(child.value for child in requests._children.values()) == before
+
+
+def test_livez_passes_other_requests_through(test_app):
+    client = test_app.test_client()
+    assert client.post("/livez").status_code == 404
+    assert client.get("/livez/").status_code == 404
+
+
+def test_pool_usage():
+    engine = create_engine(
+        "sqlite://", poolclass=QueuePool, pool_size=1, max_overflow=2
+    )
+    assert health.pool_usage(engine) == (0, 3)
+    with engine.connect():
+        assert health.pool_usage(engine) == (1, 3)
+    assert health.pool_usage(create_engine("sqlite://")) is None
+
+
+def test_readyz(test_app, monkeypatch):
+    monkeypatch.setattr(health, "database_check", health.DatabaseCheck())
+    client = test_app.test_client()
+    resp = client.get("/readyz")
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 200
+    assert resp.headers["Cache-Control"] == "no-store"
+    assert data["status"] == "ready"
+    assert data["checks"]["database"]["ok"]
+    assert data["checks"]["password_queue"]["ok"]
+
+
+def test_readyz_caches_database_check(test_app, monkeypatch):
+    monkeypatch.setattr(health, "database_check", health.DatabaseCheck())
+    calls = []
+
+    def ping(engine):
+        calls.append(engine)
+        return 0.001
+
+    monkeypatch.setattr(health, "ping_database", ping)
+    client = test_app.test_client()
+    for _ in range(3):
+        assert client.get("/readyz").status_code == 200
+    assert len(calls) == 1
+    monkeypatch.setitem(test_app.config, "READINESS_DB_CHECK_INTERVAL", 0)
+    assert client.get("/readyz").status_code == 200
+    assert len(calls) == 2
+
+
+def test_readyz_database_down(test_app, monkeypatch):
+    monkeypatch.setattr(health, "database_check", health.DatabaseCheck())
+
+    def ping(engine):
+        raise OperationalError("SELECT 1", {}, Exception("connection refused"))
+
+    monkeypatch.setattr(health, "ping_database", ping)
+    resp = test_app.test_client().get("/readyz")
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 503
+    assert data["status"] == "unavailable"
+    assert data["checks"]["database"] == {"ok": False, "error": "OperationalError"}
+
+
+def test_readyz_saturated(test_app, monkeypatch):
+    monkeypatch.setattr(health, "database_check", health.DatabaseCheck())
+    monkeypatch.setattr(health, "pool_usage", lambda engine: (15, 15))
+    monkeypatch.setattr(health, "queue_depth", lambda: (16, 16))
+    resp = test_app.test_client().get("/readyz")
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 503
+    assert data["checks"]["db_pool"] == {"in_use": 15, "capacity": 15, "ok": False}
+    assert data["checks"]["database"] == {"ok": False, "error": "pool exhausted"}
+    assert data["checks"]["password_queue"] == {
+        "in_use": 16,
+        "capacity": 16,
+        "ok": False,
+    }
+
+    monkeypatch.setattr(health, "pool_usage", lambda engine: (14, 15))
+    monkeypatch.setattr(health, "queue_depth", lambda: (15, 16))
+    assert test_app.test_client().get("/readyz").status_code == 200
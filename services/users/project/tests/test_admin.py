@@ -1,6 +1,8 @@
 import os
 
 from project import create_app, db
+from project.api.users.admin import UsersAdminView
+from project.api.users.models import User, UserEvent
 
 
 def test_admin_view_dev():
@@ -31,3 +33,15 @@ def test_admin_view_prod():
         resp = client.get("/admin/user/")
         assert resp.status_code == 404
     assert os.getenv("FLASK_ENV") == "production"
+
+
+def test_admin_delete_is_soft(test_app, test_database, add_user):
+    user = add_user("admindelete", "admindelete@test.com", "password")
+    view = UsersAdminView(User, test_database.session)
+    with test_app.test_request_context():
+        assert view.delete_model(user)
+    user = User.query.get(user.id)
+    assert user.deleted_at is not None
+    assert not user.active
+    event = UserEvent.query.order_by(UserEvent.seq.desc()).first()
+    assert (event.type, event.user_id) == ("deleted", user.id)
@@ -1,9 +1,13 @@
+import datetime
 import json
 
 import pytest
 from flask import current_app
 
-from project.api.users.models import User
+import project.api.auth
+from project.api.users.cache import token_cache, token_cache_hits
+from project.api.users.models import RevokedToken, User
+from project.api.users.revocation import purge_expired, revocation_checks, revocations
 
 
 def test_user_registration(test_app, test_database):
@@ -202,3 +206,195 @@ def test_invalid_status(test_app, test_database):
     assert resp.status_code == 401
     assert resp.content_type == "application/json"
     assert "Invalid token. Please log in again." in data["message"]
+
+
+def login(client, email, password):
+    resp = client.post(
+        "/auth/login",
+        data=json.dumps({"email": email, "password": password}),
+        content_type="application/json",
+    )
+    return json.loads(resp.data.decode())["access_token"]
+
+
+def test_user_status_cached(test_app, test_database, add_user, monkeypatch):
+    test_database.session.query(User).delete()
+    monkeypatch.setitem(current_app.config, "TOKEN_CACHE_TTL", 30)
+    token_cache.clear()
+    user = add_user("foo", "foo@bar.com", "foobar")
+    client = test_app.test_client()
+    access_token = login(client, user.email, "foobar")
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    hits = token_cache_hits.value
+    assert client.get("/auth/status", headers=headers).status_code == 200
+    assert token_cache_hits.value == hits
+
+    def fail_get_user_by_id(user_id):
+        raise AssertionError("status should be served from the token cache")
+
+    with monkeypatch.context() as m:
+        m.setattr(project.api.auth, "get_user_by_id", fail_get_user_by_id)
+        resp = client.get("/auth/status", headers=headers)
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 200
+    assert data["email"] == "foo@bar.com"
+    assert token_cache_hits.value == hits + 1
+
+
+def test_user_status_cache_invalidated_on_update(
+    test_app, test_database, add_user, monkeypatch
+):
+    test_database.session.query(User).delete()
+    monkeypatch.setitem(current_app.config, "TOKEN_CACHE_TTL", 30)
+    token_cache.clear()
+    user = add_user("foo", "foo@bar.com", "foobar")
+    client = test_app.test_client()
+    headers = {"Authorization": f"Bearer {login(client, user.email, 'foobar')}"}
+    client.get("/auth/status", headers=headers)
+
+    client.put(
+        f"/users/{user.id}",
+        data=json.dumps({"username": "foo", "email": "new@bar.com"}),
+        content_type="application/json",
+    )
+    data = json.loads(client.get("/auth/status", headers=headers).data.decode())
+    assert data["email"] == "new@bar.com"
+
+    client.delete(f"/users/{user.id}")
+    resp = client.get("/auth/status", headers=headers)
+    assert resp.status_code == 401
+
+
+def test_logout_revokes_tokens(test_app, test_database, add_user, monkeypatch):
+    test_database.session.query(User).delete()
+    monkeypatch.setitem(current_app.config, "TOKEN_CACHE_TTL", 30)
+    monkeypatch.setitem(current_app.config, "REFRESH_TOKEN_EXPIRATION", 60)
+    token_cache.clear()
+    revocations.clear()
+    user = add_user("foo", "foo@bar.com", "foobar")
+    client = test_app.test_client()
+    resp = client.post(
+        "/auth/login",
+        data=json.dumps({"email": user.email, "password": "foobar"}),
+        content_type="application/json",
+    )
+    tokens = json.loads(resp.data.decode())
+    headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+
+    clear = revocation_checks.labels("clear").value
+    assert client.get("/auth/status", headers=headers).status_code == 200
+    assert revocation_checks.labels("clear").value == clear + 1
+
+    resp = client.post(
+        "/auth/logout",
+        data=json.dumps({"refresh_token": tokens["refresh_token"]}),
+        content_type="application/json",
+        headers=headers,
+    )
+    assert resp.status_code == 200
+    assert "Successfully logged out." in json.loads(resp.data.decode())["message"]
+
+    # rejected even though the token cache still holds the access token
+    resp = client.get("/auth/status", headers=headers)
+    assert resp.status_code == 401
+    assert "Token revoked" in json.loads(resp.data.decode())["message"]
+    resp = client.post(
+        "/auth/refresh",
+        data=json.dumps({"refresh_token": tokens["refresh_token"]}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 401
+
+    # another worker's filter picks the revocation up from the database
+    revocations.clear()
+    assert client.get("/auth/status", headers=headers).status_code == 401
+
+
+def test_logout_with_expired_access_token(
+    test_app, test_database, add_user, monkeypatch
+):
+    test_database.session.query(User).delete()
+    monkeypatch.setitem(current_app.config, "ACCESS_TOKEN_EXPIRATION", -1)
+    monkeypatch.setitem(current_app.config, "REFRESH_TOKEN_EXPIRATION", 60)
+    revocations.clear()
+    user = add_user("foo", "foo@bar.com", "foobar")
+    access_token = user.encode_token(user.id, "access").decode()
+    refresh_token = user.encode_token(user.id, "refresh").decode()
+    client = test_app.test_client()
+
+    resp = client.post(
+        "/auth/logout",
+        data=json.dumps({"refresh_token": refresh_token}),
+        content_type="application/json",
+        headers={"Authorization": f"Bearer {access_token}"},
+    )
+    assert resp.status_code == 200
+    resp = client.post(
+        "/auth/refresh",
+        data=json.dumps({"refresh_token": refresh_token}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 401
+    assert "Token revoked" in json.loads(resp.data.decode())["message"]
+
+
+def test_logout_refresh_token_only(test_app, test_database, add_user, monkeypatch):
+    test_database.session.query(User).delete()
+    monkeypatch.setitem(current_app.config, "REFRESH_TOKEN_EXPIRATION", 60)
+    revocations.clear()
+    user = add_user("foo", "foo@bar.com", "foobar")
+    refresh_token = user.encode_token(user.id, "refresh").decode()
+    other = add_user("bar", "bar@foo.com", "foobar")
+    other_access = other.encode_token(other.id, "access").decode()
+    client = test_app.test_client()
+
+    # someone else's access token does not vouch for the refresh token
+    resp = client.post(
+        "/auth/logout",
+        data=json.dumps({"refresh_token": refresh_token}),
+        content_type="application/json",
+        headers={"Authorization": f"Bearer {other_access}"},
+    )
+    assert resp.status_code == 401
+
+    resp = client.post(
+        "/auth/logout",
+        data=json.dumps({"refresh_token": refresh_token}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200
+    resp = client.post(
+        "/auth/refresh",
+        data=json.dumps({"refresh_token": refresh_token}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 401
+
+
+def test_logout_no_token(test_app, test_database):
+    client = test_app.test_client()
+    resp = client.post("/auth/logout")
+    assert resp.status_code == 403
+    assert "Token required" in json.loads(resp.data.decode())["message"]
+
+
+def test_expired_revocations_pruned(test_app, test_database):
+    test_database.session.query(RevokedToken).delete()
+    now = datetime.datetime.utcnow()
+    test_database.session.add_all(
+        [
+            RevokedToken(
+                jti="old", user_id=1, expires_at=now - datetime.timedelta(seconds=1)
+            ),
+            RevokedToken(
+                jti="new", user_id=1, expires_at=now + datetime.timedelta(hours=1)
+            ),
+        ]
+    )
+    test_database.session.commit()
+    revocations.clear()
+    assert revocations.is_revoked({"jti": "new"})
+    assert not revocations.is_revoked({"jti": "old"})
+    assert purge_expired() == 1
+    assert [row.jti for row in RevokedToken.query] == ["new"]
@@ -0,0 +1,99 @@
+import gzip
+import json
+
+import pytest
+from flask import Response
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+from project import compression
+from project.api.users.models import User
+from project.serialization import json_response
+
+BIG = {"users": [{"id": i, "username": f"user{i}"} for i in range(200)]}
+
+
+def compress(test_app, response, accept_encoding="gzip"):
+    headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {}
+    with test_app.test_request_context(headers=headers):
+        return compression.compress_response(response)
+
+
+def accept(value):
+    return parse_accept_header(value, Accept)
+
+
+def test_negotiate(monkeypatch):
+    assert compression.negotiate(accept("gzip, deflate")) == "gzip"
+    assert compression.negotiate(accept("deflate")) is None
+    assert compression.negotiate(accept("gzip;q=0")) is None
+    assert compression.negotiate(accept("*")) == "gzip"
+    monkeypatch.setattr(compression, "available_encodings", lambda: ("br", "gzip"))
+    assert compression.negotiate(accept("gzip, br")) == "br"
+    assert compression.negotiate(accept("gzip, br;q=0.5")) == "gzip"
+
+
+def test_compresses_large_bodies(test_app):
+    response = compress(test_app, json_response(BIG))
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.vary
+    assert response.content_length == len(response.get_data())
+    assert json.loads(gzip.decompress(response.get_data())) == BIG
+
+
+def test_leaves_small_or_unwanted_bodies(test_app):
+    response = compress(test_app, json_response({"ok": True}))
+    assert "Content-Encoding" not in response.headers
+    assert "Accept-Encoding" in response.vary
+    response = compress(test_app, json_response(BIG), accept_encoding=None)
+    assert "Content-Encoding" not in response.headers
+    response = compress(test_app, Response(b"\x89PNG" * 1000, mimetype="image/png"))
+    assert "Content-Encoding" not in response.headers
+    response = compress(test_app, Response(status=304))
+    assert "Vary" not in response.headers
+
+
+def test_compressed_etag_is_weak(test_app):
+    response = json_response(BIG)
+    response.set_etag("abc")
+    response = compress(test_app, response)
+    assert response.get_etag() == ("abc", True)
+
+
+def test_compresses_streams(test_app):
+    lines = [json.dumps({"id": i}).encode() + b"\n" for i in range(1000)]
+    closed = []
+
+    def generate():
+        try:
+            yield from lines
+        finally:
+            closed.append(True)
+
+    response = compress(test_app, Response(generate(), mimetype="application/json"))
+    assert response.is_streamed
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in response.headers
+    chunks = list(response.response)
+    assert len(chunks) < len(lines)
+    assert gzip.decompress(b"".join(chunks)) == b"".join(lines)
+    assert closed
+
+
+def test_brotli(test_app):
+    brotli = pytest.importorskip("brotli")
+    response = compress(test_app, json_response(BIG), accept_encoding="br, gzip")
+    assert response.headers["Content-Encoding"] == "br"
+    assert json.loads(brotli.decompress(response.get_data())) == BIG
+
+
+def test_compressed_user_stream(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    for i in range(3):
+        add_user(f"user{i}", f"user{i}@example.com", "password")
+    resp = test_app.test_client().get(
+        "/users?format=ndjson", headers={"Accept-Encoding": "gzip"}
+    )
+    assert resp.headers["Content-Encoding"] == "gzip"
+    rows = gzip.decompress(resp.data).decode().splitlines()
+    assert [json.loads(row)["username"] for row in rows] == ["user0", "user1", "user2"]
@@ -0,0 +1,330 @@
+import datetime
+import json
+import time
+
+import pytest
+
+from project import jobs
+from project.api.users import tasks
+from project.api.users.models import RevokedToken, User
+from project.jobs import Job
+
+calls = []
+
+
+@jobs.task("tests.echo")
+def echo(value):
+    calls.append(value)
+    return {"echo": value}
+
+
+@jobs.task("tests.flaky", max_attempts=2)
+def flaky():
+    raise RuntimeError("try again")
+
+
+@jobs.task("tests.secret", sensitive=True)
+def secret(password):
+    return "ok"
+
+
+@jobs.task("tests.limited", queue="limited")
+def limited():
+    return None
+
+
+@pytest.fixture
+def clean(test_app, test_database, monkeypatch):
+    monkeypatch.setitem(test_app.config, "JOBS_QUEUES", {"default": 0, "limited": 1})
+    test_database.session.query(Job).delete()
+    test_database.session.commit()
+    del calls[:]
+
+
+@pytest.fixture
+def staging(test_app, monkeypatch, tmp_path):
+    monkeypatch.setitem(test_app.config, "USERS_BULK_STAGING_DIR", str(tmp_path))
+    return tmp_path
+
+
+def later(seconds):
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+
+
+def test_backoff(test_app, monkeypatch):
+    monkeypatch.setattr(jobs.random, "uniform", lambda low, high: high)
+    monkeypatch.setitem(test_app.config, "JOBS_RETRY_BASE", 10)
+    monkeypatch.setitem(test_app.config, "JOBS_RETRY_MAX", 60)
+    assert [jobs.backoff(attempts) for attempts in range(1, 6)] == [10, 20, 40, 60, 60]
+
+
+def test_enqueue_joins_the_transaction(test_app, test_database, clean):
+    jobs.enqueue("tests.echo", {"value": 1})
+    test_database.session.rollback()
+    assert jobs.claim("default", "w1") is None
+    job = jobs.enqueue("tests.echo", {"value": 2})
+    test_database.session.commit()
+    assert jobs.claim("default", "w1").id == job.id
+
+
+def test_run_job(test_app, test_database, clean):
+    job = jobs.enqueue("tests.echo", {"value": "hi"})
+    test_database.session.commit()
+    claimed = jobs.claim("default", "w1")
+    assert claimed.status == "running"
+    assert claimed.attempts == 1
+    assert jobs.claim("default", "w2") is None
+    assert jobs.run(claimed, "w1") == "done"
+    job = Job.query.get(job.id)
+    assert calls == ["hi"]
+    assert job.status == "done"
+    assert job.result == {"echo": "hi"}
+    assert job.args == {"value": "hi"}
+    assert job.locked_by is None
+
+
+def test_scheduled_job(test_app, test_database, clean):
+    jobs.enqueue("tests.echo", {"value": 1}, delay=60)
+    test_database.session.commit()
+    assert jobs.claim("default", "w1") is None
+    assert jobs.claim("default", "w1", now=later(61)) is not None
+
+
+def test_failed_job_retries_with_backoff(test_app, test_database, clean):
+    job = jobs.enqueue("tests.flaky")
+    test_database.session.commit()
+    assert jobs.run(jobs.claim("default", "w1"), "w1") == "retried"
+    job = Job.query.get(job.id)
+    assert job.status == "queued"
+    assert job.run_at > datetime.datetime.utcnow()
+    assert "try again" in job.last_error
+    assert jobs.claim("default", "w1") is None
+
+    retry = jobs.claim("default", "w1", now=later(3600))
+    assert retry.attempts == 2
+    assert jobs.run(retry, "w1") == "failed"
+    job = Job.query.get(job.id)
+    assert job.status == "failed"
+    assert job.finished_at is not None
+
+
+def test_unknown_job_fails(test_app, test_database, clean):
+    test_database.session.add(
+        Job(queue="default", name="tests.gone", args={}, max_attempts=5)
+    )
+    test_database.session.commit()
+    assert jobs.run(jobs.claim("default", "w1", now=later(1)), "w1") == "failed"
+
+
+def test_sensitive_args_are_cleared(test_app, test_database, clean):
+    job = jobs.enqueue("tests.secret", {"password": "hunter2"})
+    test_database.session.commit()
+    jobs.run(jobs.claim("default", "w1"), "w1")
+    job = Job.query.get(job.id)
+    assert job.status == "done"
+    assert job.args is None
+
+
+def test_queue_concurrency_limit(test_app, test_database, clean):
+    for _ in range(2):
+        jobs.enqueue("tests.limited")
+    jobs.enqueue("tests.echo", {"value": 1})
+    test_database.session.commit()
+    first = jobs.claim("limited", "w1")
+    assert first is not None
+    assert jobs.claim("limited", "w2") is None
+    # other queues are not held up
+    assert jobs.claim("default", "w2") is not None
+    jobs.run(first, "w1")
+    assert jobs.claim("limited", "w2") is not None
+
+
+def test_expired_lease_is_handed_out_again(test_app, test_database, clean):
+    job = jobs.enqueue("tests.echo", {"value": 1})
+    test_database.session.commit()
+    jobs.claim("default", "w1")
+    assert jobs.requeue_expired(60) == 0
+    assert jobs.requeue_expired(60, now=later(61)) == 1
+    retry = jobs.claim("default", "w2", now=later(61))
+    assert retry.id == job.id
+    # the first worker's late result is dropped
+    jobs._finish(job.id, "w1", {"status": "done"})
+    assert Job.query.get(job.id).status == "running"
+
+
+def test_expired_last_attempt_clears_sensitive_args(
+    test_app, test_database, clean, monkeypatch
+):
+    monkeypatch.setitem(test_app.config, "JOBS_MAX_ATTEMPTS", 1)
+    secret = jobs.enqueue("tests.secret", {"password": "hunter2"})
+    echo = jobs.enqueue("tests.echo", {"value": 1})
+    test_database.session.commit()
+    jobs.claim("default", "w1")
+    jobs.claim("default", "w1")
+    assert jobs.requeue_expired(60, now=later(61)) == 2
+    secret, echo = Job.query.get(secret.id), Job.query.get(echo.id)
+    assert (secret.status, secret.args) == ("failed", None)
+    assert (echo.status, echo.args) == ("failed", {"value": 1})
+
+
+def test_worker_runs_jobs(test_app, test_database, clean, monkeypatch):
+    monkeypatch.setitem(test_app.config, "JOBS_POLL_INTERVAL", 0.01)
+    job = jobs.enqueue("tests.echo", {"value": "threaded"})
+    test_database.session.commit()
+    worker = jobs.Worker(test_app, ["limited", "default"], threads=2)
+    worker.start()
+    try:
+        deadline = time.monotonic() + 5
+        while not calls and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        worker.stop()
+    assert calls == ["threaded"]
+    test_database.session.expire_all()
+    assert Job.query.get(job.id).status == "done"
+
+
+def test_periodic_task_scheduling(test_app, test_database, clean, monkeypatch):
+    monkeypatch.setitem(test_app.config, "JOBS_PRUNE_INTERVAL", 0)
+    monkeypatch.setitem(test_app.config, "REVOCATION_PURGE_INTERVAL", 0)
+    assert jobs.schedule_periodic() == []
+    monkeypatch.setitem(test_app.config, "REVOCATION_PURGE_INTERVAL", 60)
+    [job] = jobs.schedule_periodic()
+    assert job.name == tasks.PURGE_REVOKED_TOKENS
+    # one run at a time
+    assert jobs.schedule_periodic() == []
+    claimed = jobs.claim("default", "w1")
+    assert claimed.id == job.id
+    assert jobs.schedule_periodic() == []
+    jobs.run(claimed, "w1")
+    [after] = jobs.schedule_periodic()
+    assert after.run_at == claimed.run_at + datetime.timedelta(seconds=60)
+    assert jobs.claim("default", "w1") is None
+
+
+def test_worker_purges_revoked_tokens(test_app, test_database, clean, monkeypatch):
+    monkeypatch.setitem(test_app.config, "JOBS_PRUNE_INTERVAL", 0)
+    monkeypatch.setitem(test_app.config, "JOBS_POLL_INTERVAL", 0.01)
+    test_database.session.query(RevokedToken).delete()
+    expired, live = later(-60), later(3600)
+    test_database.session.add(RevokedToken(jti="old", user_id=1, expires_at=expired))
+    test_database.session.add(RevokedToken(jti="new", user_id=1, expires_at=live))
+    test_database.session.commit()
+    worker = jobs.Worker(test_app, ["default"], threads=1)
+    worker.start()
+    try:
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            test_database.session.expire_all()
+            if Job.query.filter_by(status="done").first() is not None:
+                break
+            time.sleep(0.01)
+    finally:
+        worker.stop()
+    job = Job.query.filter_by(name=tasks.PURGE_REVOKED_TOKENS, status="done").one()
+    assert job.result == {"purged": 1}
+    jtis = [jti for (jti,) in test_database.session.query(RevokedToken.jti)]
+    assert jtis == ["new"]
+
+
+def test_prune_finished_jobs(test_app, test_database, clean, monkeypatch):
+    monkeypatch.setitem(test_app.config, "JOBS_RETENTION_DAYS", 1)
+    for value in ("old", "recent", "queued"):
+        jobs.enqueue("tests.echo", {"value": value})
+    jobs.enqueue("tests.flaky")
+    test_database.session.commit()
+    for _ in range(2):
+        jobs.run(jobs.claim("default", "w1"), "w1")
+    flaky = Job.query.filter_by(name="tests.flaky").one()
+    flaky.status, flaky.finished_at = "failed", later(-3 * 86400)
+    Job.query.filter(Job.args["value"].as_string() == "old").update(
+        {"finished_at": later(-2 * 86400)}, synchronize_session=False
+    )
+    test_database.session.commit()
+
+    assert jobs.prune_jobs() == {"pruned": 2}
+    left = {(job.status, job.args["value"]) for job in Job.query}
+    assert left == {("done", "recent"), ("queued", "queued")}
+
+
+def test_bulk_import_in_background(test_app, test_database, clean, staging):
+    test_database.session.query(User).delete()
+    test_database.session.commit()
+    client = test_app.test_client()
+    body = "username,email,password\nbg1,bg1@test.com,x\nbg2,BG1@test.com,x\n"
+    resp = client.post(
+        "/users/bulk",
+        data=body,
+        content_type="text/csv",
+        headers={"Prefer": "respond-async"},
+    )
+    assert resp.status_code == 202
+    assert resp.headers["Preference-Applied"] == "respond-async"
+    location = resp.headers["Location"]
+    data = json.loads(resp.data.decode())
+    assert data["status"] == "queued"
+    assert User.query.count() == 0
+    # the passwords are staged outside the database, and the report is only
+    # reachable through the signed Location
+    job = Job.query.get(data["id"])
+    assert "x" not in json.dumps(job.args)
+    assert len(list(staging.iterdir())) == 1
+    assert client.get(f"/users/bulk/{job.id}").status_code == 404
+
+    assert jobs.Worker(test_app, ["bulk"], threads=1).work() == "done"
+    data = json.loads(client.get(location).data.decode())
+    assert data["status"] == "done"
+    assert data["result"]["created"] == 1
+    assert data["result"]["duplicate"] == 1
+    assert list(staging.iterdir()) == []
+    assert client.get("/users/bulk/999999").status_code == 404
+
+
+def test_bulk_import_upload_removed_after_last_attempt(
+    test_app, test_database, clean, staging, monkeypatch
+):
+    monkeypatch.setattr(tasks, "bulk_add_users", lambda rows, batch_size: 1 / 0)
+    test_app.test_client().post(
+        "/users/bulk",
+        data="username,email,password\nbg1,bg1@test.com,x\n",
+        content_type="text/csv",
+        headers={"Prefer": "respond-async"},
+    )
+    assert jobs.run(jobs.claim("bulk", "w1"), "w1") == "retried"
+    assert len(list(staging.iterdir())) == 1
+    assert jobs.requeue_expired(0, now=later(3600)) == 0
+    retry = jobs.claim("bulk", "w1", now=later(3600))
+    jobs.run(retry, "w1")
+    retry = jobs.claim("bulk", "w1", now=later(7200))
+    # a worker that dies on the last attempt still leaves nothing behind
+    assert jobs.requeue_expired(60, now=later(9000)) == 1
+    assert list(staging.iterdir()) == []
+
+
+def test_bulk_import_in_background_row_limit(
+    test_app, test_database, clean, staging, monkeypatch
+):
+    monkeypatch.setitem(test_app.config, "USERS_BULK_ASYNC_MAX_ROWS", 1)
+    resp = test_app.test_client().post(
+        "/users/bulk",
+        data="username,email,password\na,a@test.com,x\nb,b@test.com,x\n",
+        content_type="text/csv",
+        headers={"Prefer": "respond-async"},
+    )
+    assert resp.status_code == 413
+    assert Job.query.count() == 0
+    assert list(staging.iterdir()) == []
+
+
+def test_queue_metrics(test_app, test_database, clean):
+    jobs.enqueue("tests.echo", {"value": 1})
+    jobs.enqueue("tests.echo", {"value": 2}, delay=60)
+    jobs.enqueue("tests.limited")
+    test_database.session.commit()
+    jobs.claim("limited", "w1")
+    body = test_app.test_client().get("/metrics").data.decode()
+    assert 'jobs_queued{queue="default"} 2' in body
+    assert 'jobs_queued{queue="limited"} 0' in body
+    assert 'jobs_running{queue="limited"} 1' in body
+    assert 'jobs_running{queue="default"} 0' in body
+    assert 'jobs_oldest_due_seconds{queue="default"}' in body
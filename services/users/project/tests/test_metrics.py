@@ -0,0 +1,108 @@
+import json
+import logging
+
+from project import metrics
+from project.api.users.models import User
+
+
+def test_metrics_endpoint(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    user = add_user("foo", "foo@bar.com", "foobar")
+    client = test_app.test_client()
+    client.get(f"/users/{user.id}")
+    client.post(
+        "/auth/login",
+        data=json.dumps({"email": "foo@bar.com", "password": "foobar"}),
+        content_type="application/json",
+    )
+
+    resp = client.get("/metrics")
+    body = resp.data.decode()
+    assert resp.status_code == 200
+    assert resp.content_type.startswith("text/plain")
+    assert "# TYPE http_request_duration_seconds histogram" in body
+    assert (
+        'http_request_duration_seconds_count{endpoint="Users_users",method="GET"}'
+        in body
+    )
+    assert (
+        'http_requests_total{endpoint="Users_users",method="GET",status="200"}' in body
+    )
+    assert 'http_request_db_queries_count{endpoint="Auth_login"}' in body
+    assert 'jwt_seconds_count{operation="encode"}' in body
+    assert "password_hash_seconds_count" in body
+
+
+def test_request_query_count(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    user = add_user("foo", "foo@bar.com", "foobar")
+    histogram = metrics.registry["http_request_db_queries"].labels("Users_users")
+    count, total = histogram.count, histogram.sum
+    test_app.test_client().get(f"/users/{user.id}")
+    assert histogram.count == count + 1
+    assert histogram.sum == total + 1
+
+
+def test_slow_request_log(test_app, test_database, add_user, monkeypatch, caplog):
+    test_database.session.query(User).delete()
+    user = add_user("foo", "foo@bar.com", "foobar")
+    monkeypatch.setitem(test_app.config, "SLOW_REQUEST_THRESHOLD", 0)
+    with caplog.at_level(logging.WARNING):
+        test_app.test_client().get(f"/users/{user.id}")
+    assert f"Slow request GET /users/{user.id}" in caplog.text
+    assert "1 queries" in caplog.text
+    assert "FROM users" in caplog.text
+
+
+def test_histogram_render():
+    histogram = metrics.Histogram("test_render_seconds", "Test.", buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    lines = histogram.render()
+    assert 'test_render_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_render_seconds_bucket{le="1"} 2' in lines
+    assert 'test_render_seconds_bucket{le="+Inf"} 2' in lines
+    assert "test_render_seconds_count 2" in lines
+    del metrics.registry["test_render_seconds"]
+
+
+def test_label_values_escaped():
+    counter = metrics.Counter("test_escape_total", "Test.", ("path",))
+    counter.labels('a\\b"c\nd').inc()
+    assert 'test_escape_total{path="a\\\\b\\"c\\nd"} 1' in counter.render()
+    del metrics.registry["test_escape_total"]
+
+
+def test_metrics_summed_across_processes(
+    test_app, test_database, monkeypatch, tmp_path
+):
+    monkeypatch.setattr(metrics, "start_writer", lambda directory, interval: None)
+    monkeypatch.setitem(test_app.config, "METRICS_DIR", str(tmp_path))
+    other = {
+        "test_shared_total": metrics.Counter(
+            "test_shared_total", "Test.", ("kind",), _register=False
+        ),
+        "test_shared_seconds": metrics.Histogram(
+            "test_shared_seconds", "Test.", buckets=(0.1, 1), _register=False
+        ),
+    }
+    other["test_shared_total"].labels("a").inc(2)
+    other["test_shared_seconds"].observe(0.5)
+    dumps = {name: metric.dump() for name, metric in other.items()}
+    (tmp_path / "1.json").write_text(json.dumps(dumps))
+    counter = metrics.Counter("test_shared_total", "Test.", ("kind",))
+    histogram = metrics.Histogram("test_shared_seconds", "Test.", buckets=(0.1, 1))
+    try:
+        counter.labels("a").inc(3)
+        counter.labels("b").inc()
+        histogram.observe(0.05)
+        body = test_app.test_client().get("/metrics").data.decode()
+    finally:
+        del metrics.registry["test_shared_total"]
+        del metrics.registry["test_shared_seconds"]
+    assert 'test_shared_total{kind="a"} 5' in body
+    assert 'test_shared_total{kind="b"} 1' in body
+    assert 'test_shared_seconds_bucket{le="0.1"} 1' in body
+    assert 'test_shared_seconds_bucket{le="1"} 2' in body
+    assert "test_shared_seconds_count 2" in body
+    assert body.count("# TYPE test_shared_total counter") == 1
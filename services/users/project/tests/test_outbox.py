@@ -0,0 +1,196 @@
+import datetime
+import json
+
+import pytest
+
+from project.api.users import outbox
+from project.api.users.models import ChangeCounter, User, UserEvent
+from project.api.users.services import (
+    add_user,
+    bulk_add_users,
+    delete_user,
+    get_users_version,
+    update_user,
+)
+
+
+@pytest.fixture
+def clean(test_app, test_database):
+    test_database.session.query(User).delete()
+    test_database.session.query(UserEvent).delete()
+    test_database.session.query(ChangeCounter).filter_by(
+        name="user_events_pruned"
+    ).update({"value": 0})
+    test_database.session.commit()
+
+
+def events():
+    return [
+        (event.type, event.user_id, event.data["username"])
+        for event in UserEvent.query.order_by(UserEvent.seq)
+    ]
+
+
+def test_create_sink():
+    assert isinstance(outbox.create_sink("memory"), outbox.MemorySink)
+    assert outbox.create_sink("file", "/tmp/events").path == "/tmp/events"
+    with pytest.raises(ValueError):
+        outbox.create_sink("kafka")
+
+
+def test_file_sink(tmp_path):
+    path = tmp_path / "events.ndjson"
+    sink = outbox.FileSink(str(path))
+    sink.publish([{"seq": 1}, {"seq": 2}])
+    sink.publish([{"seq": 3}])
+    lines = path.read_text().splitlines()
+    assert [json.loads(line)["seq"] for line in lines] == [1, 2, 3]
+
+
+def test_writes_record_events(test_app, test_database, clean):
+    user = add_user("justatest", "test@test.com", "password")
+    update_user(user, "renamed", "test@test.com")
+    delete_user(user)
+    assert events() == [
+        ("created", user.id, "justatest"),
+        ("updated", user.id, "renamed"),
+        ("deleted", user.id, "renamed"),
+    ]
+    data = UserEvent.query.order_by(UserEvent.seq.desc()).first().data
+    assert data["email"] == "test@test.com"
+    assert data["active"] is False
+    assert "password" not in data
+
+
+def test_failed_writes_record_nothing(test_app, test_database, clean):
+    first = add_user("first", "first@test.com", "password")
+    second = add_user("second", "second@test.com", "password")
+    assert add_user("again", "FIRST@test.com", "password") is None
+    assert update_user(second, "second", "first@test.com") is None
+    assert events() == [
+        ("created", first.id, "first"),
+        ("created", second.id, "second"),
+    ]
+
+
+def test_session_writes_record_events(test_app, test_database, clean):
+    # the admin writes through the session rather than the services
+    session = test_database.session
+    user = User(username="direct", email="direct@test.com", password="password")
+    session.add(user)
+    session.flush()
+    user.username = "direct2"
+    session.commit()
+    session.commit()
+    user.username = "rolled back"
+    session.flush()
+    session.rollback()
+    user.deleted_at = datetime.datetime.utcnow()
+    session.commit()
+    assert events() == [
+        ("created", user.id, "direct2"),
+        ("deleted", user.id, "direct2"),
+    ]
+
+
+def test_bulk_add_records_events(test_app, test_database, clean):
+    rows = [
+        {"username": "bulk1", "email": "bulk1@test.com", "password": "x"},
+        {"username": "bulk2", "email": "bulk2@test.com", "password": "x"},
+        {"username": "dupe", "email": "BULK1@test.com", "password": "x"},
+    ]
+    results = list(bulk_add_users(rows, batch_size=10))
+    assert events() == [
+        ("created", results[0]["id"], "bulk1"),
+        ("created", results[1]["id"], "bulk2"),
+    ]
+
+
+def test_relay_events(test_app, test_database, clean):
+    for i in range(5):
+        add_user(f"user{i}", f"user{i}@test.com", "password")
+    sink = outbox.MemorySink()
+    assert outbox.relay_events(sink, batch_size=3) == 3
+    assert outbox.relay_events(sink, batch_size=3) == 2
+    assert outbox.relay_events(sink, batch_size=3) == 0
+    published = [sink.queue.get_nowait() for _ in range(5)]
+    assert sink.queue.empty()
+    assert [event["user"]["username"] for event in published] == [
+        f"user{i}" for i in range(5)
+    ]
+    seqs = [event["seq"] for event in published]
+    assert seqs == sorted(seqs)
+    assert UserEvent.query.filter(UserEvent.published_at.is_(None)).count() == 0
+
+
+def test_prune_events_keeps_unpublished(test_app, test_database, clean):
+    add_user("old", "old@test.com", "password")
+    outbox.relay_events(outbox.MemorySink(), batch_size=10)
+    add_user("pending", "pending@test.com", "password")
+    add_user("newer", "newer@test.com", "password")
+    future = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    assert outbox.prune_events(future) == 1
+    assert [username for _, _, username in events()] == ["pending", "newer"]
+    assert outbox.prune_events(future) == 0
+
+
+def test_changes_feed(test_app, test_database, clean):
+    client = test_app.test_client()
+    resp = client.get("/users/changes")
+    assert resp.status_code == 200
+    start = json.loads(resp.data.decode())
+    assert start["changes"] == []
+
+    user = add_user("feed", "feed@test.com", "password")
+    update_user(user, "feed2", "feed@test.com")
+    resp = client.get(f"/users/changes?since={start['next']}&limit=1")
+    data = json.loads(resp.data.decode())
+    assert data["has_more"]
+    [change] = data["changes"]
+    assert change["type"] == "created"
+    assert change["user_id"] == user.id
+    assert change["user"]["username"] == "feed"
+
+    resp = client.get(f"/users/changes?since={data['next']}")
+    data = json.loads(resp.data.decode())
+    assert not data["has_more"]
+    assert [change["type"] for change in data["changes"]] == ["updated"]
+    resp = client.get(f"/users/changes?since={data['next']}")
+    assert json.loads(resp.data.decode())["changes"] == []
+    assert client.get("/users/changes?since=-1").status_code == 400
+
+
+def test_changes_feed_gone_after_prune(test_app, test_database, clean):
+    client = test_app.test_client()
+    add_user("gone", "gone@test.com", "password")
+    outbox.relay_events(outbox.MemorySink(), batch_size=10)
+    head = json.loads(client.get("/users/changes").data.decode())["next"]
+    outbox.prune_events(datetime.datetime.utcnow() + datetime.timedelta(days=1))
+    resp = client.get(f"/users/changes?since={head - 1}")
+    assert resp.status_code == 410
+    assert client.get(f"/users/changes?since={head}").status_code == 200
+
+
+def test_users_version_follows_events(test_app, test_database, clean):
+    add_user("versioned", "versioned@test.com", "password")
+    head = UserEvent.query.order_by(UserEvent.seq.desc()).first().seq
+    assert get_users_version() == head
+    outbox.relay_events(outbox.MemorySink(), batch_size=10)
+    outbox.prune_events(datetime.datetime.utcnow() + datetime.timedelta(days=1))
+    assert UserEvent.query.count() == 0
+    assert get_users_version() == head
+
+
+def test_backlog_metrics(test_app, test_database, clean):
+    client = test_app.test_client()
+    body = client.get("/metrics").data.decode()
+    assert "outbox_events_unpublished 0" in body
+    assert "outbox_oldest_unpublished_seconds 0" in body
+    add_user("backlog1", "backlog1@test.com", "password")
+    add_user("backlog2", "backlog2@test.com", "password")
+    body = client.get("/metrics").data.decode()
+    assert "outbox_events_unpublished 2" in body
+    outbox.relay_events(outbox.MemorySink(), batch_size=10)
+    body = client.get("/metrics").data.decode()
+    assert "outbox_events_unpublished 0" in body
+    assert "outbox_events_published_total" in body
@@ -0,0 +1,199 @@
+import json
+
+import pytest
+from flask import g
+
+from project import bcrypt, metrics
+from project.api.users import passwords
+from project.api.users.models import User
+from project.api.users.services import upgrade_password
+
+
+def test_hash_and_check_password(test_app):
+    hashed = passwords.hash_password("foobar")
+    assert hashed.startswith("$2b$04$")
+    assert bcrypt.check_password_hash(hashed, "foobar")
+    assert passwords.check_password(hashed, "foobar")
+    assert not passwords.check_password(hashed, "barfoo")
+
+
+def test_hash_password_in_worker_pool(test_app, monkeypatch):
+    monkeypatch.setitem(test_app.config, "PASSWORD_POOL_SIZE", 1)
+    hashed = passwords.hash_password("foobar")
+    assert passwords.check_password(hashed, "foobar")
+    assert passwords.queue_depth() == (0, test_app.config["PASSWORD_QUEUE_DEPTH"])
+
+
+def test_hash_passwords_batch_in_worker_pool(test_app, monkeypatch):
+    monkeypatch.setitem(test_app.config, "PASSWORD_POOL_SIZE", 2)
+    plain = [f"password{i}" for i in range(5)]
+    hashed = passwords.hash_passwords(plain)
+    assert len(hashed) == 5
+    assert all(bcrypt.check_password_hash(h, p) for h, p in zip(hashed, plain))
+    assert passwords.hash_passwords([]) == []
+
+
+def test_hash_passwords_batch_holds_a_slot_per_job(test_app, monkeypatch):
+    monkeypatch.setitem(test_app.config, "PASSWORD_POOL_SIZE", 2)
+    submit = passwords._submit
+    in_flight = []
+
+    def spy(state, fn, args):
+        job = submit(state, fn, args)
+        in_flight.append(state.in_flight)
+        return job
+
+    monkeypatch.setattr(passwords, "_submit", spy)
+    passwords.hash_passwords([f"password{i}" for i in range(5)])
+    # one slot per password, and never more jobs queued than pool processes
+    assert in_flight == [1, 2, 2, 2, 2]
+    assert passwords.queue_depth()[0] == 0
+
+
+def test_password_metrics_recorded(test_app):
+    count = metrics.registry["password_hash_seconds"].count
+    with test_app.test_request_context():
+        passwords.hash_password("foobar")
+        assert g.password_hash_time > 0
+        assert g.password_queue_wait >= 0
+    assert metrics.registry["password_hash_seconds"].count == count + 1
+
+
+def test_register_overloaded(test_app, test_database, monkeypatch):
+    test_database.session.query(User).delete()
+    monkeypatch.setitem(test_app.config, "PASSWORD_QUEUE_DEPTH", 1)
+    monkeypatch.setitem(test_app.config, "PASSWORD_QUEUE_TIMEOUT", 0)
+    slots = passwords._pool().slots
+    slots.acquire()
+    try:
+        client = test_app.test_client()
+        resp = client.post(
+            "/auth/register",
+            data=json.dumps(
+                {"username": "foo", "email": "foo@bar.com", "password": "foobar"}
+            ),
+            content_type="application/json",
+        )
+    finally:
+        slots.release()
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == str(test_app.config["PASSWORD_RETRY_AFTER"])
+    assert "overloaded" in data["message"]
+    assert test_database.session.query(User).count() == 0
+
+
+def test_needs_rehash(test_app, monkeypatch):
+    hashed = passwords.hash_password("foobar")
+    assert not passwords.needs_rehash(hashed)
+    monkeypatch.setitem(test_app.config, "BCRYPT_LOG_ROUNDS", 5)
+    assert passwords.needs_rehash(hashed)
+    monkeypatch.setitem(test_app.config, "PASSWORD_SCHEME", "argon2")
+    assert passwords.needs_rehash(hashed)
+
+
+def test_argon2_hash_and_check_password(test_app, monkeypatch):
+    pytest.importorskip("argon2")
+    monkeypatch.setitem(test_app.config, "PASSWORD_SCHEME", "argon2")
+    monkeypatch.setitem(test_app.config, "ARGON2_TIME_COST", 1)
+    monkeypatch.setitem(test_app.config, "ARGON2_MEMORY_COST", 1024)
+    hashed = passwords.hash_password("foobar")
+    assert hashed.startswith("$argon2id$")
+    assert passwords.check_password(hashed, "foobar")
+    assert not passwords.check_password(hashed, "barfoo")
+    assert not passwords.needs_rehash(hashed)
+    monkeypatch.setitem(test_app.config, "ARGON2_TIME_COST", 2)
+    assert passwords.needs_rehash(hashed)
+    # bcrypt hashes made before the switch still verify
+    monkeypatch.setitem(test_app.config, "PASSWORD_SCHEME", "bcrypt")
+    assert passwords.needs_rehash(hashed)
+    assert passwords.check_password(passwords.hash_password("foobar"), "foobar")
+    assert passwords.check_password(hashed, "foobar")
+
+
+def test_check_malformed_hash(test_app):
+    assert not passwords.check_password("$2b$04$truncated", "foobar")
+    assert not passwords.check_password("not a hash", "foobar")
+
+
+def test_argon2_check_malformed_hash(test_app):
+    pytest.importorskip("argon2")
+    assert not passwords.check_password("$argon2", "foobar")
+    assert not passwords.check_password("$argon2id$v=19$m=1024,t=1,p=2$", "foobar")
+
+
+def test_calibrate(test_app):
+    assert passwords.calibrate("bcrypt", 0)[0] == 4
+    cost, ms = passwords.calibrate("bcrypt", 1)
+    assert 4 <= cost < 32
+    assert ms >= 1 or cost == 31
+    with pytest.raises(ValueError):
+        passwords.calibrate("md5", 0)
+
+
+def _login(client, email, password):
+    return client.post(
+        "/auth/login",
+        data=json.dumps({"email": email, "password": password}),
+        content_type="application/json",
+    )
+
+
+def _drain_rehashes():
+    # the rehash executor has a single thread, so this waits for earlier jobs
+    passwords._rehasher.executor.submit(lambda: None).result()
+
+
+def test_login_upgrades_outdated_hash(test_app, test_database, monkeypatch):
+    test_database.session.query(User).delete()
+    user = User(username="rehash", email="rehash@bar.com", password="foobar")
+    test_database.session.add(user)
+    test_database.session.commit()
+    user_id, old = user.id, user.password
+    upgraded = metrics.registry["password_rehashes_total"].labels("upgraded").value
+
+    monkeypatch.setitem(test_app.config, "BCRYPT_LOG_ROUNDS", 5)
+    client = test_app.test_client()
+    assert _login(client, "rehash@bar.com", "foobar").status_code == 200
+    _drain_rehashes()
+    test_database.session.expire_all()
+    new = test_database.session.query(User).get(user_id).password
+    assert new != old
+    assert new.startswith("$2b$05$")
+    assert bcrypt.check_password_hash(new, "foobar")
+    rehashes = metrics.registry["password_rehashes_total"]
+    assert rehashes.labels("upgraded").value == upgraded + 1
+
+    # up to date now: logging in again leaves the hash alone
+    assert _login(client, "rehash@bar.com", "foobar").status_code == 200
+    _drain_rehashes()
+    test_database.session.expire_all()
+    assert test_database.session.query(User).get(user_id).password == new
+
+
+def test_rehash_does_not_overwrite_changed_password(
+    test_app, test_database, monkeypatch
+):
+    test_database.session.query(User).delete()
+    user = User(username="stale", email="stale@bar.com", password="foobar")
+    test_database.session.add(user)
+    test_database.session.commit()
+    # detached, ``user`` keeps the hash that was verified before the change
+    user.password
+    test_database.session.expunge(user)
+    changed = passwords.hash_password("changed")
+    test_database.session.query(User).filter_by(id=user.id).update(
+        {"password": changed}, synchronize_session=False
+    )
+    test_database.session.commit()
+    stale = metrics.registry["password_rehashes_total"].labels("stale").value
+
+    monkeypatch.setitem(test_app.config, "BCRYPT_LOG_ROUNDS", 5)
+    assert upgrade_password(user, "foobar").result() is False
+    test_database.session.expire_all()
+    assert test_database.session.query(User).get(user.id).password == changed
+    rehashes = metrics.registry["password_rehashes_total"]
+    assert rehashes.labels("stale").value == stale + 1
+
+    monkeypatch.setitem(test_app.config, "PASSWORD_REHASH", False)
+    assert upgrade_password(user, "foobar") is None
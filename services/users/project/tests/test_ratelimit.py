@@ -0,0 +1,120 @@
+import json
+
+import pytest
+
+import project.api.auth
+from project.api.users.models import User
+from project.ratelimit import RedisStore, hit
+
+
+@pytest.fixture
+def ratelimited(test_app, monkeypatch):
+    monkeypatch.setitem(test_app.config, "RATELIMIT_ENABLED", True)
+    test_app.extensions.pop("ratelimit", None)
+    yield test_app
+    test_app.extensions.pop("ratelimit", None)
+
+
+@pytest.fixture(params=["memory", "redis"])
+def store(ratelimited, monkeypatch, request, fake_redis):
+    monkeypatch.setitem(ratelimited.config, "RATELIMIT_STORE", request.param)
+    monkeypatch.setattr(
+        RedisStore,
+        "from_url",
+        classmethod(lambda cls, url, prefix="": cls(fake_redis, prefix)),
+    )
+    ratelimited.extensions.pop("ratelimit", None)
+    return ratelimited
+
+
+def test_sliding_window(store):
+    with store.app_context():
+        for _ in range(4):
+            assert hit("test", "k", 4, 100, now=190)[0]
+        assert hit("test", "k", 4, 100, now=199) == (False, 0, 1)
+        # a quarter into the next window, 3 of the 4 earlier hits still count
+        assert hit("test", "k", 4, 100, now=225) == (True, 0, 75)
+        assert not hit("test", "k", 4, 100, now=225)[0]
+        assert hit("test", "k", 4, 100, now=250) == (True, 0, 50)
+        assert hit("test", "k", 4, 100, now=300) == (True, 1, 100)
+
+
+def login(client, email, password="foobar"):
+    return client.post(
+        "/auth/login",
+        data=json.dumps({"email": email, "password": password}),
+        content_type="application/json",
+    )
+
+
+def test_login_throttled_per_account(
+    test_app, test_database, ratelimited, add_user, monkeypatch
+):
+    test_database.session.query(User).delete()
+    add_user("foo", "foo@bar.com", "foobar")
+    monkeypatch.setitem(ratelimited.config, "RATELIMIT_LOGIN", (2, 60))
+    client = ratelimited.test_client()
+
+    resp = login(client, "foo@bar.com", "wrong")
+    assert resp.status_code == 404
+    assert resp.headers["RateLimit-Limit"] == "2"
+    assert resp.headers["RateLimit-Remaining"] == "1"
+    assert login(client, "FOO@bar.com").status_code == 200
+
+    def fail(*args):
+        raise AssertionError("throttled logins must not reach the database")
+
+    with monkeypatch.context() as m:
+        m.setattr(project.api.auth, "get_user_by_email", fail)
+        m.setattr(project.api.auth, "check_password", fail)
+        resp = login(client, "foo@bar.com")
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 429
+    assert "Too many requests" in data["message"]
+    assert int(resp.headers["Retry-After"]) > 0
+    assert resp.headers["RateLimit-Remaining"] == "0"
+
+    # other accounts from the same address are unaffected
+    assert login(client, "bar@foo.com").status_code == 404
+
+
+def test_auth_throttled_per_ip(ratelimited, monkeypatch):
+    monkeypatch.setitem(ratelimited.config, "RATELIMIT_AUTH", (1, 60))
+    monkeypatch.setitem(ratelimited.config, "PROXY_COUNT", 1)
+    client = ratelimited.test_client()
+    forwarded = {"X-Forwarded-For": "10.0.0.1"}
+    assert client.get("/auth/status", headers=forwarded).status_code == 403
+    assert client.get("/auth/status", headers=forwarded).status_code == 429
+    resp = client.get("/auth/status", headers={"X-Forwarded-For": "10.0.0.2"})
+    assert resp.status_code == 403
+
+
+def test_create_user_throttled_per_ip(
+    test_app, test_database, ratelimited, monkeypatch
+):
+    test_database.session.query(User).delete()
+    monkeypatch.setitem(ratelimited.config, "RATELIMIT_CREATE_USER", (1, 60))
+    client = ratelimited.test_client()
+    for status_code in (201, 429):
+        resp = client.post(
+            "/users",
+            data=json.dumps(
+                {"username": "foo", "email": "foo@bar.com", "password": "foobar"}
+            ),
+            content_type="application/json",
+        )
+        assert resp.status_code == status_code
+
+
+def test_bulk_import_throttled_per_ip(
+    test_app, test_database, ratelimited, monkeypatch
+):
+    monkeypatch.setitem(ratelimited.config, "RATELIMIT_BULK_IMPORT", (1, 60))
+    client = ratelimited.test_client()
+    for status_code in (200, 429):
+        resp = client.post(
+            "/users/bulk",
+            data="username,email,password\nbulky,bulky@bar.com,foobar\n",
+            content_type="text/csv",
+        )
+        assert resp.status_code == status_code
@@ -0,0 +1,115 @@
+import json
+
+import pytest
+
+from project import database, db, metrics
+from project.api.users.models import User
+from project.api.users.services import get_user_by_email, get_user_by_id, get_users_page
+
+
+@pytest.fixture
+def replica(test_app, test_database, monkeypatch, tmp_path):
+    path = tmp_path / "users_replica.db"
+    monkeypatch.setitem(
+        test_app.config, "SQLALCHEMY_BINDS", {"replica0": f"sqlite:///{path}"}
+    )
+    monkeypatch.setitem(test_app.config, "DB_REPLICA_LAG_CHECK_INTERVAL", 0)
+    test_app.extensions.pop("db_sticky", None)
+    engine = db.get_engine(test_app, bind="replica0")
+    db.Model.metadata.create_all(engine)
+    test_database.session.query(User).delete()
+    test_database.session.commit()
+    engine.execute(
+        User.__table__.insert().values(
+            id=1000, username="replicated", email="replicated@bar.com", password="x"
+        )
+    )
+    yield engine
+    db.session.remove()
+    db.Model.metadata.drop_all(engine)
+    engine.dispose()
+
+
+def routes(route):
+    return metrics.registry["db_replica_routing_total"].labels(route).value
+
+
+def list_usernames(client, remote_addr="127.0.0.1"):
+    resp = client.get("/users", environ_base={"REMOTE_ADDR": remote_addr})
+    assert resp.status_code == 200
+    return [user["username"] for user in json.loads(resp.data.decode())]
+
+
+def test_reads_stay_on_primary_without_replicas(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    add_user("primary", "primary@bar.com", "foobar")
+    assert get_user_by_email("primary@bar.com").username == "primary"
+
+
+def test_marked_reads_go_to_replica(test_app, test_database, replica, add_user):
+    add_user("primary", "primary@bar.com", "foobar")
+    count = routes("replica")
+    assert get_user_by_email("primary@bar.com") is None
+    assert get_user_by_email("replicated@bar.com").username == "replicated"
+    users, _ = get_users_page(10)
+    assert [user.username for user in users] == ["replicated"]
+    assert routes("replica") == count + 3
+    # unmarked reads use the primary
+    assert [user.username for user in User.query] == ["primary"]
+
+
+def test_user_cache_fills_from_primary(test_app, test_database, replica, add_user):
+    user = add_user("primary", "primary@bar.com", "foobar")
+    count = routes("replica")
+    assert get_user_by_id(user.id).username == "primary"
+    assert get_user_by_id(1000) is None
+    assert routes("replica") == count
+
+
+def test_reads_after_write_in_transaction_use_primary(test_app, test_database, replica):
+    test_database.session.add(User("pending", "pending@bar.com", "foobar"))
+    # the autoflush writes to the primary, so the read must follow it there
+    assert get_user_by_email("pending@bar.com").username == "pending"
+    test_database.session.rollback()
+    assert get_user_by_email("replicated@bar.com").username == "replicated"
+
+
+def test_client_reads_own_writes(test_app, test_database, replica):
+    client = test_app.test_client()
+    assert list_usernames(client) == ["replicated"]
+    resp = client.post(
+        "/users",
+        data=json.dumps({"username": "new", "email": "new@bar.com", "password": "x"}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 201
+    count = routes("sticky")
+    assert list_usernames(client) == ["new"]
+    assert routes("sticky") > count
+    # other clients keep reading from the replica
+    assert list_usernames(client, "10.0.0.2") == ["replicated"]
+
+
+def test_writes_read_the_primary(test_app, test_database, replica, add_user):
+    user = add_user("primary", "primary@bar.com", "foobar")
+    client = test_app.test_client()
+    resp = client.put(
+        f"/users/{user.id}",
+        data=json.dumps({"username": "renamed", "email": "primary@bar.com"}),
+        content_type="application/json",
+        environ_base={"REMOTE_ADDR": "10.0.0.3"},
+    )
+    assert resp.status_code == 200
+
+
+def test_lagging_replica_falls_back_to_primary(
+    test_app, test_database, replica, add_user, monkeypatch
+):
+    add_user("primary", "primary@bar.com", "foobar")
+    monkeypatch.setattr(database, "replica_lag", lambda engine: 60.0)
+    count = routes("lagging")
+    assert get_user_by_email("primary@bar.com").username == "primary"
+    assert routes("lagging") == count + 1
+
+    monkeypatch.setattr(database, "replica_lag", lambda engine: 1.0)
+    assert get_user_by_email("primary@bar.com") is None
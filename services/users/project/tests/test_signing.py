@@ -0,0 +1,85 @@
+import datetime
+import json
+
+import jwt
+import pytest
+
+from project.api.users.models import User
+from project.api.users.signing import generate_private_key_pem, new_kid
+
+pytest.importorskip("cryptography")
+
+
+def write_key(directory, hours_from_now):
+    activates_at = datetime.datetime.utcnow() + datetime.timedelta(hours=hours_from_now)
+    kid = new_kid(activates_at)
+    (directory / f"{kid}.pem").write_bytes(generate_private_key_pem())
+    return kid
+
+
+@pytest.fixture
+def keys_dir(test_app, tmp_path, monkeypatch):
+    monkeypatch.setitem(test_app.config, "JWT_KEYS_DIR", str(tmp_path))
+    monkeypatch.setitem(test_app.config, "JWT_KEYS_RELOAD_INTERVAL", 0)
+    monkeypatch.setitem(test_app.config, "ACCESS_TOKEN_EXPIRATION", 900)
+    monkeypatch.setitem(test_app.config, "REFRESH_TOKEN_EXPIRATION", 3600)
+    return tmp_path
+
+
+def test_rs256_tokens_verify_against_jwks(test_app, keys_dir):
+    current = write_key(keys_dir, -2)
+    upcoming = write_key(keys_dir, 24)
+    client = test_app.test_client()
+
+    resp = client.get("/.well-known/jwks.json")
+    assert resp.status_code == 200
+    assert "max-age=300" in resp.headers["Cache-Control"]
+    jwks = json.loads(resp.data.decode())
+    assert [key["kid"] for key in jwks["keys"]] == [current, upcoming]
+    resp = client.get(
+        "/.well-known/jwks.json", headers={"If-None-Match": resp.headers["ETag"]}
+    )
+    assert resp.status_code == 304
+
+    with test_app.app_context():
+        token = User().encode_token(7, "access")
+        assert User.decode_token(token) == 7
+    assert jwt.get_unverified_header(token) == {
+        "alg": "RS256",
+        "kid": current,
+        "typ": "JWT",
+    }
+
+    # a downstream service needs nothing but the published key
+    public_key = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwks["keys"][0]))
+    assert jwt.decode(token, public_key, algorithms=["RS256"])["sub"] == 7
+
+
+def test_retired_keys_are_dropped(test_app, keys_dir):
+    # the successor has been signing for longer than any token lives
+    retired = write_key(keys_dir, -5)
+    current = write_key(keys_dir, -2)
+    with test_app.app_context():
+        token = User().encode_token(7, "access")
+        assert jwt.get_unverified_header(token)["kid"] == current
+        forged = jwt.encode(
+            {"sub": 7},
+            (keys_dir / f"{retired}.pem").read_bytes(),
+            algorithm="RS256",
+            headers={"kid": retired},
+        )
+        with pytest.raises(jwt.InvalidTokenError):
+            User.decode_token(forged)
+    jwks = json.loads(test_app.test_client().get("/.well-known/jwks.json").data)
+    assert [key["kid"] for key in jwks["keys"]] == [current]
+
+
+def test_hs256_tokens_rejected_with_a_kid(test_app):
+    with test_app.app_context():
+        token = jwt.encode(
+            {"sub": 7}, test_app.config["SECRET_KEY"], headers={"kid": "x"}
+        )
+        with pytest.raises(jwt.InvalidTokenError):
+            User.decode_token(token)
+    jwks = json.loads(test_app.test_client().get("/.well-known/jwks.json").data)
+    assert jwks == {"keys": []}
@@ -0,0 +1,139 @@
+import datetime
+import json
+
+import pytest
+
+from project.api.users.cache import user_cache, user_cache_hits, user_cache_misses
+from project.api.users.models import User
+from project.api.users.services import UserChanged, get_user_by_id, update_user
+from project.cache import RedisBackend
+
+
+@pytest.fixture(params=["memory", "redis"])
+def cache_backend(test_app, monkeypatch, request, fake_redis):
+    monkeypatch.setitem(test_app.config, "USER_CACHE_BACKEND", request.param)
+    monkeypatch.setattr(
+        RedisBackend,
+        "from_url",
+        classmethod(lambda cls, url, prefix="": cls(fake_redis, prefix)),
+    )
+    test_app.extensions.pop("user_cache", None)
+    yield request.param
+    test_app.extensions.pop("user_cache", None)
+
+
+def test_get_user_by_id_cached(test_app, test_database, add_user, cache_backend):
+    test_database.session.query(User).delete()
+    user = add_user("foo", "foo@bar.com", "foobar")
+    user_id = user.id
+    test_database.session.expunge_all()
+
+    misses = user_cache_misses.value
+    hits = user_cache_hits.value
+    assert get_user_by_id(user_id).email == "foo@bar.com"
+    assert user_cache_misses.value == misses + 1
+
+    test_database.session.expunge_all()
+    cached = get_user_by_id(user_id)
+    assert user_cache_hits.value == hits + 1
+    assert cached.email == "foo@bar.com"
+    assert cached.created_date == user.created_date
+    assert cached.password
+
+
+def test_get_user_by_id_negative_cache(
+    test_app, test_database, add_user, cache_backend
+):
+    test_database.session.query(User).delete()
+    assert get_user_by_id(999) is None
+    assert user_cache.get(999) == {}
+    assert get_user_by_id(999) is None
+
+
+def test_user_cache_invalidated_on_write(
+    test_app, test_database, add_user, cache_backend
+):
+    test_database.session.query(User).delete()
+    client = test_app.test_client()
+    client.post(
+        "/users",
+        data=json.dumps(
+            {"username": "foo", "email": "foo@bar.com", "password": "foobar"}
+        ),
+        content_type="application/json",
+    )
+    user_id = test_database.session.query(User).one().id
+
+    assert client.get(f"/users/{user_id}").status_code == 200
+    client.put(
+        f"/users/{user_id}",
+        data=json.dumps({"username": "bar", "email": "bar@foo.com"}),
+        content_type="application/json",
+    )
+    data = json.loads(client.get(f"/users/{user_id}").data.decode())
+    assert data["username"] == "bar"
+
+    assert client.delete(f"/users/{user_id}").status_code == 200
+    assert client.get(f"/users/{user_id}").status_code == 404
+
+
+def test_writes_bypass_stale_cache(test_app, test_database, add_user, cache_backend):
+    test_database.session.query(User).delete()
+    user = add_user("foo", "foo@bar.com", "foobar")
+    user_id = user.id
+    client = test_app.test_client()
+    assert client.get(f"/users/{user_id}").status_code == 200
+    # another worker updates the row; this worker's cache entry is now stale
+    table = User.__table__
+    test_database.session.execute(
+        table.update().where(table.c.id == user_id).values(version=table.c.version + 1)
+    )
+    test_database.session.commit()
+    test_database.session.expunge_all()
+    resp = client.put(
+        f"/users/{user_id}",
+        data=json.dumps({"username": "bar", "email": "foo@bar.com"}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200
+    assert test_database.session.query(User).get(user_id).username == "bar"
+
+
+def test_write_of_stale_user_conflicts(
+    test_app, test_database, add_user, cache_backend
+):
+    test_database.session.query(User).delete()
+    user_id = add_user("foo", "foo@bar.com", "foobar").id
+    test_database.session.expunge_all()
+    get_user_by_id(user_id)
+    stale = get_user_by_id(user_id)
+    table = User.__table__
+    test_database.session.execute(
+        table.update().where(table.c.id == user_id).values(version=table.c.version + 1)
+    )
+    with pytest.raises(UserChanged):
+        update_user(stale, "bar", "foo@bar.com")
+    assert test_database.session.query(User).get(user_id).username == "foo"
+
+
+def test_write_of_user_deleted_elsewhere(
+    test_app, test_database, add_user, cache_backend
+):
+    test_database.session.query(User).delete()
+    user_id = add_user("foo", "foo@bar.com", "foobar").id
+    client = test_app.test_client()
+    assert client.get(f"/users/{user_id}").status_code == 200
+    table = User.__table__
+    test_database.session.execute(
+        table.update()
+        .where(table.c.id == user_id)
+        .values(deleted_at=datetime.datetime.utcnow())
+    )
+    test_database.session.commit()
+    assert client.delete(f"/users/{user_id}").status_code == 404
+    resp = client.put(
+        f"/users/{user_id}",
+        data=json.dumps({"username": "bar", "email": "foo@bar.com"}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 404
@@ -2,9 +2,13 @@ import time
 from datetime import datetime
 
 import jwt
+import pytest
 
 from project.api.users.models import User
 
+# every test adds bar@baz.com, and emails are unique
+pytestmark = pytest.mark.usefixtures("clean_users")
+
 
 def test_password_hashes_are_random(test_app, test_database, add_user):
     user_one = add_user("foo", "bar@baz.com", "foobar")
@@ -1,13 +1,20 @@
 import json
+from datetime import datetime, timedelta
 
 import pytest
+from sqlalchemy import event
 
 from project import bcrypt, db
 from project.api.users.models import User
-from project.api.users.services import get_user_by_id
+from project.api.users.services import (
+    get_user_by_email,
+    get_user_by_id,
+    purge_deleted_users,
+)
 
 
 def test_add_user(test_app, test_database):
+    test_database.session.query(User).delete()
     client = test_app.test_client()
     resp = client.post(
         "/users",
@@ -43,6 +50,7 @@ def test_add_user_invalid(test_app, test_database, payload, status_code, message
 
 
 def test_add_duplicate_user(test_app, test_database):
+    test_database.session.query(User).delete()
     client = test_app.test_client()
     resp = client.post(
         "/users",
@@ -72,6 +80,7 @@ def test_add_duplicate_user(test_app, test_database):
 
 
 def test_get_user(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
     user = add_user(
         username="testuser", email="testuser@example.com", password="qqutwoei"
     )
@@ -111,6 +120,323 @@ def test_get_all_users(test_app, test_database, add_user):
     assert "password" not in data[1]
 
 
+def test_get_all_users_paginated(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    for i in range(5):
+        add_user(f"testuser{i}", f"testuser{i}@example.com", "qoowtuxbff")
+    client = test_app.test_client()
+
+    usernames = []
+    url = "/users?limit=2"
+    while url:
+        resp = client.get(url)
+        assert resp.status_code == 200
+        data = json.loads(resp.data.decode())
+        assert len(data) <= 2
+        usernames += [row["username"] for row in data]
+        cursor = resp.headers.get("X-Next-Cursor")
+        url = f"/users?limit=2&cursor={cursor}" if cursor else None
+    assert usernames == [f"testuser{i}" for i in range(5)]
+
+    # browsers on another origin may only read headers CORS exposes
+    resp = client.get("/users?limit=2", headers={"Origin": "http://localhost:3007"})
+    exposed = resp.headers["Access-Control-Expose-Headers"]
+    assert "X-Next-Cursor" in exposed
+
+
+def test_get_all_users_filtered(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    alice = add_user("alice", "alice@example.com", "qoowtuxbff")
+    bob = add_user("bob", "bob@example.org", "qoowtuxbff")
+    carol = add_user("carol", "carol_smith@example.com", "qoowtuxbff")
+    alice.created_date = datetime(2019, 1, 1)
+    bob.created_date = datetime(2019, 6, 1)
+    carol.created_date = datetime(2020, 1, 1)
+    bob.active = False
+    db.session.commit()
+    client = test_app.test_client()
+
+    def usernames(url):
+        resp = client.get(url)
+        assert resp.status_code == 200
+        return [row["username"] for row in json.loads(resp.data.decode())]
+
+    assert usernames("/users?active=false") == ["bob"]
+    assert usernames("/users?active=true") == ["alice", "carol"]
+    assert usernames("/users?created_after=2019-03-01") == ["bob", "carol"]
+    assert usernames("/users?created_before=2019-03-01") == ["alice"]
+    assert usernames("/users?q=BO") == ["bob"]
+    assert usernames("/users?q=example.org") == []
+    assert usernames("/users?q=example.org&match=contains") == ["bob"]
+    assert usernames("/users?q=_&match=contains") == ["carol"]
+    assert usernames("/users?sort=-created_date") == ["carol", "bob", "alice"]
+
+
+@pytest.mark.parametrize("sort", ["username", "-email", "-created_date", "-id"])
+def test_get_all_users_sorted_pages(test_app, test_database, add_user, sort):
+    test_database.session.query(User).delete()
+    for i, name in enumerate(["dave", "alice", "carol", "bob", "erin"]):
+        user = add_user(name, f"{name}@example.com", "qoowtuxbff")
+        user.created_date = datetime(2019, 1, 1 + i % 2)
+    db.session.commit()
+    client = test_app.test_client()
+
+    resp = client.get(f"/users?sort={sort}")
+    expected = [row["username"] for row in json.loads(resp.data.decode())]
+    assert len(expected) == 5
+
+    usernames = []
+    url = f"/users?limit=2&sort={sort}"
+    while url:
+        resp = client.get(url)
+        assert resp.status_code == 200
+        usernames += [row["username"] for row in json.loads(resp.data.decode())]
+        link = resp.headers.get("Link")
+        url = link[1:].split(">")[0] if link else None
+    assert usernames == expected
+    if sort == "username":
+        assert usernames == ["alice", "bob", "carol", "dave", "erin"]
+
+
+@pytest.mark.parametrize("sort", ["created_date", "-created_date"])
+def test_get_all_users_pages_by_default_created_date(
+    test_app, test_database, add_user, sort
+):
+    # created_date left to its default, with several users made
+    # within the same second
+    test_database.session.query(User).delete()
+    for name in ["dave", "alice", "carol", "bob", "erin", "frank", "grace"]:
+        add_user(name, f"{name}@example.com", "qoowtuxbff")
+    client = test_app.test_client()
+
+    usernames = []
+    url = f"/users?limit=2&sort={sort}"
+    for _ in range(5):
+        resp = client.get(url)
+        assert resp.status_code == 200
+        usernames += [row["username"] for row in json.loads(resp.data.decode())]
+        link = resp.headers.get("Link")
+        if not link:
+            break
+        url = link[1:].split(">")[0]
+    assert sorted(usernames) == [
+        "alice",
+        "bob",
+        "carol",
+        "dave",
+        "erin",
+        "frank",
+        "grace",
+    ]
+
+
+def test_get_all_users_cursor_from_other_sort(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    for name in ("alice", "bob"):
+        add_user(name, f"{name}@example.com", "qoowtuxbff")
+    client = test_app.test_client()
+    resp = client.get("/users?limit=1")
+    cursor = resp.headers["X-Next-Cursor"]
+    resp = client.get(f"/users?limit=1&sort=username&cursor={cursor}")
+    assert resp.status_code == 400
+    assert "Invalid cursor" in json.loads(resp.data.decode())["message"]
+
+
+def test_get_all_users_etag(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    add_user("testuser1", "testuser1@example.com", "qoowtuxbff")
+    client = test_app.test_client()
+
+    resp = client.get("/users")
+    etag = resp.headers["ETag"]
+    assert etag.startswith('W/"users-')
+    assert resp.headers["Cache-Control"] == "private, no-cache"
+    resp = client.get("/users", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.data == b""
+
+    client.post(
+        "/users",
+        data=json.dumps(
+            {
+                "username": "testuser2",
+                "email": "testuser2@example.com",
+                "password": "qoowtuxbff",
+            }
+        ),
+        content_type="application/json",
+    )
+    resp = client.get("/users", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert len(json.loads(resp.data.decode())) == 2
+    assert resp.headers["ETag"] != etag
+
+    etag = resp.headers["ETag"]
+    client.post(
+        "/users/bulk",
+        data="username,email,password\nbulk,bulk@example.com,qoowtuxbff\n",
+        content_type="text/csv",
+    )
+    resp = client.get("/users", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+
+
+def test_single_user_etag(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    user = add_user("jeffrey", "jeffrey@testdriven.io", "qoowtuxbff")
+    client = test_app.test_client()
+
+    resp = client.get(f"/users/{user.id}")
+    etag = resp.headers["ETag"]
+    assert etag == f'W/"user-{user.id}-1"'
+    resp = client.get(f"/users/{user.id}", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+
+    client.put(
+        f"/users/{user.id}",
+        data=json.dumps({"username": "jeff", "email": "jeffrey@testdriven.io"}),
+        content_type="application/json",
+    )
+    resp = client.get(f"/users/{user.id}", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] == f'W/"user-{user.id}-2"'
+    assert json.loads(resp.data.decode())["username"] == "jeff"
+
+
+def test_get_all_users_stream(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    add_user("testuser1", "testuser1@example.com", "qoowtuxbff")
+    add_user("testuser2", "testuser2@example.com", "zzshlwwayu")
+    client = test_app.test_client()
+    resp = client.get("/users", headers={"Accept": "application/x-ndjson"})
+    assert resp.status_code == 200
+    assert resp.content_type == "application/x-ndjson"
+    rows = [json.loads(line) for line in resp.data.decode().splitlines()]
+    assert [row["username"] for row in rows] == ["testuser1", "testuser2"]
+    assert "password" not in rows[0]
+
+
+def test_batch_get_users(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    first = add_user("testuser1", "testuser1@example.com", "qoowtuxbff")
+    second = add_user("testuser2", "testuser2@example.com", "zzshlwwayu")
+    missing = second.id + 100
+    ids = [second.id, missing, first.id, second.id]
+    client = test_app.test_client()
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        if "FROM users" in statement:
+            statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", count)
+    try:
+        resp = client.post(
+            "/users/batch-get",
+            data=json.dumps({"ids": ids}),
+            content_type="application/json",
+        )
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 200
+    assert [user["username"] for user in data["users"]] == ["testuser2", "testuser1"]
+    assert data["missing"] == [missing]
+    assert "password" not in data["users"][0]
+    assert len(statements) == 1
+
+    resp = client.get("/users?ids=" + ",".join(str(user_id) for user_id in ids))
+    assert resp.status_code == 200
+    assert json.loads(resp.data.decode()) == data
+    etag = resp.headers["ETag"]
+    resp = client.get(
+        f"/users?ids={first.id},{second.id}", headers={"If-None-Match": etag}
+    )
+    assert resp.status_code == 304
+
+
+def test_batch_get_users_invalid(test_app, test_database, monkeypatch):
+    monkeypatch.setitem(test_app.config, "USERS_BATCH_MAX_IDS", 2)
+    client = test_app.test_client()
+    resp = client.post(
+        "/users/batch-get",
+        data=json.dumps({"ids": [1, 2, 3]}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 400
+    assert "At most 2 ids" in json.loads(resp.data.decode())["message"]
+    resp = client.post(
+        "/users/batch-get",
+        data=json.dumps({"ids": ["one"]}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 400
+    assert client.get("/users?ids=1,two").status_code == 400
+    resp = client.get("/users?ids=")
+    assert json.loads(resp.data.decode()) == {"users": [], "missing": []}
+
+
+def test_get_all_users_sparse_fields(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    add_user("testuser1", "testuser1@example.com", "qoowtuxbff")
+    add_user("testuser2", "testuser2@example.com", "zzshlwwayu")
+    client = test_app.test_client()
+    statements = []
+
+    def capture(conn, cursor, statement, *args):
+        if "FROM users" in statement:
+            statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", capture)
+    try:
+        resp = client.get("/users?fields=username,id")
+    finally:
+        event.remove(db.engine, "before_cursor_execute", capture)
+    assert resp.status_code == 200
+    assert json.loads(resp.data.decode()) == [
+        {"id": user.id, "username": user.username}
+        for user in User.query.order_by(User.id)
+    ]
+    [statement] = statements
+    assert "users.email" not in statement
+    assert "users.created_date" not in statement
+
+    resp = client.get("/users?fields=username&sort=-email&limit=1")
+    assert json.loads(resp.data.decode()) == [{"username": "testuser2"}]
+    resp = client.get("/users?fields=email", headers={"Accept": "application/x-ndjson"})
+    rows = [json.loads(line) for line in resp.data.decode().splitlines()]
+    assert rows == [
+        {"email": "testuser1@example.com"},
+        {"email": "testuser2@example.com"},
+    ]
+
+
+def test_get_users_sparse_fields_by_id(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    user = add_user("testuser1", "testuser1@example.com", "qoowtuxbff")
+    client = test_app.test_client()
+    resp = client.get(f"/users/{user.id}?fields=email")
+    assert json.loads(resp.data.decode()) == {"email": "testuser1@example.com"}
+    resp = client.post(
+        "/users/batch-get?fields=username",
+        data=json.dumps({"ids": [user.id, user.id + 1]}),
+        content_type="application/json",
+    )
+    assert json.loads(resp.data.decode()) == {
+        "users": [{"username": "testuser1"}],
+        "missing": [user.id + 1],
+    }
+    resp = client.get(f"/users?ids={user.id}&fields=id")
+    assert json.loads(resp.data.decode())["users"] == [{"id": user.id}]
+
+
+@pytest.mark.parametrize("fields", ["password", "id,nope", ",", ""])
+def test_get_users_sparse_fields_invalid(test_app, test_database, fields):
+    resp = test_app.test_client().get(f"/users?fields={fields}")
+    assert resp.status_code == 400
+    assert "fields must be some of" in resp.data.decode()
+
+
 def test_delete_user(test_app, test_database, add_user):
     test_database.session.query(User).delete()
     user = add_user("testuser1", "testuser1@example.com", "woivuuwbwqp")
@@ -135,6 +461,57 @@ def test_delete_user(test_app, test_database, add_user):
     assert len(data) == 0
 
 
+def test_delete_user_is_soft(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    user = add_user("testuser1", "testuser1@example.com", "woivuuwbwqp")
+    user_id = user.id
+    client = test_app.test_client()
+    assert client.delete(f"/users/{user_id}").status_code == 200
+
+    test_database.session.expire_all()
+    row = test_database.session.query(User).get(user_id)
+    assert row.deleted_at is not None
+    assert not row.active
+    assert client.get(f"/users/{user_id}").status_code == 404
+    assert client.delete(f"/users/{user_id}").status_code == 404
+    assert get_user_by_email("testuser1@example.com") is None
+    resp = client.post(
+        "/users/batch-get",
+        data=json.dumps({"ids": [user_id]}),
+        content_type="application/json",
+    )
+    assert json.loads(resp.data.decode())["missing"] == [user_id]
+
+    # the email is free again
+    resp = client.post(
+        "/users",
+        data=json.dumps(
+            {"username": "again", "email": "TestUser1@example.com", "password": "x"}
+        ),
+        content_type="application/json",
+    )
+    assert resp.status_code == 201
+    assert get_user_by_email("testuser1@example.com").username == "again"
+
+
+def test_purge_deleted_users(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    now = datetime.utcnow()
+    users = [add_user(f"user{i}", f"user{i}@example.com", "x") for i in range(6)]
+    for user, days in zip(users, (40, 35, 31, 10, None, None)):
+        if days is not None:
+            user.active = False
+            user.deleted_at = now - timedelta(days=days)
+    test_database.session.commit()
+    ids = [user.id for user in users]
+
+    batches = list(purge_deleted_users(now - timedelta(days=30), batch_size=2))
+    assert batches == [2, 1]
+    remaining = {user_id for (user_id,) in test_database.session.query(User.id)}
+    assert remaining == set(ids[3:])
+    assert list(purge_deleted_users(now - timedelta(days=30), batch_size=2)) == []
+
+
 def test_delete_invalid(test_app, test_database, add_user):
     test_database.session.query(User).delete()
     add_user("foo", "bar", "foobar")
@@ -145,6 +522,33 @@ def test_delete_invalid(test_app, test_database, add_user):
     assert "User 999 does not exist" in data["message"]
 
 
+def test_add_duplicate_user_email_case(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    add_user("testuser", "testuser@example.com", "wbvouxxywo")
+    client = test_app.test_client()
+    resp = client.post(
+        "/users",
+        data=json.dumps(
+            {
+                "username": "testuser",
+                "email": "TestUser@Example.com",
+                "password": "wbvbvcupiuw",
+            }
+        ),
+        content_type="application/json",
+    )
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 400
+    assert "Sorry. That email already exists." in data["message"]
+    assert test_database.session.query(User).count() == 1
+
+
+def test_get_user_by_email_ignores_case(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    user = add_user("testuser", "testuser@example.com", "wbvouxxywo")
+    assert get_user_by_email("TESTUSER@example.com").id == user.id
+
+
 def test_update_user(test_app, test_database, add_user):
     test_database.session.query(User).delete()
     user = add_user("testuser1", "testuser1@example.com", "foobar")
@@ -166,6 +570,22 @@ def test_update_user(test_app, test_database, add_user):
     assert updated_email in data["email"]
 
 
+def test_update_user_duplicate_email(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    add_user("testuser1", "testuser1@example.com", "foobar")
+    user = add_user("testuser2", "testuser2@example.com", "foobar")
+    client = test_app.test_client()
+    resp = client.put(
+        f"/users/{user.id}",
+        data=json.dumps({"username": "testuser2", "email": "testuser1@example.com"}),
+        content_type="application/json",
+    )
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 400
+    assert "Sorry. That email already exists." in data["message"]
+    assert get_user_by_id(user.id).email == "testuser2@example.com"
+
+
 def test_password_ignored_in_update_user(test_app, test_database, add_user):
     test_database.session.query(User).delete()
     original_password = "abxoekwnb"
@@ -211,3 +631,96 @@ def test_update_user_invalid(
     data = json.loads(resp.data.decode())
     assert resp.status_code == status_code
     assert message in data["message"]
+
+
+def test_bulk_add_users_csv(test_app, test_database, add_user):
+    test_database.session.query(User).delete()
+    add_user("taken", "taken@example.com", "foobar")
+    body = "\n".join(
+        [
+            "username,email,password",
+            "bulk1,bulk1@example.com,foobar",
+            "bulk2,TAKEN@example.com,foobar",
+            "bulk3,bulk3@example.com,",
+            "bulk4,BULK1@example.com,foobar",
+            "bulk5,bulk5@example.com,foobar",
+        ]
+    )
+    client = test_app.test_client()
+    resp = client.post("/users/bulk", data=body, content_type="text/csv")
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 200
+    assert (data["created"], data["duplicate"], data["invalid"]) == (2, 2, 1)
+    assert [row["status"] for row in data["results"]] == [
+        "created",
+        "duplicate",
+        "invalid",
+        "duplicate",
+        "created",
+    ]
+    user = get_user_by_email("bulk5@example.com")
+    assert data["results"][4]["id"] == user.id
+    assert bcrypt.check_password_hash(user.password, "foobar")
+
+
+def test_bulk_add_users_row_limit(test_app, test_database, monkeypatch):
+    test_database.session.query(User).delete()
+    monkeypatch.setitem(test_app.config, "USERS_BULK_SYNC_MAX_ROWS", 1)
+    resp = test_app.test_client().post(
+        "/users/bulk",
+        data="username,email,password\na,a@example.com,x\nb,b@example.com,x\n",
+        content_type="text/csv",
+    )
+    assert resp.status_code == 413
+    assert "Prefer: respond-async" in json.loads(resp.data.decode())["message"]
+    assert User.query.count() == 0
+
+
+def test_bulk_add_users_ndjson(test_app, test_database, monkeypatch):
+    test_database.session.query(User).delete()
+    monkeypatch.setitem(test_app.config, "USERS_BULK_BATCH_SIZE", 2)
+    lines = [
+        json.dumps(
+            {"username": f"bulk{i}", "email": f"bulk{i}@example.com", "password": "x"}
+        )
+        for i in range(5)
+    ]
+    lines.insert(2, "not json")
+    client = test_app.test_client()
+    resp = client.post(
+        "/users/bulk", data="\n".join(lines), content_type="application/x-ndjson"
+    )
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 200
+    assert (data["created"], data["invalid"]) == (5, 1)
+    assert data["results"][2] == {"row": 3, "status": "invalid"}
+    assert test_database.session.query(User).count() == 5
+
+
+def test_bulk_add_users_too_long(test_app, test_database):
+    test_database.session.query(User).delete()
+    long_email = "a" * 117 + "@example.com"
+    assert len(long_email) == 129
+    body = "\n".join(
+        [
+            "username,email,password",
+            f"long,{long_email},foobar",
+            f"{'b' * 129},short@example.com,foobar",
+            "fits,fits@example.com,foobar",
+        ]
+    )
+    resp = test_app.test_client().post("/users/bulk", data=body, content_type="text/csv")
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 200
+    assert [result["status"] for result in data["results"]] == [
+        "invalid",
+        "invalid",
+        "created",
+    ]
+    assert test_database.session.query(User).count() == 1
+
+
+def test_bulk_add_users_unsupported_format(test_app, test_database):
+    client = test_app.test_client()
+    resp = client.post("/users/bulk", data="{}", content_type="application/json")
+    assert resp.status_code == 415
@@ -0,0 +1,18 @@
+from project.bloom import BloomFilter
+
+
+def test_bloom_filter_membership():
+    bloom = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add(f"key{i}")
+    assert all(f"key{i}" in bloom for i in range(1000))
+    false_positives = sum(f"other{i}" in bloom for i in range(10000))
+    assert false_positives < 300
+    assert bloom.count <= 1000
+
+
+def test_bloom_filter_readd_does_not_count():
+    bloom = BloomFilter(10)
+    bloom.add("foo")
+    bloom.add("foo")
+    assert bloom.count == 1
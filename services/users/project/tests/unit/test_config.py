@@ -1,5 +1,11 @@
 import os
 
+import jwt.algorithms
+import pytest
+from flask import Flask
+
+from project.api.users import signing
+
 
 def test_postgres_host(test_app):
     assert test_app.config["POSTGRES_HOST"] == os.environ.get("POSTGRES_HOST")
@@ -33,3 +39,11 @@ def test_production_config(test_app):
     assert test_app.config["BCRYPT_LOG_ROUNDS"] == 13
     assert test_app.config["ACCESS_TOKEN_EXPIRATION"] == 900
     assert test_app.config["REFRESH_TOKEN_EXPIRATION"] == 2592000
+
+
+def test_jwt_keys_dir_needs_cryptography(monkeypatch, tmp_path):
+    app = Flask(__name__)
+    app.config["JWT_KEYS_DIR"] = str(tmp_path)
+    monkeypatch.setattr(jwt.algorithms, "has_crypto", False)
+    with pytest.raises(RuntimeError, match="cryptography"):
+        signing.init_app(app)
@@ -0,0 +1,56 @@
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+from project import db, metrics
+from project.database import InstrumentedQueuePool
+
+
+def engine_options(app, uri):
+    options = {}
+    db.apply_driver_hacks(app, make_url(uri), options)
+    return options
+
+
+def test_postgres_pool_options(test_app):
+    options = engine_options(test_app, "postgresql://runner@postgres:5432/users")
+    assert options["poolclass"] is InstrumentedQueuePool
+    assert options["pool_size"] == test_app.config["DB_POOL_SIZE"]
+    assert options["max_overflow"] == test_app.config["DB_MAX_OVERFLOW"]
+    assert options["pool_timeout"] == test_app.config["DB_POOL_TIMEOUT"]
+    assert options["pool_recycle"] == test_app.config["DB_POOL_RECYCLE"]
+    assert options["pool_pre_ping"]
+
+
+def test_transaction_pooler_uses_null_pool(test_app, monkeypatch):
+    monkeypatch.setitem(test_app.config, "DB_TRANSACTION_POOLER", True)
+    options = engine_options(test_app, "postgresql://runner@pgbouncer:6432/users")
+    assert options["poolclass"] is NullPool
+    assert "pool_size" not in options
+
+
+def test_sqlite_pool_options_untouched(test_app):
+    options = engine_options(test_app, "sqlite://")
+    assert "pool_size" not in options
+    assert options["poolclass"] is not InstrumentedQueuePool
+
+
+def test_pool_checkout_wait_recorded():
+    histogram = metrics.registry["db_pool_checkout_wait_seconds"]
+    count = histogram.count
+    engine = create_engine("sqlite://", poolclass=InstrumentedQueuePool)
+    with engine.connect() as conn:
+        conn.execute("SELECT 1")
+    assert histogram.count == count + 1
+
+
+def test_dispose_engines(test_app, monkeypatch):
+    disposed = []
+    monkeypatch.setattr(Engine, "dispose", lambda engine: disposed.append(engine.url))
+    monkeypatch.setitem(test_app.config, "SQLALCHEMY_BINDS", {"replica0": "sqlite://"})
+    db.dispose_engines(test_app)
+    assert [str(url) for url in disposed] == [
+        test_app.config["SQLALCHEMY_DATABASE_URI"],
+        "sqlite://",
+    ]
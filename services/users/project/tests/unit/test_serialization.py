@@ -0,0 +1,88 @@
+import json
+from collections import namedtuple
+from datetime import date, datetime
+
+import pytest
+from flask_restplus import Model, fields, marshal
+
+import project.serialization
+from project.serialization import Serializer, dumps
+
+model = Model(
+    "Sample",
+    {
+        "id": fields.Integer,
+        "name": fields.String(attribute="username"),
+        "active": fields.Boolean,
+        "score": fields.Float,
+        "created": fields.DateTime,
+        "fallback": fields.String(default="n/a"),
+        "tags": fields.List(fields.String),
+    },
+)
+
+
+class Sample:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+@pytest.mark.parametrize(
+    "obj",
+    [
+        Sample(
+            id=1,
+            username="foo",
+            active=True,
+            score=1.5,
+            created=datetime(2020, 1, 2, 3, 4, 5),
+            fallback="x",
+            tags=["a"],
+        ),
+        Sample(
+            id="2",
+            username=3,
+            active=0,
+            score=2,
+            created=date(2020, 1, 2),
+            fallback=None,
+            tags=None,
+        ),
+        {"id": 3, "username": None, "created": None},
+    ],
+)
+def test_serializer_matches_marshal(obj):
+    assert Serializer(model)(obj) == dict(marshal(obj, model))
+
+
+def test_serializer_row_tuples():
+    serializer = Serializer(Model("Row", {"id": fields.Integer, "name": fields.String}))
+    Row = namedtuple("Row", serializer.columns)
+    assert serializer.columns == ("id", "name")
+    assert serializer.many([Row(1, "foo"), Row(2, None)]) == [
+        {"id": 1, "name": "foo"},
+        {"id": 2, "name": None},
+    ]
+
+
+def test_dumps_without_orjson(monkeypatch):
+    monkeypatch.setattr(project.serialization, "orjson", None)
+    assert dumps({"a": [1, "b"]}) == b'{"a":[1,"b"]}\n'
+
+
+def test_dumps_matches_json():
+    data = {"a": [1, "b", None, True], "c": "é"}
+    assert json.loads(dumps(data)) == data
+    assert dumps(data).endswith(b"\n")
+
+
+def test_serializer_only():
+    serializer = Serializer(model).only({"created", "id", "fallback"})
+    assert list(serializer.model) == ["id", "created", "fallback"]
+    assert serializer.columns == ("id", "created")
+    obj = Sample(id=1, created=datetime(2020, 1, 2), fallback=None)
+    assert serializer(obj) == {
+        "id": 1,
+        "created": "2020-01-02T00:00:00",
+        "fallback": "n/a",
+    }
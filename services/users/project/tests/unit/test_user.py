@@ -7,15 +7,9 @@ import project.api.users.views
 
 
 def test_add_user(test_app, monkeypatch):
-    def mock_get_user_by_email(email):
-        return None
-
     def mock_add_user(username, email, password):
         return True
 
-    monkeypatch.setattr(
-        project.api.users.views, "get_user_by_email", mock_get_user_by_email
-    )
     monkeypatch.setattr(project.api.users.views, "add_user", mock_add_user)
 
     client = test_app.test_client()
@@ -53,15 +47,9 @@ def test_add_user_invalid(test_app, payload, status_code, message):
 
 
 def test_add_duplicate_user(test_app, monkeypatch):
-    def mock_get_user_by_email(email):
-        return True
-
     def mock_add_user(username, email, password):
-        return True
+        return None
 
-    monkeypatch.setattr(
-        project.api.users.views, "get_user_by_email", mock_get_user_by_email
-    )
     monkeypatch.setattr(project.api.users.views, "add_user", mock_add_user)
 
     client = test_app.test_client()
@@ -93,13 +81,23 @@ def test_add_duplicate_user(test_app, monkeypatch):
 
 
 def test_get_user(test_app, monkeypatch):
+    class AttrDict(dict):
+        def __init__(self, *args, **kwargs):
+            super(AttrDict, self).__init__(*args, **kwargs)
+            self.__dict__ = self
+
     def mock_get_user_by_id(user_id):
-        return {
-            "id": 1,
-            "username": "mockuser",
-            "email": "mock@user.com",
-            "created_date": datetime.now(),
-        }
+        d = AttrDict()
+        d.update(
+            {
+                "id": 1,
+                "username": "mockuser",
+                "email": "mock@user.com",
+                "created_date": datetime.now(),
+                "version": 3,
+            }
+        )
+        return d
 
     monkeypatch.setattr(project.api.users.views, "get_user_by_id", mock_get_user_by_id)
 
@@ -110,6 +108,11 @@ def test_get_user(test_app, monkeypatch):
     assert "mockuser" in data["username"]
     assert "mock@user.com" in data["email"]
     assert "password" not in data
+    assert resp.headers["ETag"] == 'W/"user-1-3"'
+
+    resp = client.get("/users/1", headers={"If-None-Match": 'W/"user-1-3"'})
+    assert resp.status_code == 304
+    assert resp.data == b""
 
 
 def test_get_user_does_not_exist(test_app, monkeypatch):
@@ -126,23 +129,27 @@ def test_get_user_does_not_exist(test_app, monkeypatch):
 
 
 def test_get_all_users(test_app, monkeypatch):
-    def mock_get_all_users():
-        return [
-            {
-                "id": 1,
-                "username": "mockuser1",
-                "email": "mock@user1.com",
-                "created_date": datetime.now(),
-            },
-            {
-                "id": 2,
-                "username": "mockuser2",
-                "email": "mock@user2.com",
-                "created_date": datetime.now(),
-            },
-        ]
+    def mock_get_users_page(limit, after=None, **filters):
+        return (
+            [
+                {
+                    "id": 1,
+                    "username": "mockuser1",
+                    "email": "mock@user1.com",
+                    "created_date": datetime.now(),
+                },
+                {
+                    "id": 2,
+                    "username": "mockuser2",
+                    "email": "mock@user2.com",
+                    "created_date": datetime.now(),
+                },
+            ],
+            False,
+        )
 
-    monkeypatch.setattr(project.api.users.views, "get_all_users", mock_get_all_users)
+    monkeypatch.setattr(project.api.users.views, "get_users_page", mock_get_users_page)
+    monkeypatch.setattr(project.api.users.views, "get_users_version", lambda: 7)
 
     client = test_app.test_client()
     resp = client.get("/users")
@@ -155,6 +162,16 @@ def test_get_all_users(test_app, monkeypatch):
     assert "mock@user2.com" in data[1]["email"]
     assert "password" not in data[0]
     assert "password" not in data[1]
+    assert "X-Next-Cursor" not in resp.headers
+    assert resp.headers["ETag"] == 'W/"users-7"'
+
+
+def test_get_all_users_invalid_cursor(test_app):
+    client = test_app.test_client()
+    resp = client.get("/users?cursor=not-a-cursor")
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 400
+    assert "Invalid cursor" in data["message"]
 
 
 def test_delete_user(test_app, monkeypatch):
@@ -172,6 +189,9 @@ def test_delete_user(test_app, monkeypatch):
         return True
 
     monkeypatch.setattr(project.api.users.views, "get_user_by_id", mock_get_user_by_id)
+    monkeypatch.setattr(
+        project.api.users.views, "get_user_for_update", mock_get_user_by_id
+    )
     monkeypatch.setattr(project.api.users.views, "delete_user", mock_delete_user)
 
     client = test_app.test_client()
@@ -187,6 +207,9 @@ def test_delete_invalid(test_app, monkeypatch):
         return None
 
     monkeypatch.setattr(project.api.users.views, "get_user_by_id", mock_get_user_by_id)
+    monkeypatch.setattr(
+        project.api.users.views, "get_user_for_update", mock_get_user_by_id
+    )
 
     client = test_app.test_client()
     resp = client.delete("/users/999")
@@ -209,6 +232,7 @@ def test_update_user(test_app, monkeypatch):
                 "username": "mockuser",
                 "email": "mock@user.com",
                 "created_date": datetime.now(),
+                "version": 1,
             }
         )
         return d
@@ -217,6 +241,9 @@ def test_update_user(test_app, monkeypatch):
         return True
 
     monkeypatch.setattr(project.api.users.views, "get_user_by_id", mock_get_user_by_id)
+    monkeypatch.setattr(
+        project.api.users.views, "get_user_for_update", mock_get_user_by_id
+    )
     monkeypatch.setattr(project.api.users.views, "update_user", mock_update_user)
 
     client = test_app.test_client()
@@ -254,6 +281,9 @@ def test_update_user_invalid(
         return None
 
     monkeypatch.setattr(project.api.users.views, "get_user_by_id", mock_get_user_by_id)
+    monkeypatch.setattr(
+        project.api.users.views, "get_user_for_update", mock_get_user_by_id
+    )
 
     client = test_app.test_client()
     resp = client.put(
@@ -0,0 +1,16 @@
+"""Request helpers shared across the service."""
+from flask import current_app, request
+
+
+def client_ip():
+    """The address of the client behind this request.
+
+    With PROXY_COUNT proxies in front of the app, each appending to
+    X-Forwarded-For, it is the hop the outermost proxy added.
+    """
+    proxies = current_app.config["PROXY_COUNT"]
+    forwarded = request.headers.get("X-Forwarded-For")
+    if proxies and forwarded:
+        hops = [hop.strip() for hop in forwarded.split(",")]
+        return hops[max(len(hops) - proxies, 0)]
+    return request.remote_addr or "unknown"